@@ -1,24 +1,26 @@
 from __future__ import annotations
 
+import queue
+import threading
+import time
+
 import numpy as np
 import numpy.typing as npt
 import torch
 
 
+def _gather_windows(dataset: npt.NDArray, starting_idxs: torch.Tensor, window: int) -> npt.NDArray:
+    # One fancy-indexing read of all (batch_size, window) token windows
+    return dataset[starting_idxs.numpy()[:, None] + np.arange(window)]
+
+
 def get_batch(
     dataset: npt.NDArray, batch_size: int, context_length: int, device: str
 ) -> tuple[torch.Tensor, torch.Tensor]:
     starting_idxs = torch.randint(len(dataset) - context_length, (batch_size,))
-    x = torch.stack([
-            torch.from_numpy((dataset[i : i + context_length]).astype(np.int64))
-            for i in starting_idxs
-    ])  # fmt: skip
-    y = torch.stack(
-        [
-            torch.from_numpy((dataset[i + 1 : i + 1 + context_length]).astype(np.int64))
-            for i in starting_idxs
-        ]
-    )  # fmt: skip
+    windows = torch.from_numpy(_gather_windows(dataset, starting_idxs, context_length + 1).astype(np.int64))
+    x = windows[:, :-1].contiguous()
+    y = windows[:, 1:].contiguous()
     if "cuda" in device:
         x = x.pin_memory().to(device, non_blocking=True)
         y = y.pin_memory().to(device, non_blocking=True)
@@ -26,3 +28,227 @@ def get_batch(
         x = x.to(device)
         y = y.to(device)
     return x, y
+
+
+class BatchSampler:
+    """
+    Allocation-free replacement for `get_batch`.
+
+    Each call draws the same starting indices as `get_batch` (one `torch.randint` call, so runs with
+    the same seed see the same batches), gathers all (batch_size, context_length + 1) windows with a
+    single `np.take` into a preallocated staging buffer, widens them into a reusable (pinned, when
+    the device is CUDA) int64 buffer and copies that to the device in one transfer. `x` and `y` are
+    views `[:, :-1]` and `[:, 1:]` of the same tensor, so they are not contiguous; use `reshape`
+    rather than `view` on them.
+
+    Pass a `generator` to draw indices from it instead of the global torch RNG.
+
+    Host buffers are rotated between `num_buffers` slots. A slot is only overwritten after the
+    asynchronous copy that last read from it has finished, so the next batch can be sampled while
+    the model is still consuming the previous one.
+    """
+
+    def __init__(
+        self,
+        dataset: npt.NDArray,
+        batch_size: int,
+        context_length: int,
+        device: str,
+        num_buffers: int = 2,
+        generator: torch.Generator | None = None,
+    ):
+        if len(dataset) <= context_length:
+            raise ValueError(f"dataset has {len(dataset)} tokens, need more than context_length={context_length}")
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.context_length = context_length
+        self.device = torch.device(device)
+        self.is_cuda = self.device.type == "cuda"
+        self.generator = generator
+        shape = (batch_size, context_length + 1)
+        self._offsets = np.arange(context_length + 1)
+        self._idxs = np.empty(shape, dtype=np.int64)
+        self._staging = np.empty(shape, dtype=dataset.dtype)
+        self._host = [torch.empty(shape, dtype=torch.int64, pin_memory=self.is_cuda) for _ in range(num_buffers)]
+        self._events: list[torch.cuda.Event | None] = [None] * num_buffers
+        self._slot = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> tuple[torch.Tensor, torch.Tensor]:
+        return self.sample()
+
+    def sample(self) -> tuple[torch.Tensor, torch.Tensor]:
+        starting_idxs = torch.randint(
+            len(self.dataset) - self.context_length, (self.batch_size,), generator=self.generator
+        )
+        np.add(starting_idxs.numpy()[:, None], self._offsets, out=self._idxs)
+        np.take(self.dataset, self._idxs, out=self._staging)
+
+        slot = self._slot
+        self._slot = (slot + 1) % len(self._host)
+        event = self._events[slot]
+        if event is not None:
+            # The previous copy out of this slot may still be in flight
+            event.synchronize()
+        host = self._host[slot]
+        np.copyto(host.numpy(), self._staging)
+
+        if self.is_cuda:
+            windows = host.to(self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+            self._events[slot] = event
+        elif self.device.type == "cpu":
+            # On CPU the batch *is* the host buffer; it stays valid for num_buffers - 1 further calls
+            windows = host
+        else:
+            windows = host.to(self.device)
+        return windows[:, :-1], windows[:, 1:]
+
+
+class _WorkerError:
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+class PrefetchLoader:
+    """
+    Samples training batches in `num_workers` background threads and keeps up to `prefetch_depth`
+    of them ready on the device.
+
+    Each worker owns a `BatchSampler` with its own `torch.Generator`, seeded from the global torch
+    RNG when the loader is created, so runs stay reproducible per `torch.manual_seed` (with a
+    single worker; with several, batches arrive in whatever order the workers finish them). On
+    CUDA each worker issues its host-to-device copies on a side stream and waits for them before
+    queueing the batch, so memmap page faults and transfers overlap with compute on the main
+    stream. `num_workers=0` samples synchronously on the calling thread.
+
+    `stats()` reports how often the training loop had to wait for data since the last call.
+    """
+
+    def __init__(
+        self,
+        dataset: npt.NDArray,
+        batch_size: int,
+        context_length: int,
+        device: str,
+        num_workers: int = 1,
+        prefetch_depth: int = 4,
+    ):
+        if prefetch_depth < 1:
+            raise ValueError(f"prefetch_depth must be at least 1, got {prefetch_depth}")
+        self.device = torch.device(device)
+        if self.device.type == "cuda" and self.device.index is None:
+            # The current device is per-thread, so pin it down before starting the workers
+            self.device = torch.device("cuda", torch.cuda.current_device())
+        self.is_cuda = self.device.type == "cuda"
+        self.num_workers = num_workers
+        # On CPU the batches are the samplers' host buffers, which must outlive the queue, the batch
+        # being produced and the two (current and next) held by the training loop
+        num_buffers = 2 if self.is_cuda else prefetch_depth + 4
+        self._samplers = [
+            BatchSampler(
+                dataset,
+                batch_size,
+                context_length,
+                str(self.device),
+                num_buffers=num_buffers,
+                generator=torch.Generator().manual_seed(int(torch.randint(2**62, ()))),
+            )
+            for _ in range(max(num_workers, 1))
+        ]
+        self._queue: queue.Queue = queue.Queue(maxsize=prefetch_depth)
+        self._stop = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._worker, args=(sampler,), daemon=True, name=f"PrefetchLoader-{i}")
+            for i, sampler in enumerate(self._samplers[:num_workers])
+        ]
+        self._reset_stats()
+        for thread in self._threads:
+            thread.start()
+
+    def _reset_stats(self):
+        self._batches = 0
+        self._starved = 0
+        self._wait_seconds = 0.0
+        self._queue_depth = 0
+
+    def _worker(self, sampler: BatchSampler):
+        try:
+            stream = torch.cuda.Stream(device=self.device) if self.is_cuda else None
+            while not self._stop.is_set():
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = sampler.sample()
+                    stream.synchronize()
+                else:
+                    batch = sampler.sample()
+                self._put(batch)
+        except BaseException as exc:
+            self._put(_WorkerError(exc))
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> tuple[torch.Tensor, torch.Tensor]:
+        if not self._threads:
+            return self._samplers[0].sample()
+        depth = self._queue.qsize()
+        start = time.perf_counter()
+        item = self._queue.get()
+        self._wait_seconds += time.perf_counter() - start
+        self._starved += depth == 0
+        self._queue_depth += depth
+        self._batches += 1
+        if isinstance(item, _WorkerError):
+            self.close()
+            raise RuntimeError("PrefetchLoader worker failed") from item.exc
+        x, y = item
+        if self.is_cuda:
+            # The batch was allocated on a worker's stream; keep it alive until the main stream is done with it
+            x.record_stream(torch.cuda.current_stream(self.device))
+        return x, y
+
+    def stats(self, reset: bool = True) -> dict[str, float]:
+        """
+        Data-loading metrics since the last reset: `wait_ms` is the mean time `next` blocked per batch,
+        `starved_frac` the fraction of batches for which the queue was empty, and `queue_depth` the
+        mean number of ready batches found in the queue.
+        """
+        batches = max(self._batches, 1)
+        stats = {
+            "wait_ms": 1000 * self._wait_seconds / batches,
+            "starved_frac": self._starved / batches,
+            "queue_depth": self._queue_depth / batches,
+        }
+        if reset:
+            self._reset_stats()
+        return stats
+
+    def close(self):
+        self._stop.set()
+        # Unblock workers waiting on a full queue
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -49,6 +49,11 @@ class TrainingConfig:
     wandb_project: str | None = None
     wandb_entity: str | None = None
     log_interval: int = 20
+    # Background threads sampling training batches and how many ready batches they keep queued on the
+    # device. 0 samples synchronously on the training thread, still from a generator seeded off the
+    # global torch RNG rather than from the global RNG itself
+    data_workers: int = 1
+    prefetch_depth: int = 4
     save_checkpoints: bool = False
 
 @dataclass
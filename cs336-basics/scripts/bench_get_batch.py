@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import tempfile
+import time
+
+import numpy as np
+import numpy.typing as npt
+import torch
+import typer
+
+from cs336_basics.data import BatchSampler, PrefetchLoader, get_batch
+
+
+def get_batch_loop(
+    dataset: npt.NDArray, batch_size: int, context_length: int, device: str
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """The original per-sample implementation, kept here as the baseline."""
+    starting_idxs = torch.randint(len(dataset) - context_length, (batch_size,))
+    x = torch.stack([torch.from_numpy((dataset[i : i + context_length]).astype(np.int64)) for i in starting_idxs])
+    y = torch.stack(
+        [torch.from_numpy((dataset[i + 1 : i + 1 + context_length]).astype(np.int64)) for i in starting_idxs]
+    )
+    if "cuda" in device:
+        x = x.pin_memory().to(device, non_blocking=True)
+        y = y.pin_memory().to(device, non_blocking=True)
+    else:
+        x = x.to(device)
+        y = y.to(device)
+    return x, y
+
+
+def time_per_step(sample, steps: int, device: str, compute_seconds: float = 0.0) -> float:
+    for _ in range(10):
+        sample()
+    if "cuda" in device:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        sample()
+        # Stands in for the training step, which releases the GIL while waiting on the GPU
+        time.sleep(compute_seconds)
+    if "cuda" in device:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps
+
+
+def bench(
+    batch_size: int = 128,
+    context_length: int = 512,
+    num_tokens: int = 100_000_000,
+    steps: int = 200,
+    compute_ms: float = 0.0,
+    data_workers: int = 1,
+    prefetch_depth: int = 4,
+    device: str = "cuda" if torch.cuda.is_available() else "cpu",
+):
+    """
+    Micro-benchmark of host-side batch sampling: the original per-sample loop, the vectorised
+    `get_batch`, the buffer-reusing `BatchSampler` and the background `PrefetchLoader`, on a random
+    uint16 memmap. `--compute-ms` adds a simulated training step after each batch, which the
+    `PrefetchLoader` can overlap with sampling.
+
+    Usage: uv run scripts/bench_get_batch.py --batch-size 128 --context-length 512 --compute-ms 5
+    """
+    with tempfile.NamedTemporaryFile(suffix=".bin") as f:
+        np.random.default_rng(0).integers(0, 50257, num_tokens, dtype=np.uint16).tofile(f.name)
+        dataset = np.memmap(f.name, dtype=np.uint16, mode="r")
+        sampler = BatchSampler(dataset, batch_size, context_length, device)
+        loader = PrefetchLoader(dataset, batch_size, context_length, device, data_workers, prefetch_depth)
+        candidates = {
+            "loop": lambda: get_batch_loop(dataset, batch_size, context_length, device),
+            "get_batch": lambda: get_batch(dataset, batch_size, context_length, device),
+            "BatchSampler": sampler.sample,
+            "PrefetchLoader": lambda: next(loader),
+        }
+        with loader:
+            results = {
+                name: time_per_step(sample, steps, device, compute_ms / 1000) for name, sample in candidates.items()
+            }
+            loader_stats = loader.stats()
+    print(f"batch_size={batch_size} context_length={context_length} compute_ms={compute_ms} device={device}")
+    for name, seconds in results.items():
+        print(f"{name:>14}: {seconds * 1e6:9.1f} us/step ({results['loop'] / seconds:5.1f}x)")
+    print("PrefetchLoader: " + ", ".join(f"{k}={v:.3f}" for k, v in loader_stats.items()))
+
+
+if __name__ == "__main__":
+    typer.run(bench)
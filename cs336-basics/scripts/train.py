@@ -40,7 +40,7 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 from tqdm import tqdm, trange
 
 import wandb
-from cs336_basics.data import get_batch
+from cs336_basics.data import BatchSampler, PrefetchLoader
 from cs336_basics.model import BasicsTransformerLM
 from cs336_basics.optimizer import get_cosine_lr
 from cs336_basics.train_config import Config, register_configs
@@ -171,88 +171,89 @@ def main(cfg: Config) -> None:
         fused=True,
     )
 
-    # Get the first batch
-    batch_x, batch_y = get_batch(
-        train_data,
-        batch_size=cfg.training.train_batch_size,
-        context_length=cfg.model.context_length,
-        device=cfg.training.device,
-    )
-    for i in (pbar := trange(cfg.training.train_steps, desc="Training", disable=not is_master_process)):
-        lr = get_cosine_lr(
-            i,
-            max_learning_rate=cfg.training.lr,
-            min_learning_rate=cfg.training.lr * 0.1,
-            warmup_iters=int(cfg.training.train_steps * cfg.training.warmup_ratio),
-            cosine_cycle_iters=cfg.training.train_steps,
-        )
-        for param_group in optimizer.param_groups:
-            param_group["lr"] = lr
+    # Samples and copies batches to the device in background threads; x and y are views of one
+    # (batch_size, context_length + 1) tensor
+    with PrefetchLoader(
+            train_data,
+            batch_size=cfg.training.train_batch_size,
+            context_length=cfg.model.context_length,
+            device=cfg.training.device,
+            num_workers=cfg.training.data_workers,
+            prefetch_depth=cfg.training.prefetch_depth,
+    ) as train_loader:
+        # Get the first batch
+        batch_x, batch_y = next(train_loader)
+        for i in (pbar := trange(cfg.training.train_steps, desc="Training", disable=not is_master_process)):
+            lr = get_cosine_lr(
+                i,
+                max_learning_rate=cfg.training.lr,
+                min_learning_rate=cfg.training.lr * 0.1,
+                warmup_iters=int(cfg.training.train_steps * cfg.training.warmup_ratio),
+                cosine_cycle_iters=cfg.training.train_steps,
+            )
+            for param_group in optimizer.param_groups:
+                param_group["lr"] = lr
 
-        for micro_step_idx in range(cfg.training.gradient_accumulation_steps):
-            if is_ddp:
-                # When using DDP, don't all-reduce gradients until the last step.
-                model.require_backward_grad_sync = micro_step_idx == cfg.training.gradient_accumulation_steps - 1
+            for micro_step_idx in range(cfg.training.gradient_accumulation_steps):
+                if is_ddp:
+                    # When using DDP, don't all-reduce gradients until the last step.
+                    model.require_backward_grad_sync = micro_step_idx == cfg.training.gradient_accumulation_steps - 1
 
-            with amp_ctx:
-                logits = model(batch_x)
+                with amp_ctx:
+                    logits = model(batch_x)
 
-                # immediately async prefetch next batch while model is doing the forward pass on the GPU
-                next_batch_x, next_batch_y = get_batch(
-                    train_data,
-                    batch_size=cfg.training.train_batch_size,
-                    context_length=cfg.model.context_length,
-                    device=cfg.training.device,
-                )
+                    # take the next batch from the prefetch queue while the model is doing the forward pass on the GPU
+                    next_batch_x, next_batch_y = next(train_loader)
 
-                # Calculate the loss with the logits
-                loss = (
-                    F.cross_entropy(logits.view(-1, logits.size(-1)), batch_y.view(-1))
-                    / cfg.training.gradient_accumulation_steps
-                )
+                    # Calculate the loss with the logits
+                    loss = (
+                        F.cross_entropy(logits.view(-1, logits.size(-1)), batch_y.reshape(-1))
+                        / cfg.training.gradient_accumulation_steps
+                    )
 
-            loss.backward()
+                loss.backward()
 
-            batch_x = next_batch_x
-            batch_y = next_batch_y
+                batch_x = next_batch_x
+                batch_y = next_batch_y
 
-        if cfg.training.max_grad_norm is not None:
-            torch.nn.utils.clip_grad_norm_(model.parameters(), cfg.training.max_grad_norm)
+            if cfg.training.max_grad_norm is not None:
+                torch.nn.utils.clip_grad_norm_(model.parameters(), cfg.training.max_grad_norm)
 
-        optimizer.step()
-        optimizer.zero_grad(set_to_none=True)
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
 
-        loss_float = loss.item() * cfg.training.gradient_accumulation_steps
+            loss_float = loss.item() * cfg.training.gradient_accumulation_steps
 
-        if is_master_process:
-            pbar.set_description(f"Training step {i}, Loss: {loss_float:.4f}")
-            if cfg.training.wandb_project and i % cfg.training.log_interval == 0:
-                wandb.log({"train_loss": loss_float, "lr": lr}, step=i)
-
-        if i != 0 and i % cfg.training.eval_interval == 0 and is_master_process:
-            dev_loss = estimate_dev_loss(
-                model=model,
-                dev_dataset=dev_data,
-                batch_size=cfg.training.eval_batch_size,
-                eval_iters=cfg.training.eval_iterations,
-                device=cfg.training.device,
-                context_length=cfg.model.context_length,
-            )
-            logger.info(f"Estimated validation loss: {dev_loss}")
-            if cfg.training.wandb_project:
-                wandb.log({"eval_loss": dev_loss}, step=i)
+            if is_master_process:
+                pbar.set_description(f"Training step {i}, Loss: {loss_float:.4f}")
+                if cfg.training.wandb_project and i % cfg.training.log_interval == 0:
+                    data_stats = {f"data/{k}": v for k, v in train_loader.stats().items()}
+                    wandb.log({"train_loss": loss_float, "lr": lr, **data_stats}, step=i)
+
+            if i != 0 and i % cfg.training.eval_interval == 0 and is_master_process:
+                dev_loss = estimate_dev_loss(
+                    model=model,
+                    dev_dataset=dev_data,
+                    batch_size=cfg.training.eval_batch_size,
+                    eval_iters=cfg.training.eval_iterations,
+                    device=cfg.training.device,
+                    context_length=cfg.model.context_length,
+                )
+                logger.info(f"Estimated validation loss: {dev_loss}")
+                if cfg.training.wandb_project:
+                    wandb.log({"eval_loss": dev_loss}, step=i)
 
-            if cfg.training.save_checkpoints:
-                model_weights_output_path = cfg.paths.model_output / f"step_{i:010d}" / "model.pt"
-                model_weights_output_path.parent.mkdir(parents=True, exist_ok=True)
+                if cfg.training.save_checkpoints:
+                    model_weights_output_path = cfg.paths.model_output / f"step_{i:010d}" / "model.pt"
+                    model_weights_output_path.parent.mkdir(parents=True, exist_ok=True)
 
-                # Need both config and weights to load the model
-                # Write config:
-                with open(model_weights_output_path.parent / "model_config.json", "w") as f:
-                    json.dump(model_config, f, indent=4)
+                    # Need both config and weights to load the model
+                    # Write config:
+                    with open(model_weights_output_path.parent / "model_config.json", "w") as f:
+                        json.dump(model_config, f, indent=4)
 
-                # Write weights:
-                torch.save(model.state_dict(), model_weights_output_path)
+                    # Write weights:
+                    torch.save(model.state_dict(), model_weights_output_path)
 
     # Calculate final estimated dev loss
     if is_master_process:
@@ -288,15 +289,11 @@ def estimate_dev_loss(
 ):
     model.eval()
     losses = torch.zeros(eval_iters, device=device)
+    dev_sampler = BatchSampler(dev_dataset, batch_size=batch_size, context_length=context_length, device=device)
     for k in tqdm(range(eval_iters)):
-        batch_x, batch_y = get_batch(
-            dev_dataset,
-            batch_size=batch_size,
-            context_length=context_length,
-            device=device,
-        )
+        batch_x, batch_y = dev_sampler.sample()
         logits = model(batch_x)
-        loss = F.cross_entropy(logits.view(-1, logits.size(-1)), batch_y.view(-1))
+        loss = F.cross_entropy(logits.view(-1, logits.size(-1)), batch_y.reshape(-1))
         losses[k] = loss.item()
 
     model.train()
@@ -0,0 +1,163 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+import torch
+
+from cs336_basics.data import BatchSampler, PrefetchLoader, get_batch
+
+
+@pytest.fixture
+def dataset():
+    # Token i has value i, so every target is its input plus one
+    return np.arange(10_000, dtype=np.uint16)
+
+
+def test_batch_sampler_targets_are_shifted_inputs(dataset):
+    sampler = BatchSampler(dataset, batch_size=8, context_length=16, device="cpu")
+    for _ in range(5):
+        x, y = sampler.sample()
+        assert x.shape == y.shape == (8, 16)
+        assert x.dtype == y.dtype == torch.int64
+        assert torch.equal(y, x + 1)
+        assert torch.equal(x[:, 1:], y[:, :-1])
+
+
+def test_batch_sampler_matches_get_batch(dataset):
+    """With the same seed, BatchSampler draws exactly the batches get_batch would."""
+    torch.manual_seed(0)
+    expected = [get_batch(dataset, 8, 16, "cpu") for _ in range(3)]
+    torch.manual_seed(0)
+    sampler = BatchSampler(dataset, batch_size=8, context_length=16, device="cpu")
+    for x_ref, y_ref in expected:
+        x, y = sampler.sample()
+        assert torch.equal(x, x_ref)
+        assert torch.equal(y, y_ref)
+
+
+@pytest.mark.parametrize("num_buffers", [2, 3])
+def test_batch_sampler_buffer_reuse(dataset, num_buffers):
+    """
+    A batch stays valid for num_buffers - 1 further calls: rotating through the other host slots
+    must not overwrite the one the caller still holds.
+    """
+    torch.manual_seed(0)
+    sampler = BatchSampler(dataset, batch_size=8, context_length=16, device="cpu", num_buffers=num_buffers)
+    x, y = sampler.sample()
+    x_copy, y_copy = x.clone(), y.clone()
+    later = [sampler.sample() for _ in range(num_buffers - 1)]
+    assert torch.equal(x, x_copy)
+    assert torch.equal(y, y_copy)
+    assert all(not torch.equal(x_later, x_copy) for x_later, _ in later)
+
+    # The next call reuses the first slot
+    sampler.sample()
+    assert not torch.equal(x, x_copy)
+
+
+def test_batch_sampler_short_dataset():
+    with pytest.raises(ValueError):
+        BatchSampler(np.arange(16, dtype=np.uint16), batch_size=2, context_length=16, device="cpu")
+
+
+def worker_threads():
+    return [thread for thread in threading.enumerate() if thread.name.startswith("PrefetchLoader-")]
+
+
+def wait_until_full(loader, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not loader._queue.full():
+        assert time.monotonic() < deadline, "prefetch queue never filled"
+        time.sleep(0.01)
+
+
+def close_within(close, timeout=5.0):
+    # Run close() on another thread so a worker that never unblocks fails the test instead of hanging it
+    closer = threading.Thread(target=close, daemon=True)
+    closer.start()
+    closer.join(timeout)
+    assert not closer.is_alive(), "close() did not return"
+
+
+@pytest.mark.parametrize("num_workers", [0, 1])
+def test_prefetch_loader_batches(dataset, num_workers):
+    """
+    With at most one worker the batch sequence is fixed by torch.manual_seed, and it is the same
+    whether batches are sampled on the calling thread (num_workers=0) or in a background thread.
+    """
+    torch.manual_seed(0)
+    sampler = BatchSampler(
+        dataset, 8, 16, "cpu", generator=torch.Generator().manual_seed(int(torch.randint(2**62, ())))
+    )
+    expected = [tuple(t.clone() for t in sampler.sample()) for _ in range(5)]
+
+    torch.manual_seed(0)
+    with PrefetchLoader(dataset, 8, 16, "cpu", num_workers=num_workers, prefetch_depth=2) as loader:
+        assert len(worker_threads()) == num_workers
+        for x_ref, y_ref in expected:
+            x, y = next(loader)
+            assert torch.equal(x, x_ref)
+            assert torch.equal(y, y_ref)
+            assert torch.equal(y, x + 1)
+    assert worker_threads() == []
+
+
+def test_prefetch_loader_worker_error(dataset, monkeypatch):
+    """An exception in a worker is re-raised by next() in the consumer, and the loader shuts down."""
+
+    def fail(self):
+        raise OSError("page fault")
+
+    monkeypatch.setattr(BatchSampler, "sample", fail)
+    loader = PrefetchLoader(dataset, 8, 16, "cpu", num_workers=2)
+    with pytest.raises(RuntimeError) as excinfo:
+        next(loader)
+    assert isinstance(excinfo.value.__cause__, OSError)
+    assert worker_threads() == []
+
+
+def test_prefetch_loader_close_unblocks_workers(dataset):
+    """close() and leaving the with block stop workers that are blocked on a full queue."""
+    loader = PrefetchLoader(dataset, 8, 16, "cpu", num_workers=2, prefetch_depth=1)
+    wait_until_full(loader)
+    close_within(loader.close)
+    assert worker_threads() == []
+
+    def use_and_leave():
+        with PrefetchLoader(dataset, 8, 16, "cpu", num_workers=2, prefetch_depth=1) as loader:
+            wait_until_full(loader)
+
+    close_within(use_and_leave)
+    assert worker_threads() == []
+
+
+def test_prefetch_loader_stats(dataset, monkeypatch):
+    """
+    stats() averages over the batches since the last call: a full queue gives no starvation and
+    the full depth, an empty one counts as starved and as time spent waiting.
+    """
+    with PrefetchLoader(dataset, 8, 16, "cpu", num_workers=1, prefetch_depth=3) as loader:
+        wait_until_full(loader)
+        next(loader)
+        stats = loader.stats()
+        assert stats["starved_frac"] == 0.0
+        assert stats["queue_depth"] == 3.0
+        assert stats["wait_ms"] >= 0.0
+        # Reset by the previous call
+        assert loader.stats() == {"wait_ms": 0.0, "starved_frac": 0.0, "queue_depth": 0.0}
+
+    sample = BatchSampler.sample
+
+    def slow_sample(self):
+        time.sleep(0.05)
+        return sample(self)
+
+    monkeypatch.setattr(BatchSampler, "sample", slow_sample)
+    with PrefetchLoader(dataset, 8, 16, "cpu", num_workers=1, prefetch_depth=3) as loader:
+        next(loader)
+        stats = loader.stats(reset=False)
+        assert stats["starved_frac"] == 1.0
+        assert stats["queue_depth"] == 0.0
+        assert stats["wait_ms"] > 10.0
+        assert loader.stats() == stats
@@ -1,43 +1,516 @@
-from collections import Counter
 import os 
-import hashlib
+import json
+import shutil
+import tempfile
+import itertools
+import resource
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+import mmh3
+import numpy as np
+from xopen import xopen
+
+# 行哈希：mmh3 128 位结果的低 64 位。非密码学哈希，比 md5 hexdigest 快，而且只占 8 字节。
+# 1 亿个不同的行发生一次碰撞的概率约 3e-4，碰撞的后果只是多删掉一行。
+def hash_line(line):
+    return mmh3.hash64(line, signed=False)[0]
+
+class LineHashCounter:
+    """按 64 位行哈希计数，只区分出现 1 次和 2 次及以上。
+
+    已合并的部分是排好序的 uint64 键加上 uint8 计数（饱和在 2），每个不同的行 9 字节；
+    Counter 加 md5 hexdigest 字符串要 150 字节以上。新的哈希先放进缓冲区，满了排序去重后作为一段有序的
+    run 挂起，挂起的键数超过已合并部分的 merge_ratio 倍时才和已合并部分一起归并。已合并部分按几何级数
+    增长，每个键只会被归并 O(log n) 次，不会因为每次 flush 都重写整个数组而变成平方复杂度。
+    """
+
+    def __init__(self, buffer_size=1 << 20, merge_ratio=1.0):
+        self._keys = np.empty(0, dtype=np.uint64)
+        self._counts = np.empty(0, dtype=np.uint8)
+        self.buffer_size = buffer_size
+        self.merge_ratio = merge_ratio
+        self._buffer = array('Q')
+        # 挂起的有序 run：[(keys, counts)]
+        self._runs = []
+        self._run_size = 0
+        self.peak_bytes = 0
+
+    def __len__(self):
+        self.flush()
+        return len(self._keys)
+
+    # 读 keys / counts 之前先把缓冲区和挂起的 run 都合并进来
+    @property
+    def keys(self):
+        self.flush()
+        return self._keys
+
+    @property
+    def counts(self):
+        self.flush()
+        return self._counts
+
+    def add(self, line_hash):
+        self._buffer.append(line_hash)
+        if len(self._buffer) >= self.buffer_size:
+            self._spill()
+
+    def add_many(self, hashes):
+        self._buffer.frombytes(np.asarray(hashes, dtype=np.uint64).tobytes())
+        if len(self._buffer) >= self.buffer_size:
+            self._spill()
+
+    # 缓冲区排序去重，变成一段 run
+    def _spill(self):
+        if not self._buffer:
+            return
+        new_keys, new_counts = np.unique(np.frombuffer(self._buffer, dtype=np.uint64), return_counts=True)
+        buffer_bytes = self._buffer.itemsize * len(self._buffer)
+        self._buffer = array('Q')
+        self.merge(new_keys, new_counts, buffer_bytes)
+
+    def flush(self):
+        self._spill()
+        self._compact()
+
+    # 加入一组有序、不重复的键和它们的计数
+    def merge(self, new_keys, new_counts, extra_bytes=0):
+        self._runs.append((np.asarray(new_keys, dtype=np.uint64),
+                           np.minimum(new_counts, 2).astype(np.uint8)))
+        self._run_size += len(new_keys)
+        self.peak_bytes = max(self.peak_bytes, self.nbytes + extra_bytes)
+        if self._run_size >= self.merge_ratio * len(self._keys):
+            self._compact(extra_bytes)
+
+    # 把已合并部分和所有挂起的 run 一次归并：拼接后稳定排序，相同的键计数相加（饱和在 2）
+    def _compact(self, extra_bytes=0):
+        if not self._runs:
+            return
+        keys = np.concatenate([self._keys] + [k for k, _ in self._runs])
+        counts = np.concatenate([self._counts] + [c for _, c in self._runs])
+        order = np.argsort(keys, kind='stable')
+        # 归并时旧数组、拼接的数组和排序下标同时存在
+        self.peak_bytes = max(self.peak_bytes, self.nbytes + keys.nbytes + counts.nbytes + order.nbytes
+                              + extra_bytes)
+        self._runs, self._run_size = [], 0
+        keys, counts = keys[order], counts[order]
+        del order
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        self._counts = np.minimum(np.add.reduceat(counts, starts, dtype=np.uint32), 2).astype(np.uint8)
+        self._keys = keys[starts]
+
+    # 返回每个哈希的计数（0、1 或 2，2 表示至少 2 次）
+    def count(self, hashes):
+        self.flush()
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        pos = np.searchsorted(self._keys, hashes)
+        pos[pos == len(self._keys)] = 0
+        out = np.zeros(len(hashes), dtype=np.uint8)
+        if len(self._keys):
+            hit = self._keys[pos] == hashes
+            out[hit] = self._counts[pos[hit]]
+        return out
+
+    # 出现 2 次及以上的哈希，已排序
+    def duplicates(self):
+        self.flush()
+        return self._keys[self._counts > 1]
+
+    @property
+    def nbytes(self):
+        return (self._keys.nbytes + self._counts.nbytes
+                + sum(k.nbytes + c.nbytes for k, c in self._runs) + self._buffer.itemsize * len(self._buffer))
+
+# 第二遍按块读取，整块一起查表
+LINE_BLOCK = 1 << 16
+
+# 按块读取文件，返回 (原始行, strip 后的行, 行哈希数组)
+def read_line_blocks(f):
+    while True:
+        lines = list(itertools.islice(f, LINE_BLOCK))
+        if not lines:
+            break
+        contents = [line.strip() for line in lines]
+        hashes = np.fromiter((hash_line(c) for c in contents), dtype=np.uint64, count=len(contents))
+        yield lines, contents, hashes
+
+# 第二遍：is_duplicate(hashes) 返回布尔数组，重复的行和空行不写
+def write_unique_lines(file, new_file, is_duplicate):
+    with open(file, 'r', encoding='utf-8', errors='replace') as f_in, \
+        open (new_file, 'w', encoding='utf-8') as f_out:
+        for lines, contents, hashes in read_line_blocks(f_in):
+            duplicated = is_duplicate(hashes)
+            for line, line_content, dup in zip(lines, contents, duplicated):
+                if not line_content: 
+                    # 空行跳过
+                    continue 
+                if dup: continue
+                f_out.write(line)
+
+# ---- 多文档分片 ----
+# pipeline.py 的输出是每个分片里很多篇文档。record_format 是 RECORD_FORMATS 里的名字或者一对
+# (reader, writer)：reader 是 path -> 逐篇文档的函数，writer(f_out, text) 写出一篇文档。给了它各个去重入口
+# 就按文档去重，并用同一个格式写出同名的分片，输出和输入的格式总是一致，不需要先把分片拆成大量小文件。
+# 压缩格式由 xopen 按扩展名判断。
+RecordFormat = namedtuple('RecordFormat', ['read', 'write'])
+# 按文档读的时候每块的文档数
+RECORD_BLOCK = 1024
+
+def open_shard(path, mode='rt'):
+    if 'r' in mode:
+        return xopen(path, mode, encoding='utf-8', errors='replace')
+    return xopen(path, mode, encoding='utf-8')
+
+# 每行一个 {"text": ...}，pipeline 的输出格式。文档里的空行和换行都在 JSON 字符串里，不会被当成分隔
+def jsonl_records(path):
+    with open_shard(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)['text']
+
+def write_jsonl_record(f_out, text):
+    f_out.write(json.dumps({'text': text}, ensure_ascii=False) + '\n')
+
+# 空行分隔的纯文本。只适合内部没有空行的文档，否则每个段落都会被当成一篇文档
+def blank_line_records(path):
+    lines = []
+    with open_shard(path) as f:
+        for line in f:
+            if line.strip():
+                lines.append(line)
+            elif lines:
+                yield ''.join(lines).rstrip('\n')
+                lines = []
+    if lines:
+        yield ''.join(lines).rstrip('\n')
+
+def write_blank_line_record(f_out, text):
+    f_out.write(text + '\n\n')
+
+# 整个文件是一篇文档
+def file_records(path):
+    with open_shard(path) as f:
+        yield f.read()
+
+def write_file_record(f_out, text):
+    f_out.write(text)
+
+RECORD_FORMATS = {
+    'jsonl': RecordFormat(jsonl_records, write_jsonl_record),
+    'blank_line': RecordFormat(blank_line_records, write_blank_line_record),
+    'file': RecordFormat(file_records, write_file_record),
+}
+
+def get_record_format(record_format):
+    if record_format is None or isinstance(record_format, RecordFormat):
+        return record_format
+    if isinstance(record_format, tuple):
+        return RecordFormat(*record_format)
+    if record_format not in RECORD_FORMATS:
+        raise ValueError(f"未知的 record_format: {record_format}，可选 {list(RECORD_FORMATS)}")
+    return RECORD_FORMATS[record_format]
+
+def record_blocks(file, record_format):
+    records = record_format.read(file)
+    return iter(lambda: list(itertools.islice(records, RECORD_BLOCK)), [])
+
+# 第一遍用：逐块返回一个文件（或分片里所有文档）的行哈希
+def line_hash_blocks(file, record_format=None):
+    if record_format is None:
+        with open(file, 'r', encoding='utf-8', errors='replace') as f:
+            for _, _, hashes in read_line_blocks(f):
+                yield hashes
+        return
+    for records in record_blocks(file, record_format):
+        contents = [line.strip() for record in records for line in record.split('\n')]
+        yield np.fromiter((hash_line(c) for c in contents), dtype=np.uint64, count=len(contents))
+
+# 按文档的第二遍：每篇文档去掉重复的行和空行，剩下的行还是一篇文档，一行都不剩的文档不写
+def write_unique_record_lines(file, new_file, is_duplicate, record_format):
+    with open_shard(new_file, 'wt') as f_out:
+        for records in record_blocks(file, record_format):
+            lines = [record.split('\n') for record in records]
+            contents = [line.strip() for record_lines in lines for line in record_lines]
+            hashes = np.fromiter((hash_line(c) for c in contents), dtype=np.uint64, count=len(contents))
+            duplicated = is_duplicate(hashes)
+            pos = 0
+            for record_lines in lines:
+                end = pos + len(record_lines)
+                kept = [line for line, content, dup in zip(record_lines, contents[pos:end], duplicated[pos:end])
+                        if content and not dup]
+                pos = end
+                if kept:
+                    record_format.write(f_out, '\n'.join(kept))
+
+def rewrite_unique_lines(file, new_file, is_duplicate, record_format=None):
+    if record_format is None:
+        write_unique_lines(file, new_file, is_duplicate)
+    else:
+        write_unique_record_lines(file, new_file, is_duplicate, record_format)
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
 
 # uv run pytest -k test_exact_line_deduplication
-def exact_line_deduplication(input_files, output_path):
-    line_counts = Counter() # 相同的line只能出现一次
+def exact_line_deduplication(input_files, output_path, buffer_size=1 << 20, num_workers=1, num_partitions=64,
+                             tmp_dir=None, record_format=None):
+    """num_workers > 1 时走多进程、按哈希分区落盘的外存版本，结果相同。
+    给了 record_format 时输入是多文档分片，按文档去掉重复行后写出同名分片"""
+    record_format = get_record_format(record_format)
+    if num_workers > 1:
+        return parallel_exact_line_deduplication(input_files, output_path, num_workers, num_partitions,
+                                                 buffer_size, tmp_dir, record_format)
+    line_counts = LineHashCounter(buffer_size) # 相同的line只能出现一次
     os.makedirs(output_path, exist_ok=True)
     print("Pass 1: Counting lines...")
     for file in input_files:
         try:
-            with open(file, 'r', encoding='utf-8', errors='replace') as f:
-                for line in f:
-                    line_hash = hashlib.md5(line.strip().encode('utf-8')).hexdigest()
-                    line_counts[line_hash] += 1
+            for hashes in line_hash_blocks(file, record_format):
+                line_counts.add_many(hashes)
         except Exception as e:
             print(f'Erro reading {file} {e}')
+    line_counts.flush()
+    print(f"行哈希表: {len(line_counts)} 个不同的行, {line_counts.nbytes / 2**20:.1f} MB "
+          f"(合并时峰值 {line_counts.peak_bytes / 2**20:.1f} MB), 进程峰值 RSS {peak_rss_mb():.0f} MB")
     print("Pass 2: Filtering and writing...")
     for file in input_files:
         file_name = os.path.basename(file)
         new_file = os.path.join(output_path, file_name)
         try:
-            with open(file, 'r', encoding='utf-8', errors='replace') as f_in, \
-                open (new_file, 'w', encoding='utf-8') as f_out:
-                for line in f_in:
-                    line_content = line.strip()
-                    if not line_content: 
-                        # 空行跳过
-                        continue 
-                    line_hash = hashlib.md5(line_content.encode('utf-8')).hexdigest()
-                    if line_counts[line_hash] > 1: continue
-                    f_out.write(line)
+            rewrite_unique_lines(file, new_file, lambda hashes: line_counts.count(hashes) > 1, record_format)
         except Exception as e:
             print(f'Error writing {file} {e}')
     print('Finished !')
 
+
+# ---- 跨快照的增量去重 ----
+# LineHashIndex 是磁盘上的一个目录，保存历史上所有行哈希的计数（饱和在 2）。
+# 每次增量去重只读新数据：新数据的计数和历史计数相加后判断重复，再把新数据的计数作为一个新的段写进索引。
+# 段是有序的 keys/counts 两个 .npy，用 mmap 打开，查询时把各段的计数加起来；段多了以后用 compact() 合并成一个。
+
+INDEX_META = 'index.json'
+
+class LineHashIndex:
+    """可 mmap 的持久化行哈希索引，由若干有序段组成。"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, INDEX_META)
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {'segments': [], 'sources': []}
+        self.segments = [self._open_segment(name) for name in self.meta['segments']]
+
+    def _open_segment(self, name):
+        keys = np.load(os.path.join(self.path, f'{name}.keys.npy'), mmap_mode='r')
+        counts = np.load(os.path.join(self.path, f'{name}.counts.npy'), mmap_mode='r')
+        return keys, counts
+
+    def __len__(self):
+        """各段键数之和；段之间可能有相同的键，compact 之后才是不同的行数"""
+        return sum(len(keys) for keys, _ in self.segments)
+
+    @property
+    def sources(self):
+        return self.meta['sources']
+
+    # 返回每个哈希在历史中的计数（0、1 或 2）
+    def count(self, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        out = np.zeros(len(hashes), dtype=np.uint8)
+        for keys, counts in self.segments:
+            if len(keys) == 0:
+                continue
+            pos = np.searchsorted(keys, hashes)
+            pos[pos == len(keys)] = 0
+            hit = keys[pos] == hashes
+            out[hit] = np.minimum(out[hit] + counts[pos[hit]], 2)
+        return out
+
+    def _save_meta(self):
+        meta_path = os.path.join(self.path, INDEX_META)
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f, ensure_ascii=False, indent=2)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def _write_segment(self, keys, counts):
+        seq = self.meta.get('next_segment', 0)
+        self.meta['next_segment'] = seq + 1
+        name = f'seg-{seq:05d}'
+        for suffix, values in (('keys', keys), ('counts', counts)):
+            out = os.path.join(self.path, f'{name}.{suffix}.npy')
+            with open(out + '.tmp', 'wb') as f:
+                np.save(f, values)
+            os.replace(out + '.tmp', out)
+        return name
+
+    # 把一个 LineHashCounter 的计数作为新段加进索引；meta 最后原子替换，中途失败不影响已有索引
+    def add(self, counter, sources=()):
+        counter.flush()
+        name = self._write_segment(counter.keys, counter.counts)
+        self.meta['segments'].append(name)
+        self.meta['sources'].extend(os.path.basename(s) for s in sources)
+        self._save_meta()
+        self.segments.append(self._open_segment(name))
+
+    # 把所有段合并成一个。需要把所有段读进内存，适合在两次增量之间离线做
+    def compact(self):
+        if len(self.segments) <= 1:
+            return
+        merged = LineHashCounter()
+        for keys, counts in self.segments:
+            merged.merge(np.asarray(keys), np.asarray(counts))
+        old = self.meta['segments']
+        name = self._write_segment(merged.keys, merged.counts)
+        self.meta['segments'] = [name]
+        self._save_meta()
+        self.segments = [self._open_segment(name)]
+        for seg in old:
+            for suffix in ('keys', 'counts'):
+                os.remove(os.path.join(self.path, f'{seg}.{suffix}.npy'))
+
+
+# 用历史索引对一批新文件做行去重：只读新文件，新文件里的行只要在历史加上这批数据中出现 2 次及以上就删掉。
+# 历史文件已经发布，不会回头修改。update_index=False 时只查询不写入。
+def incremental_line_deduplication(input_files, output_path, index_path, buffer_size=1 << 20, update_index=True,
+                                   record_format=None):
+    record_format = get_record_format(record_format)
+    index = LineHashIndex(index_path)
+    os.makedirs(output_path, exist_ok=True)
+    print(f"Pass 1: Counting lines of {len(input_files)} new files (index: {len(index.sources)} files, "
+          f"{len(index.segments)} segments)...")
+    new_counts = LineHashCounter(buffer_size)
+    for file in input_files:
+        try:
+            for hashes in line_hash_blocks(file, record_format):
+                new_counts.add_many(hashes)
+        except Exception as e:
+            print(f'Erro reading {file} {e}')
+    new_counts.flush()
+    print("Pass 2: Filtering and writing...")
+    for file in input_files:
+        new_file = os.path.join(output_path, os.path.basename(file))
+        try:
+            rewrite_unique_lines(file, new_file, lambda hashes: new_counts.count(hashes) + index.count(hashes) > 1,
+                                 record_format)
+        except Exception as e:
+            print(f'Error writing {file} {e}')
+    if update_index:
+        index.add(new_counts, input_files)
+    print('Finished !')
+    return index
+
+
+# ---- 多进程外存版本 ----
+# 1. 每个 worker 处理一个输入文件，把行哈希按取值区间写进 num_partitions 个分区文件；
+# 2. 每个 worker 处理一个分区，只需要这个分区的哈希表，找出出现 2 次及以上的哈希；
+# 3. 分区是连续的哈希区间，各分区的重复集合按顺序拼起来就是有序的，存成一个 .npy，
+#    第二遍的 worker 用 mmap 共享读取，按块查表重写各自的文件。
+# 内存上限由分区大小决定，分区数随语料规模调大即可。
+
+# 把哈希映射到 [0, num_partitions)，单调不减，所以每个分区是一段连续的哈希区间
+def hash_partition(hashes, num_partitions):
+    return ((hashes >> np.uint64(32)) * np.uint64(num_partitions)) >> np.uint64(32)
+
+def partition_dir(spill_dir, part):
+    return os.path.join(spill_dir, f'part-{part:04d}')
+
+def spill_line_hashes(args):
+    file_idx, file, spill_dir, num_partitions, record_format = args
+    outputs = {}
+    num_lines = 0
+    try:
+        for hashes in line_hash_blocks(file, record_format):
+            num_lines += len(hashes)
+            parts = hash_partition(hashes, num_partitions)
+            order = np.argsort(parts, kind='stable')
+            parts, hashes = parts[order], hashes[order]
+            bounds = np.searchsorted(parts, np.arange(num_partitions + 1, dtype=np.uint64))
+            for part in np.flatnonzero(np.diff(bounds)):
+                out = outputs.get(part)
+                if out is None:
+                    out = outputs[part] = open(os.path.join(partition_dir(spill_dir, part), f'{file_idx:06d}.u64'), 'wb')
+                hashes[bounds[part]:bounds[part + 1]].tofile(out)
+    except Exception as e:
+        print(f'Erro reading {file} {e}')
+    finally:
+        for out in outputs.values():
+            out.close()
+    return num_lines
+
+# 统计一个分区，返回 (重复哈希, 不同的行数, 哈希表峰值字节数)
+def count_partition(args):
+    part_path, buffer_size = args
+    counter = LineHashCounter(buffer_size)
+    for name in sorted(os.listdir(part_path)):
+        path = os.path.join(part_path, name)
+        # 分区文件也按块读，避免一次读进整个文件
+        with open(path, 'rb') as f:
+            while True:
+                hashes = np.fromfile(f, dtype=np.uint64, count=buffer_size)
+                if len(hashes) == 0:
+                    break
+                counter.add_many(hashes)
+        os.remove(path)
+    dups = counter.duplicates()
+    return dups, len(counter), max(counter.peak_bytes, counter.nbytes)
+
+def rewrite_with_duplicates(args):
+    file, new_file, dups_path, record_format = args
+    dups = np.load(dups_path, mmap_mode='r')
+
+    def is_duplicate(hashes):
+        if len(dups) == 0:
+            return np.zeros(len(hashes), dtype=bool)
+        pos = np.searchsorted(dups, hashes)
+        pos[pos == len(dups)] = 0
+        return dups[pos] == hashes
+
+    try:
+        rewrite_unique_lines(file, new_file, is_duplicate, record_format)
+    except Exception as e:
+        print(f'Error writing {file} {e}')
+    return peak_rss_mb()
+
+def parallel_exact_line_deduplication(input_files, output_path, num_workers=4, num_partitions=64,
+                                      buffer_size=1 << 20, tmp_dir=None, record_format=None):
+    os.makedirs(output_path, exist_ok=True)
+    spill_dir = tempfile.mkdtemp(prefix='line-dedup-', dir=tmp_dir)
+    try:
+        for part in range(num_partitions):
+            os.makedirs(partition_dir(spill_dir, part))
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            print(f"Pass 1: Hashing lines into {num_partitions} partitions with {num_workers} workers...")
+            tasks = [(i, file, spill_dir, num_partitions, record_format) for i, file in enumerate(input_files)]
+            num_lines = sum(executor.map(spill_line_hashes, tasks))
+
+            print("Counting partitions...")
+            tasks = [(partition_dir(spill_dir, part), buffer_size) for part in range(num_partitions)]
+            results = list(executor.map(count_partition, tasks))
+            dups = np.concatenate([r[0] for r in results]) if results else np.empty(0, dtype=np.uint64)
+            num_distinct = sum(r[1] for r in results)
+            dups_path = os.path.join(spill_dir, 'duplicates.npy')
+            np.save(dups_path, dups)
+            print(f"{num_lines} 行, {num_distinct} 个不同的行, {len(dups)} 个重复的行 "
+                  f"({dups.nbytes / 2**20:.1f} MB); 最大分区哈希表 {max((r[2] for r in results), default=0) / 2**20:.1f} MB")
+            del dups, results
+
+            print("Pass 2: Filtering and writing...")
+            tasks = [(file, os.path.join(output_path, os.path.basename(file)), dups_path, record_format)
+                     for file in input_files]
+            peak = max(executor.map(rewrite_with_duplicates, tasks), default=0)
+            print(f"worker 进程峰值 RSS {peak:.0f} MB")
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    print('Finished !')
+
 import re
 import unicodedata
-import numpy as np
-from collections import defaultdict
+from functools import lru_cache
 
 # Step 1. Normalize
 def normalize(text):
@@ -63,7 +536,526 @@ def jaccard_similarity(set_a, set_b):
     union = len(set_a.union(set_b))
     return intersection / union
 
+# 读取一个文档，和写出时用同样的解码方式
+def read_document(path):
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        return f.read()
+
+def document_ngrams(path, ngrams):
+    return get_ngrams(normalize(read_document(path)), ngrams)
+
+# ---- MinHash 签名 ----
+# n-gram 用带种子的 mmh3 64 位哈希（Python 的 hash() 每个解释器随机，签名没法跨进程、跨任务比较），
+# 再用 (a*x + b) mod p 生成 num_hashes 个哈希，p = 2^61 - 1。uint64 直接算 a*x 会溢出，
+# 这里把乘数拆成 32 位的两半，利用 2^61 ≡ 1 (mod p) 分段约简，结果和大整数运算完全一致，
+# 所以签名在不同的运行、进程和机器上逐位相同，可以缓存和跨任务比较。
+MERSENNE_PRIME = (1 << 61) - 1
+NGRAM_HASH_SEED = 42
+EMPTY_SIGNATURE = np.uint64(2**64 - 1)
+_P = np.uint64(MERSENNE_PRIME)
+_MASK32 = np.uint64(0xFFFFFFFF)
+_MASK29 = np.uint64((1 << 29) - 1)
+
+def make_hash_params(num_hashes, seed=42):
+    # 和原来 np.random.seed(42) 之后的 randint 是同一个序列
+    return np.random.RandomState(seed).randint(1, MERSENNE_PRIME, size=(num_hashes, 2), dtype=np.uint64)
+
+# x mod p，x 是任意 uint64
+def mod_mersenne61(x):
+    x = (x & _P) + (x >> np.uint64(61))
+    return np.where(x >= _P, x - _P, x)
+
+# (a * x) mod p，a、x 都小于 p，按元素广播
+def mulmod_mersenne61(a, x):
+    return hashmod_mersenne61(a, np.uint64(0), x)
+
+# (a * x + b) mod p，a、b、x 都小于 p。
+# a*x = hh*2^64 + mid*2^32 + ll，其中 2^64 ≡ 2^3，mid*2^32 = (mid >> 29)*2^61 + (mid & (2^29-1))*2^32 ≡ (mid >> 29) + ...，
+# 各项都小于 2^61，和 b 加起来仍在 uint64 范围内，最后只约简一次。中间结果原地计算，减少临时数组。
+def hashmod_mersenne61(a, b, x):
+    a_hi, a_lo = a >> np.uint64(32), a & _MASK32
+    x_hi, x_lo = x >> np.uint64(32), x & _MASK32
+    total = a_hi * x_hi                       # < 2^58
+    total <<= np.uint64(3)
+    mid = a_hi * x_lo                         # mid < 2^62
+    tmp = a_lo * x_hi
+    mid += tmp
+    np.right_shift(mid, np.uint64(29), out=tmp)
+    total += tmp
+    mid &= _MASK29
+    mid <<= np.uint64(32)
+    total += mid
+    ll = np.multiply(a_lo, x_lo, out=mid)     # < 2^64
+    np.bitwise_and(ll, _P, out=tmp)
+    total += tmp
+    ll >>= np.uint64(61)
+    total += ll
+    total += b
+    np.right_shift(total, np.uint64(61), out=tmp)
+    total &= _P
+    total += tmp
+    total -= _P * (total >= _P)
+    return total
+
+def ngram_hashes(doc_ngrams_set):
+    return np.fromiter((mmh3.hash64(s, NGRAM_HASH_SEED, signed=False)[0] for s in doc_ngrams_set),
+                       dtype=np.uint64, count=len(doc_ngrams_set))
+
+# 一批文档的签名：所有文档的 n-gram 哈希拼成一个向量，按列分块（块小一些能留在缓存里）算 (num_hashes, 块长) 的矩阵，
+# 再用 minimum.reduceat 按文档取最小值。返回 (文档数, num_hashes)，没有 n-gram 的文档全是 2^64-1。
+def minhash_signatures(hash_lists, hash_params, block=1024):
+    num_hashes = len(hash_params)
+    out = np.full((len(hash_lists), num_hashes), EMPTY_SIGNATURE, dtype=np.uint64)
+    nonempty = [i for i, h in enumerate(hash_lists) if len(h)]
+    if not nonempty:
+        return out
+    values = mod_mersenne61(np.concatenate([hash_lists[i] for i in nonempty]))
+    doc_ids = np.repeat(np.arange(len(nonempty)), [len(hash_lists[i]) for i in nonempty])
+    a, b = hash_params[:, 0:1], hash_params[:, 1:2]
+    mins = np.full((num_hashes, len(nonempty)), EMPTY_SIGNATURE, dtype=np.uint64)
+    for start in range(0, len(values), block):
+        x = values[start:start + block]
+        ids = doc_ids[start:start + block]
+        raw = hashmod_mersenne61(a, b, x)
+        # 块内每篇文档的起点
+        starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+        mins[:, ids[starts]] = np.minimum(mins[:, ids[starts]], np.minimum.reduceat(raw, starts, axis=1))
+    out[nonempty] = mins.T
+    return out
+
+def compute_signature(doc_ngrams_set, hash_params):
+    return minhash_signatures([ngram_hashes(doc_ngrams_set)], hash_params)[0]
+
+# worker：读一批文件（给了 record_format 时是一批分片里的所有文档），返回它们的签名，
+# 以及（需要时）每篇文档有序去重后的 n-gram 哈希数组
+def signature_batch(args):
+    paths, ngrams, hash_params, keep_ngrams, record_format = args
+    if record_format is None:
+        ngram_sets = (document_ngrams(path, ngrams) for path in paths)
+    else:
+        ngram_sets = (get_ngrams(normalize(record), ngrams) for path in paths
+                      for record in record_format.read(path))
+    hash_lists = [np.unique(ngram_hashes(ngram_set)) for ngram_set in ngram_sets]
+    return minhash_signatures(hash_lists, hash_params), hash_lists if keep_ngrams else None
+
+class NgramHashStore:
+    """按文档顺序把有序的 n-gram 哈希数组追加到一个 .u64 文件，offsets 记在内存里，读的时候用 mmap。
+    验证时不用再读原文、归一化和重新切 n-gram。"""
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = [0]
+        self._file = open(path, 'wb')
+
+    def append(self, hashes):
+        hashes.tofile(self._file)
+        self.offsets.append(self.offsets[-1] + len(hashes))
+
+    def close(self):
+        self._file.close()
+        self.offsets = np.asarray(self.offsets, dtype=np.int64)
+
+    # 供 worker 使用的 {文档下标: (起点, 终点)}
+    def spans(self, doc_ids):
+        return {idx: (int(self.offsets[idx]), int(self.offsets[idx + 1])) for idx in doc_ids}
+
+def open_ngram_data(path):
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=np.uint64)
+    return np.memmap(path, dtype=np.uint64, mode='r')
+
+# 计算所有文件的签名，写进预先分配的矩阵；num_workers > 1 时按批分给进程池。
+# 给了 record_format 时每个分片一批，文档数事先不知道，各批的签名最后拼起来，行的顺序就是文档在分片里的顺序。
+# 给了 ngram_store 时，顺便把每篇文档的 n-gram 哈希数组按顺序写进去
+def compute_signatures(input_files, hash_params, ngrams, num_workers=1, batch_docs=64, ngram_store=None,
+                       record_format=None):
+    record_format = get_record_format(record_format)
+    keep_ngrams = ngram_store is not None
+    batch = batch_docs if record_format is None else 1
+    starts = range(0, len(input_files), batch)
+    tasks = [(input_files[i:i + batch], ngrams, hash_params, keep_ngrams, record_format) for i in starts]
+    if record_format is None:
+        signatures = np.empty((len(input_files), len(hash_params)), dtype=np.uint64)
+    else:
+        signatures = []
+    if num_workers > 1:
+        executor = ProcessPoolExecutor(max_workers=num_workers)
+        results = executor.map(signature_batch, tasks)
+    else:
+        executor = None
+        results = map(signature_batch, tasks)
+    try:
+        for i, (sigs, hash_lists) in zip(starts, results):
+            if record_format is None:
+                signatures[i:i + len(sigs)] = sigs
+            else:
+                signatures.append(sigs)
+            if keep_ngrams:
+                for hashes in hash_lists:
+                    ngram_store.append(hashes)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if keep_ngrams:
+        ngram_store.close()
+    if record_format is not None:
+        signatures = np.concatenate(signatures) if signatures else np.empty((0, len(hash_params)), dtype=np.uint64)
+    return signatures
+
+# 按块把文件原样（同样的解码和换行处理）复制到输出，不把整篇文本留在内存里
+def copy_document(path, output_path, chunk_chars=1 << 20):
+    with open(path, 'r', encoding='utf-8', errors='replace') as f_in, \
+        open(output_path, 'w', encoding='utf-8') as f_out:
+        while True:
+            chunk = f_in.read(chunk_chars)
+            if not chunk:
+                break
+            f_out.write(chunk)
+
+# 写出保留的文档，返回它们的来源名（文件名；按文档时是 "分片名:分片内序号"）。
+# 按文档时重新顺序读一遍分片，第 idx 篇文档对应签名矩阵的第 idx 行
+def write_kept_documents(input_files, keep, output_directory, record_format=None):
+    kept = []
+    if record_format is None:
+        for idx in np.flatnonzero(keep).tolist():
+            name = os.path.basename(input_files[idx])
+            copy_document(input_files[idx], os.path.join(output_directory, name))
+            kept.append(name)
+        return kept
+    idx = 0
+    for file in input_files:
+        name = os.path.basename(file)
+        with open_shard(os.path.join(output_directory, name), 'wt') as f_out:
+            for i, record in enumerate(record_format.read(file)):
+                if keep[idx]:
+                    record_format.write(f_out, record)
+                    kept.append(f'{name}:{i}')
+                idx += 1
+    return kept
+
+# ---- 候选边验证 ----
+# 每篇文档的 n-gram 存成排好序、不重复的 64 位哈希数组（每个 n-gram 8 字节，字符串集合要几十字节），
+# 交集大小用 searchsorted 向量化地求。候选边按代表文档排序后切块，分给进程池并行验证。
+
+def ngram_hash_array(path, ngrams):
+    return np.unique(ngram_hashes(document_ngrams(path, ngrams)))
+
+# 两个有序不重复数组的 Jaccard 相似度，空集的约定和 jaccard_similarity 一致
+def jaccard_sorted(a, b):
+    if len(a) == 0 and len(b) == 0: return 1.0
+    if len(a) == 0 or len(b) == 0: return 0.0
+    if len(a) > len(b):
+        a, b = b, a
+    pos = np.searchsorted(b, a)
+    pos[pos == len(b)] = 0
+    intersection = int((b[pos] == a).sum())
+    return intersection / (len(a) + len(b) - intersection)
+
+# worker：验证一块边，返回每条边的 Jaccard 是否超过阈值。
+# store_path 不为 None 时 docs 是 {下标: (起点, 终点)}，直接从 mmap 的 n-gram 哈希文件里切；否则 docs 是 {下标: 文件路径}
+def verify_edge_chunk(args):
+    docs, reps, members, ngrams, jaccard_threshold, ngram_cache, store_path = args
+    if store_path is not None:
+        data = open_ngram_data(store_path)
+        load = lambda idx: data[docs[idx][0]:docs[idx][1]]
+    else:
+        load = lru_cache(maxsize=ngram_cache)(lambda idx: ngram_hash_array(docs[idx], ngrams))
+    return np.fromiter((jaccard_sorted(load(i), load(j)) > jaccard_threshold for i, j in zip(reps, members)),
+                       dtype=bool, count=len(reps))
+
+# 用签名估计 Jaccard：两篇文档签名相同的位置占比。估计值的标准差约为 sqrt(t(1-t)/num_hashes)，
+# 离阈值超过 estimate_z 个标准差的边直接判定，返回 (已判定掩码, 判定结果)。
+def estimate_decisions(signatures, reps, members, jaccard_threshold, estimate_z, chunk=1 << 16):
+    num_hashes = signatures.shape[1]
+    margin = estimate_z * np.sqrt(max(jaccard_threshold * (1 - jaccard_threshold), 1e-12) / num_hashes)
+    estimates = np.empty(len(reps))
+    for start in range(0, len(reps), chunk):
+        r, m = reps[start:start + chunk], members[start:start + chunk]
+        estimates[start:start + chunk] = (signatures[r] == signatures[m]).mean(axis=1)
+    accept = estimates >= jaccard_threshold + margin
+    reject = estimates <= jaccard_threshold - margin
+    return accept | reject, accept
+
+def verify_edges(input_files, reps, members, ngrams, jaccard_threshold, num_workers=1, chunk_size=4096,
+                 ngram_cache=1024, signatures=None, estimate_z=None, ngram_store=None):
+    """返回每条候选边是否通过验证。给了 signatures 和 estimate_z 时，先用签名估计判定明显的边，其余的精确计算。
+    给了 ngram_store（已 close 的 NgramHashStore）时从里面读 n-gram 哈希，否则从原文件重新计算。"""
+    keep = np.zeros(len(reps), dtype=bool)
+    pending = np.arange(len(reps))
+    if estimate_z is not None and signatures is not None and len(reps):
+        decided, accepted = estimate_decisions(signatures, reps, members, jaccard_threshold, estimate_z)
+        keep[decided] = accepted[decided]
+        pending = np.flatnonzero(~decided)
+        print(f"  签名估计直接判定 {int(decided.sum())} 条边（接受 {int(accepted.sum())}），精确验证 {len(pending)} 条")
+    # 按代表排序后切块，同一块里的边大多共享文档
+    pending = pending[np.argsort(reps[pending], kind='stable')]
+    chunks = [pending[i:i + chunk_size] for i in range(0, len(pending), chunk_size)]
+    tasks = []
+    store_path = ngram_store.path if ngram_store is not None else None
+    for c in chunks:
+        # 每块只带上用到的文档
+        doc_ids = np.union1d(reps[c], members[c]).tolist()
+        docs = ngram_store.spans(doc_ids) if ngram_store is not None else {idx: input_files[idx] for idx in doc_ids}
+        tasks.append((docs, reps[c].tolist(), members[c].tolist(), ngrams, jaccard_threshold, ngram_cache, store_path))
+    if num_workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(verify_edge_chunk, tasks))
+    else:
+        results = [verify_edge_chunk(task) for task in tasks]
+    for c, result in zip(chunks, results):
+        keep[c] = result
+    return keep
+
+# ---- LSH 和聚类 ----
+# 每个 band 的 rows_per_band 个签名值混合成一个 uint64 键（乘法溢出是有意的，只用来分桶；
+# 不同的 band 值撞到同一个键只会多出几条候选边，之后都会用 Jaccard 验证）。
+_BAND_MULT = np.uint64(0x9E3779B97F4A7C15)
+
+def band_hashes(signatures, num_bands):
+    rows_per_band = signatures.shape[1] // num_bands
+    keys = np.empty((len(signatures), num_bands), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for band_idx in range(num_bands):
+            h = np.full(len(signatures), band_idx, dtype=np.uint64)
+            for row in range(band_idx * rows_per_band, (band_idx + 1) * rows_per_band):
+                h ^= signatures[:, row]
+                h *= _BAND_MULT
+                h ^= h >> np.uint64(29)
+            keys[:, band_idx] = h
+    return keys
+
+# 每个 band 按键排序，同一个桶里的文档只和桶里下标最小的代表文档连边（星形），不枚举桶内所有 pair。
+# 返回去重后的 (代表, 成员) 两个数组，以及如果枚举所有 pair 会有多少条（用于对比）。
+def lsh_star_edges(band_keys):
+    reps, members = [], []
+    all_pairs = 0
+    for keys in band_keys.T:
+        # stable 排序，同一个桶里的文档按下标递增，第一个就是代表
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        new_bucket = np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]
+        bucket_id = np.cumsum(new_bucket) - 1
+        sizes = np.bincount(bucket_id)
+        all_pairs += int((sizes * (sizes - 1) // 2).sum())
+        rep = order[new_bucket][bucket_id]
+        is_member = ~new_bucket
+        reps.append(rep[is_member])
+        members.append(order[is_member])
+    if not reps:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), 0
+    edges = np.unique(np.stack([np.concatenate(reps), np.concatenate(members)], axis=1), axis=0)
+    return edges[:, 0], edges[:, 1], all_pairs
+
+# 基于数组的并查集：把每条边两端的根中较大的挂到较小的下面，再做指针跳跃压平，直到每条边两端同根。
+# 指针总是指向更小的下标，所以每个连通分量的根就是其中最小的下标。
+def union_find_components(n, u, v):
+    parent = np.arange(n)
+    u, v = np.asarray(u, dtype=np.int64), np.asarray(v, dtype=np.int64)
+    while True:
+        pu, pv = parent[u], parent[v]
+        differ = pu != pv
+        if not differ.any():
+            return parent
+        lo, hi = np.minimum(pu[differ], pv[differ]), np.maximum(pu[differ], pv[differ])
+        np.minimum.at(parent, hi, lo)
+        while True:
+            grand = parent[parent]
+            if (grand == parent).all():
+                break
+            parent = grand
+
+# ---- LSH 参数规划 ----
+# b 个 band、每个 band r 行时，Jaccard 为 s 的一对文档至少在一个 band 撞桶的概率是 1 - (1 - s^r)^b（S 曲线），
+# 拐点约在 (1/b)^(1/r)。规划器枚举 b * r <= max_hashes 的所有组合（num_hashes 取 b * r，不留余数），
+# 要求阈值处的召回率 >= recall，在此基础上最小化
+#     预计假阳性候选对数 + hash_cost * 文档数 * num_hashes
+# hash_cost 是算一个文档的一个签名值相对验证一对候选的代价。假阳性对数需要文档对的相似度分布：
+# 给了 similarity_hist（dry_run_lsh 在样本上量出来的所有文档对估计 Jaccard 的直方图）就按它算，
+# 否则假设阈值以下的相似度均匀分布，这会大大高估假阳性，只适合在组合之间做比较。
+PLAN_BINS = 100
+
+def lsh_collision_probability(similarity, num_bands, rows_per_band):
+    return 1 - (1 - np.power(similarity, rows_per_band)) ** num_bands
+
+def lsh_configs(max_hashes):
+    return [(b, r) for r in range(1, max_hashes + 1) for b in range(1, max_hashes // r + 1)]
+
+def check_band_remainder(num_hashes, num_bands):
+    remainder = num_hashes % num_bands
+    if remainder:
+        print(f"警告: num_hashes={num_hashes} 不能被 num_bands={num_bands} 整除，最后 {remainder} 个哈希不参与分桶；"
+              f"可以用 plan_lsh 选一组 b * r")
+
+def plan_lsh(jaccard_threshold, recall=0.9, num_docs=1_000_000, max_hashes=256, hash_cost=0.02,
+             similarity_hist=None, top=5):
+    """返回按代价排序的前 top 个方案，每个方案是一个 dict；没有满足 recall 的组合时返回阈值处召回率最高的几个"""
+    centers = (np.arange(PLAN_BINS) + 0.5) / PLAN_BINS
+    if similarity_hist is None:
+        weights = np.where(centers < jaccard_threshold, 1.0, 0.0)
+    else:
+        weights = np.asarray(similarity_hist, dtype=np.float64)
+    weights = weights / max(weights.sum(), 1e-300)
+    num_pairs = num_docs * (num_docs - 1) / 2
+    below = centers < jaccard_threshold
+    plans = []
+    for b, r in lsh_configs(max_hashes):
+        prob = lsh_collision_probability(centers, b, r)
+        plans.append({
+            'num_bands': b,
+            'rows_per_band': r,
+            'num_hashes': b * r,
+            'knee': (1 / b) ** (1 / r),
+            'recall_at_threshold': float(lsh_collision_probability(jaccard_threshold, b, r)),
+            'expected_candidates': float(num_pairs * (weights * prob).sum()),
+            'expected_false_positives': float(num_pairs * (weights * prob)[below].sum()),
+        })
+    for plan in plans:
+        plan['cost'] = plan['expected_false_positives'] + hash_cost * num_docs * plan['num_hashes']
+    feasible = [plan for plan in plans if plan['recall_at_threshold'] >= recall]
+    if not feasible:
+        print(f"警告: max_hashes={max_hashes} 内没有阈值处召回率 >= {recall} 的组合")
+        return sorted(plans, key=lambda p: -p['recall_at_threshold'])[:top]
+    return sorted(feasible, key=lambda p: p['cost'])[:top]
+
+# 样本里所有文档对的签名估计 Jaccard 的直方图（PLAN_BINS 个等宽区间）
+def pair_similarity_hist(signatures, block=128):
+    hist = np.zeros(PLAN_BINS, dtype=np.int64)
+    n = len(signatures)
+    for i in range(0, n, block):
+        sims = (signatures[i:i + block, None, :] == signatures[None, i:, :]).mean(axis=2)
+        # 只取 j > i 的上三角
+        rows, cols = np.triu_indices(len(sims), k=1, m=sims.shape[1])
+        bins = np.minimum((sims[rows, cols] * PLAN_BINS).astype(np.int64), PLAN_BINS - 1)
+        hist += np.bincount(bins, minlength=PLAN_BINS)
+    return hist
+
+# 一组 (b, r) 下撞桶的所有文档对（去重），用签名矩阵的前 b * r 列
+def colliding_pairs(signatures, num_bands, rows_per_band):
+    keys = band_hashes(signatures[:, :num_bands * rows_per_band], num_bands)
+    pairs = []
+    for band in keys.T:
+        order = np.argsort(band, kind='stable')
+        sorted_keys = band[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        sizes = np.diff(np.r_[starts, len(band)])
+        for start, size in zip(starts[sizes > 1], sizes[sizes > 1]):
+            members = np.sort(order[start:start + size])
+            i, j = np.triu_indices(size, k=1)
+            pairs.append(np.stack([members[i], members[j]], axis=1))
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.unique(np.concatenate(pairs), axis=0)
+
+def lsh_sample(input_files, jaccard_threshold, ngrams, sample_docs=1000, max_hashes=256, seed=0,
+               record_format=None, num_workers=1, tmp_dir=None):
+    """随机抽样，算 max_hashes 个哈希的签名，找出样本里真实的近重复对，并统计所有文档对的相似度直方图。
+
+    真实的近重复对：签名估计 Jaccard 在阈值减 3 个标准差以上的对再用 n-gram 哈希精确验证。
+    返回的 dict 给 measure_lsh_configs 用，其中的 'hist' 可以直接传给 plan_lsh。"""
+    record_format = get_record_format(record_format)
+    rng = np.random.default_rng(seed)
+    files = list(input_files)
+    if record_format is None and len(files) > sample_docs:
+        files = [files[i] for i in np.sort(rng.choice(len(files), sample_docs, replace=False))]
+    hash_params = make_hash_params(max_hashes)
+    work_dir = tempfile.mkdtemp(prefix='lsh-plan-', dir=tmp_dir)
+    try:
+        store = NgramHashStore(os.path.join(work_dir, 'ngrams.u64'))
+        signatures = compute_signatures(files, hash_params, ngrams, num_workers, ngram_store=store,
+                                        record_format=record_format)
+        # 分片里的文档先全部算签名，再抽样
+        docs = np.arange(len(signatures))
+        if len(docs) > sample_docs:
+            docs = np.sort(rng.choice(len(docs), sample_docs, replace=False))
+        sample = signatures[docs]
+
+        margin = 3 * np.sqrt(jaccard_threshold * (1 - jaccard_threshold) / max_hashes)
+        candidates = []
+        for i in range(len(sample)):
+            sims = (sample[i + 1:] == sample[i]).mean(axis=1)
+            for j in np.flatnonzero(sims >= jaccard_threshold - margin):
+                candidates.append((i, i + 1 + j))
+        candidates = np.array(candidates, dtype=np.int64).reshape(-1, 2)
+        keep = verify_edges(None, docs[candidates[:, 0]], docs[candidates[:, 1]], ngrams, jaccard_threshold,
+                            ngram_store=store)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        'signatures': sample,
+        'true_pairs': {tuple(pair) for pair in candidates[keep].tolist()},
+        'hist': pair_similarity_hist(sample),
+    }
+
+# 在样本上实测每组 (b, r) 的候选对数、假阳性和召回率
+def measure_lsh_configs(sample, configs):
+    signatures, true_pairs = sample['signatures'], sample['true_pairs']
+    results = []
+    for b, r in configs:
+        if b * r > signatures.shape[1]:
+            raise ValueError(f"b * r = {b * r} 超过样本的签名长度 {signatures.shape[1]}")
+        pairs = colliding_pairs(signatures, b, r)
+        found = sum(1 for pair in pairs.tolist() if tuple(pair) in true_pairs)
+        results.append({
+            'num_bands': b,
+            'rows_per_band': r,
+            'sample_docs': len(signatures),
+            'true_pairs': len(true_pairs),
+            'candidate_pairs': len(pairs),
+            'false_positives': len(pairs) - found,
+            'recall': found / len(true_pairs) if true_pairs else 1.0,
+        })
+    return results
+
+def dry_run_lsh(input_files, jaccard_threshold, ngrams, configs, sample_docs=1000, max_hashes=256, **kwargs):
+    """返回 (每组配置的实测结果, 样本的相似度直方图)"""
+    sample = lsh_sample(input_files, jaccard_threshold, ngrams, sample_docs, max_hashes, **kwargs)
+    return measure_lsh_configs(sample, configs), sample['hist']
+
+# 第 1～4 步：算签名、LSH 分桶、验证候选边、并查集聚类。
+# 返回签名矩阵、每篇文档所在连通分量的根（最小下标），以及候选边和验证的统计
+def batch_near_duplicates(input_files, hash_params, num_bands, ngrams, jaccard_threshold, num_workers=1,
+                          ngram_cache=1024, estimate_z=None, ngram_store=True, tmp_dir=None, record_format=None):
+    if record_format is not None and not ngram_store:
+        raise ValueError("按文档去重时没法从文件重新计算单篇文档的 n-gram，需要 ngram_store=True")
+    check_band_remainder(len(hash_params), num_bands)
+    work_dir = tempfile.mkdtemp(prefix='minhash-', dir=tmp_dir)
+    try:
+        # 第一遍顺便把 n-gram 哈希落盘，验证时直接 mmap 读取
+        store = NgramHashStore(os.path.join(work_dir, 'ngrams.u64')) if ngram_store else None
+
+        print("Step 1: Computing Signatures...")
+        signatures = compute_signatures(input_files, hash_params, ngrams, num_workers, ngram_store=store,
+                                        record_format=record_format)
+
+        print("Step 2: LSH Bucketing...")
+        reps, members, all_pairs = lsh_star_edges(band_hashes(signatures, num_bands))
+
+        print(f"Step 3: Verifying {len(reps)} candidate edges (all-pairs would be {all_pairs})...")
+        keep_edge = verify_edges(input_files, reps, members, ngrams, jaccard_threshold, num_workers,
+                                 ngram_cache=ngram_cache, signatures=signatures, estimate_z=estimate_z,
+                                 ngram_store=store)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print("Step 4: Clustering and Filtering...")
+    # 每个连通分量只留下下标最小的文档
+    roots = union_find_components(len(signatures), reps[keep_edge], members[keep_edge])
+    stats = {
+        'docs': len(signatures),
+        'candidate_edges': len(reps),
+        'bucket_pairs': all_pairs,
+        'verified_edges': int(keep_edge.sum()),
+        'removed': int((roots != np.arange(len(roots))).sum()),
+    }
+    return signatures, roots, stats
+
 # uv run pytest -k test_minhash_deduplication
+# 流式版本：第一遍只保留预先分配好的 (文档数, num_hashes) 签名矩阵，不保留文本和 n-gram 集合；
+# 验证时用第一遍落盘的 n-gram 哈希（ngram_store=False 时只对候选文档重新计算，LRU 缓存最多 ngram_cache 篇），
+# 输出时再从磁盘读取保留的文件。
+# LSH 用排序分桶，桶内只连到代表文档的星形边，验证通过的边用并查集合并。
+# estimate_z 不为 None 时，签名估计离阈值超过 estimate_z 个标准差的边不再精确验证。
+# record_format 不为 None 时输入是多文档分片，每篇文档是一个去重单位，输出同名分片。
 def minhash_deduplication(
     input_files: list[os.PathLike],
     num_hashes: int,
@@ -71,99 +1063,196 @@ def minhash_deduplication(
     ngrams: int,
     jaccard_threshold: float,
     output_directory: os.PathLike,
+    ngram_cache: int = 1024,
+    num_workers: int = 1,
+    estimate_z: float | None = None,
+    ngram_store: bool = True,
+    tmp_dir: str | None = None,
+    record_format=None,
 ):
+    record_format = get_record_format(record_format)
     os.makedirs(output_directory, exist_ok=True)
-    prime = (1 << 61) - 1
-    np.random.seed(42) 
     # (a*x + b) % p 
-    hash_params = np.random.randint(1, prime, size=(num_hashes, 2), dtype=np.uint64)
-    docs = []
+    hash_params = make_hash_params(num_hashes)
+    _, roots, stats = batch_near_duplicates(input_files, hash_params, num_bands, ngrams, jaccard_threshold,
+                                            num_workers, ngram_cache, estimate_z, ngram_store, tmp_dir,
+                                            record_format)
+    keep = roots == np.arange(len(roots))
 
-    print("Step 1: Computing Signatures...")
-    for file in input_files:
-        file_name = os.path.basename(file)
-        with open(file, 'r', encoding='utf-8', errors='replace') as f:
-            text = f.read()
-        clean_text = normalize(text)
-        doc_ngrams_set = get_ngrams(clean_text, ngrams)
-        if not doc_ngrams_set: 
-            signature = np.full(num_hashes, 2**64-1, dtype=np.uint64)
+    print("Step 5: Writing output...")
+    write_kept_documents(input_files, keep, output_directory, record_format)
+
+    print(f"Removed {int((~keep).sum())} duplicate documents.")
+    print('Sucess!')
+    return stats
+
+
+# ---- 持久化 MinHash LSH 索引 ----
+# 索引目录里是若干段，每段保存一批已入库文档的签名矩阵（.sig.npy），以及每个 band 按键排好序的
+# 桶表（.bands.npy 是 (num_bands, n) 的有序键，.order.npy 是对应的段内下标），都用 mmap 打开。
+# 查询时每个 band 对每段做两次 searchsorted 就能取出同桶的文档，不需要把历史签名读进内存。
+# 原文可能已经发布、不在本地，所以和历史文档的相似度用签名估计（签名相同位置的占比），不做精确验证。
+# 参数 num_hashes / num_bands / ngrams 写在 index.json 里，之后打开时必须一致。
+
+class MinHashLSHIndex:
+    """可增量追加、可查询的磁盘 MinHash LSH 索引。"""
+
+    def __init__(self, path, num_hashes=None, num_bands=None, ngrams=None):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, INDEX_META)
+        params = {'num_hashes': num_hashes, 'num_bands': num_bands, 'ngrams': ngrams}
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                self.meta = json.load(f)
+            for key, value in params.items():
+                if value is not None and value != self.meta[key]:
+                    raise ValueError(f"索引 {path} 的 {key}={self.meta[key]}，与传入的 {value} 不一致")
         else:
-            ngrams_hash = np.array([hash(s) & 0xFFFFFFFF for s in doc_ngrams_set], dtype=np.uint64)
-            raw_hash = (hash_params[:, 0:1] * ngrams_hash + hash_params[:, 1:2]) % prime
-            signature = raw_hash.min(axis=1)
-        docs.append({
-            'path': file,
-            'filename': file_name,
-            'text': text,
-            'ngrams': doc_ngrams_set,
-            'signature': signature
-        })
-        
-    print("Step 2: LSH Bucketing...")
-    rows_per_band = num_hashes // num_bands
-    candidate_pairs = set()
-    for band_idx in range(num_bands):
-        start_row = band_idx * rows_per_band
-        end_row = start_row + rows_per_band
-        buckets = defaultdict(list)
-        for doc_idx, doc in enumerate(docs):
-            sig = doc['signature']
-            band_sig = tuple(sig[start_row: end_row])
-            buckets[band_sig].append(doc_idx) # [(band1):[doc1, doc3, doc10, ...], (band2):[...]]
-        # collision_count = sum(1 for docs in buckets.values() if len(docs) > 1)
-        # print(f'Band {band_idx}: 发现 {collision_count} 组潜在重复。')
-        for bucket_docs in buckets.values():
-            if len(bucket_docs) > 1:
-                for i in range(len(bucket_docs)):
-                    for j in range(i+1, len(bucket_docs)):
-                        doc_a = bucket_docs[i]
-                        doc_b = bucket_docs[j]
-                        candidate_pairs.add(tuple(sorted((doc_a, doc_b)))) # doc_idx
-
-    print(f"Step 3: Verifying {len(candidate_pairs)} candidates...")
-
-    to_remove_indices = set()
-    import networkx as nx
-    G = nx.Graph()
-    # 所有的文档作为节点，相似度高的两两连接
-    for i in range(len(docs)):
-        G.add_node(i)
-    for (i, j) in candidate_pairs:
-        siga, sigb = docs[i]['ngrams'], docs[j]['ngrams']
-        if jaccard_similarity(siga, sigb) > jaccard_threshold:
-            G.add_edge(i, j)
+            missing = [key for key, value in params.items() if value is None]
+            if missing:
+                raise ValueError(f"新建索引 {path} 需要指定 {', '.join(missing)}")
+            check_band_remainder(num_hashes, num_bands)
+            self.meta = {**params, 'segments': [], 'sources': []}
+        self.hash_params = make_hash_params(self.num_hashes)
+        self.segments = [self._open_segment(seg) for seg in self.meta['segments']]
 
-    print("Step 4: Clustering and Filtering...")
-    components = list(nx.connected_components(G))
-    # 所有联通分量list[set]
-    # ex: [
-    #       {'doc1', 'doc3', 'doc10'},
-    #       {'doc2', 'doc8'}
-    #      ]
-    for comp in components:
-        # 所有联通分量只留下一个（第一个）
-        if len(comp) > 1:
-            comp_list = sorted(list(comp))
-            for idx in comp_list[1:]:
-                to_remove_indices.add(idx)
+    num_hashes = property(lambda self: self.meta['num_hashes'])
+    num_bands = property(lambda self: self.meta['num_bands'])
+    ngrams = property(lambda self: self.meta['ngrams'])
 
-    print("Step 5: Writing output...")
-    for idx, doc in enumerate(docs):
-        if idx not in to_remove_indices:
-            output_path = os.path.join(output_directory, doc['filename'])
-            with open(output_path, 'w', encoding='utf-8') as f:
-                f.write(doc['text'])
+    def _open_segment(self, seg):
+        arrays = [np.load(os.path.join(self.path, f"{seg['name']}.{suffix}.npy"), mmap_mode='r')
+                  for suffix in ('sig', 'bands', 'order')]
+        return (seg['start'], *arrays)
 
-    print(f"Removed {len(to_remove_indices)} duplicate documents.")
-    print('Sucess!')
+    def __len__(self):
+        return len(self.meta['sources'])
 
+    @property
+    def sources(self):
+        return self.meta['sources']
 
-    
+    def _save_meta(self):
+        meta_path = os.path.join(self.path, INDEX_META)
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f, ensure_ascii=False, indent=2)
+        os.replace(meta_path + '.tmp', meta_path)
 
+    def _write_segment(self, signatures, start):
+        seq = self.meta.get('next_segment', 0)
+        self.meta['next_segment'] = seq + 1
+        name = f'seg-{seq:05d}'
+        keys = band_hashes(signatures, self.num_bands).T
+        order = np.argsort(keys, axis=1, kind='stable')
+        arrays = {'sig': signatures, 'bands': np.take_along_axis(keys, order, axis=1), 'order': order}
+        for suffix, values in arrays.items():
+            out = os.path.join(self.path, f'{name}.{suffix}.npy')
+            with open(out + '.tmp', 'wb') as f:
+                np.save(f, values)
+            os.replace(out + '.tmp', out)
+        return {'name': name, 'start': start, 'size': len(signatures)}
 
+    def signatures(self, files, num_workers=1, record_format=None):
+        return compute_signatures(files, self.hash_params, self.ngrams, num_workers, record_format=record_format)
 
+    # 把一批文档的签名作为新段追加进索引，返回它们在索引里的全局编号；meta 最后原子替换
+    def add(self, signatures, sources=()):
+        signatures = np.ascontiguousarray(signatures, dtype=np.uint64)
+        start = len(self)
+        sources = [os.path.basename(str(s)) for s in sources]
+        if len(sources) != len(signatures):
+            raise ValueError(f"sources 有 {len(sources)} 个，签名有 {len(signatures)} 行")
+        if len(signatures):
+            seg = self._write_segment(signatures, start)
+            self.meta['segments'].append(seg)
+            self.segments.append(self._open_segment(seg))
+        self.meta['sources'].extend(sources)
+        self._save_meta()
+        return np.arange(start, start + len(signatures))
 
+    # 返回 (查询下标, 索引中的全局编号, 估计的 Jaccard)，只包含估计值 >= jaccard_threshold 的对，按查询下标排序
+    def query(self, signatures, jaccard_threshold):
+        signatures = np.asarray(signatures, dtype=np.uint64)
+        band_keys = band_hashes(signatures, self.num_bands).T
+        queries, matches, estimates = [], [], []
+        for start, sig, bands, order in self.segments:
+            cand_q, cand_local = [], []
+            for band_idx in range(self.num_bands):
+                lo = np.searchsorted(bands[band_idx], band_keys[band_idx], side='left')
+                hi = np.searchsorted(bands[band_idx], band_keys[band_idx], side='right')
+                sizes = hi - lo
+                if not sizes.any():
+                    continue
+                q = np.repeat(np.arange(len(signatures)), sizes)
+                # 展开每个查询命中的 [lo, hi) 区间
+                offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+                cand_q.append(q)
+                cand_local.append(np.asarray(order[band_idx])[np.repeat(lo, sizes) + offsets])
+            if not cand_q:
+                continue
+            pairs = np.unique(np.stack([np.concatenate(cand_q), np.concatenate(cand_local)], axis=1), axis=0)
+            est = (signatures[pairs[:, 0]] == np.asarray(sig[pairs[:, 1]])).mean(axis=1)
+            hit = est >= jaccard_threshold
+            queries.append(pairs[hit, 0])
+            matches.append(pairs[hit, 1] + start)
+            estimates.append(est[hit])
+        if not queries:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+        queries, matches, estimates = np.concatenate(queries), np.concatenate(matches), np.concatenate(estimates)
+        order = np.argsort(queries, kind='stable')
+        return queries[order], matches[order], estimates[order]
 
+    # 把所有段合并成一个，重建桶表。需要把所有签名读进内存，适合在两次增量之间离线做
+    def compact(self):
+        if len(self.segments) <= 1:
+            return
+        signatures = np.concatenate([np.asarray(sig) for _, sig, _, _ in self.segments])
+        old = self.meta['segments']
+        seg = self._write_segment(signatures, 0)
+        self.meta['segments'] = [seg]
+        self._save_meta()
+        self.segments = [self._open_segment(seg)]
+        for s in old:
+            for suffix in ('sig', 'bands', 'order'):
+                os.remove(os.path.join(self.path, f"{s['name']}.{suffix}.npy"))
 
 
+# 用持久化索引对一批新文档做近似去重：批内按 minhash_deduplication 的方式精确验证，
+# 再去掉和索引中任何文档估计 Jaccard >= jaccard_threshold 的文档。
+# 只有保留下来的文档会加入索引（索引代表已经进入训练集的数据）；update_index=False 时只查询不写入。
+def incremental_minhash_deduplication(
+    input_files: list[os.PathLike],
+    output_directory: os.PathLike,
+    index_path: os.PathLike,
+    num_hashes: int | None = None,
+    num_bands: int | None = None,
+    ngrams: int | None = None,
+    jaccard_threshold: float = 0.8,
+    num_workers: int = 1,
+    update_index: bool = True,
+    tmp_dir: str | None = None,
+    record_format=None,
+):
+    record_format = get_record_format(record_format)
+    index = MinHashLSHIndex(index_path, num_hashes, num_bands, ngrams)
+    os.makedirs(output_directory, exist_ok=True)
+    print(f"Deduplicating {len(input_files)} new files against index ({len(index)} docs, "
+          f"{len(index.segments)} segments)...")
+    signatures, roots, _ = batch_near_duplicates(input_files, index.hash_params, index.num_bands, index.ngrams,
+                                                 jaccard_threshold, num_workers, tmp_dir=tmp_dir,
+                                                 record_format=record_format)
+    keep = roots == np.arange(len(roots))
+    batch_removed = int((~keep).sum())
+    # 只需要查批内保留的文档；批内被去掉的文档已经和某篇保留的文档相似
+    candidates = np.flatnonzero(keep)
+    queries, _, _ = index.query(signatures[candidates], jaccard_threshold)
+    keep[candidates[np.unique(queries)]] = False
+
+    print("Step 5: Writing output...")
+    kept = write_kept_documents(input_files, keep, output_directory, record_format)
+    if update_index:
+        index.add(signatures[keep], kept)
+    print(f"Removed {batch_removed} duplicates within the batch and "
+          f"{len(candidates) - int(keep.sum())} against the index.")
+    return index
@@ -0,0 +1,141 @@
+"""fastText 模型的共享注册表。
+
+模型在第一次 get_model 时才加载，同一进程里 preprocessing、pipeline、测试共用同一个实例，
+import 时不做任何加载。
+
+路径配置：
+    CS336_MODEL_DIR=/path/to/classifiers          # 模型目录，默认 cs336_data/data/classifiers
+    CS336_MODEL_LID=/path/to/lid.176.bin          # 单个模型的路径，优先于目录
+    CS336_MODEL_MEMORY_MB=4096                    # 已加载模型的内存上限，超出时按 LRU 卸载
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+import fasttext
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MODEL_DIR = os.path.join(BASE_DIR, 'data', 'classifiers')
+
+MODEL_FILES = {
+    'lid': 'lid.176.bin',
+    'nsfw': 'jigsaw_fasttext_bigrams_nsfw_final.bin',
+    'toxic': 'jigsaw_fasttext_bigrams_hatespeech_final.bin',
+    'quality': 'quality_classifier.bin',
+}
+
+# fastText 加载时会打印一行已弃用 API 的警告
+fasttext.FastText.eprint = lambda x: None
+
+
+class ModelRegistry:
+    """按 key 懒加载模型。max_bytes 不为 None 时，已加载模型的总大小超出上限就卸载最久没用的模型。"""
+
+    def __init__(self, model_dir=None, paths=None, max_bytes=None):
+        self.model_dir = model_dir or os.environ.get('CS336_MODEL_DIR', DEFAULT_MODEL_DIR)
+        self.paths = dict(paths or {})
+        self.max_bytes = max_bytes
+        self._models = OrderedDict()
+        self._sizes = {}
+        # path -> 文件是否存在。缺模型时 has_model 每篇文档都会被调用，不能每次都 stat
+        self._available = {}
+        self.load_times = {}
+        self.load_counts = {}
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        if key in self.paths:
+            return self.paths[key]
+        env = os.environ.get(f'CS336_MODEL_{key.upper()}')
+        if env:
+            return env
+        return os.path.join(self.model_dir, MODEL_FILES.get(key, key))
+
+    def set_path(self, key, path):
+        self.evict(key)
+        self.paths[key] = path
+        self._available.pop(path, None)
+
+    def available(self, key):
+        if key in self._models:
+            return True
+        path = self.path(key)
+        exists = self._available.get(path)
+        if exists is None:
+            exists = self._available[path] = os.path.exists(path)
+        return exists
+
+    def get(self, key):
+        model = self._models.get(key)
+        if model is not None:
+            if self.max_bytes is not None:
+                with self._lock:
+                    if key in self._models:
+                        self._models.move_to_end(key)
+            return model
+        with self._lock:
+            # 其他线程可能已经加载好了
+            if key in self._models:
+                return self._models[key]
+            path = self.path(key)
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"模型 {key} 不存在: {path}")
+            # fastText 把 .bin 整个读进内存，文件大小就是常驻内存的近似值
+            size = os.path.getsize(path)
+            if self.max_bytes is not None:
+                self._evict_for(size)
+            start = time.perf_counter()
+            model = fasttext.load_model(path)
+            self.load_times[key] = time.perf_counter() - start
+            self.load_counts[key] = self.load_counts.get(key, 0) + 1
+            self._models[key] = model
+            self._sizes[key] = size
+            return model
+
+    def _evict_for(self, size):
+        while self._models and self.memory_bytes() + size > self.max_bytes:
+            key = next(iter(self._models))
+            del self._models[key]
+            del self._sizes[key]
+            self.evictions += 1
+
+    def evict(self, key):
+        """卸载模型，并丢掉它路径是否存在的缓存，下次使用时重新检查。"""
+        with self._lock:
+            self._models.pop(key, None)
+            self._sizes.pop(key, None)
+            self._available.pop(self.path(key), None)
+
+    def preload(self, keys=None):
+        """加载 keys 中存在的模型（默认全部），返回实际加载的 key。prefork 模式在父进程里调用。"""
+        keys = MODEL_FILES if keys is None else keys
+        return [key for key in keys if self.available(key) and self.get(key) is not None]
+
+    def loaded(self):
+        return list(self._models)
+
+    def memory_bytes(self):
+        return sum(self._sizes.values())
+
+    def stats(self):
+        return {
+            'loaded': self.loaded(),
+            'memory_mb': self.memory_bytes() / 2**20,
+            'load_seconds': dict(self.load_times),
+            'load_counts': dict(self.load_counts),
+            'evictions': self.evictions,
+        }
+
+
+def _default_max_bytes():
+    mb = os.environ.get('CS336_MODEL_MEMORY_MB')
+    return int(float(mb) * 2**20) if mb else None
+
+registry = ModelRegistry(max_bytes=_default_max_bytes())
+
+def get_model(key):
+    return registry.get(key)
+
+def has_model(key):
+    return registry.available(key)
@@ -1,6 +1,25 @@
 import os 
-import fasttext
-from preprocessing import * 
+import io
+import gc
+import time
+import zlib
+import shutil
+import json
+import hashlib
+import argparse
+import multiprocessing
+import numpy as np
+try:
+    from .preprocessing import *
+    from .model_registry import registry, get_model, has_model
+    from .score_store import (THRESHOLDS, STATUS_OK, STATUS_READ_ERROR, STATUS_EMPTY, ScoreWriter,
+                              scores_path, output_name, merge_score_parts, stage_masks, write_document)
+except ImportError:
+    # 以脚本方式运行时（python cs336_data/pipeline.py），cs336_data 不是包
+    from preprocessing import *
+    from model_registry import registry, get_model, has_model
+    from score_store import (THRESHOLDS, STATUS_OK, STATUS_READ_ERROR, STATUS_EMPTY, ScoreWriter,
+                             scores_path, output_name, merge_score_parts, stage_masks, write_document)
 import gzip
 from collections import Counter
 from concurrent.futures import ProcessPoolExecutor, as_completed
@@ -8,98 +27,567 @@ from tqdm import tqdm
 from fastwarc.warc import ArchiveIterator, WarcRecordType
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-# 模型目录
-MODEL_DIR = os.path.join(BASE_DIR, 'data', 'classifiers')
-# 模型地址
-LID_MODEL_PATH = os.path.join(MODEL_DIR, 'lid.176.bin')
-NSFW_MODEL_PATH = os.path.join(MODEL_DIR, 'jigsaw_fasttext_bigrams_nsfw_final.bin')
-TOXIC_MODEL_PATH = os.path.join(MODEL_DIR, 'jigsaw_fasttext_bigrams_hatespeech_final.bin')
-QUALITY_MODEL_PATH = os.path.join(MODEL_DIR, 'quality_classifier.bin')
-
-models = {}
-def init_worker():
+
+cascade = None
+batch_size = 0
+store_scores = False
+def init_worker(cascade_warmup=0, doc_batch_size=0, score_store=False):
     """在每个进程启动时加载模型，避免重复加载或 Pickling 问题"""
-    global models
-    fasttext.FastText.eprint = lambda x: None
-    if os.path.exists(LID_MODEL_PATH):
-        models['lid'] = fasttext.load_model(LID_MODEL_PATH)
-    if os.path.exists(NSFW_MODEL_PATH):
-        models['nsfw'] = fasttext.load_model(NSFW_MODEL_PATH)
-    if os.path.exists(TOXIC_MODEL_PATH):
-        models['toxic'] = fasttext.load_model(TOXIC_MODEL_PATH)
-    if os.path.exists(QUALITY_MODEL_PATH):
-        models['quality'] = fasttext.load_model(QUALITY_MODEL_PATH)
+    global cascade, batch_size, store_scores
+    batch_size = doc_batch_size
+    store_scores = score_store
+    # 同一进程可能被多次初始化（测试、prefork 父进程），不开 cascade 时要清掉上一次的
+    cascade = None
+    if cascade_warmup > 0:
+        stages = FILTER_BATCH_STAGES if batch_size > 0 else FILTER_STAGES
+        cascade = FilterCascade(stages, warmup=cascade_warmup)
+    if registry.loaded():
+        # prefork 模式：模型已经在父进程加载，fork 出来的子进程直接共享这些只读页
+        return
+    # 和 preprocessing 共用同一个注册表，同一个模型每个进程只加载一次
+    registry.preload()
+    describe_models()
+
+def describe_models():
+    timings = ', '.join(f"{key} {sec:.2f}s" for key, sec in registry.load_times.items())
+    print(f"[{os.getpid()}] 模型加载 ({registry.memory_bytes() / 2**20:.0f} MB): {timings or '无'}")
 
 def predict_fasttext(model_key, text):
-    if model_key not in models: return None, 0.0
+    if not has_model(model_key): return None, 0.0
     text = text.replace('\n', ' ')
-    labels, scores = models[model_key].predict(text)
+    labels, scores = get_model(model_key).predict(text)
     label = labels[0].replace('__label__', '')
     score = scores[0]
     return label, score
 
+# 批量预测：clean_texts 已去掉换行，返回 (labels, scores) 两个 NumPy 数组
+def predict_fasttext_batch(model_key, clean_texts):
+    if not has_model(model_key):
+        return np.full(len(clean_texts), None, dtype=object), np.zeros(len(clean_texts))
+    return predict_batch(model_key, clean_texts, normalised=True)
+
+class DocBatch:
+    """一批待过滤的文档。换行替换每篇只做一次，所有模型共用。"""
+
+    def __init__(self, texts):
+        self.texts = texts
+        self._clean = [None] * len(texts)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def clean(self, idx):
+        out = []
+        for i in idx:
+            text = self._clean[i]
+            if text is None:
+                text = self._clean[i] = self.texts[i].replace('\n', ' ')
+            out.append(text)
+        return out
+
+# 各过滤阶段，返回 True 表示保留
+def keep_gopher(text):
+    return test_gopher(text)
+
+def keep_lang(text):
+    lang, score = predict_fasttext('lid', text)
+    return lang == 'en' and score >= THRESHOLDS['lang']
+
+def keep_nsfw(text):
+    nsfw_label, nsfw_score = predict_fasttext('nsfw', text)
+    return not (nsfw_label == 'nsfw' and nsfw_score > THRESHOLDS['nsfw'])
+
+def keep_toxic(text):
+    toxic_label, toxic_score = predict_fasttext('toxic', text)
+    return not (toxic_label == 'toxic' and toxic_score > THRESHOLDS['toxic'])
+
+def keep_quality(text):
+    qual_label, qual_score = predict_fasttext('quality', text)
+    # 如果确信是 'cc' (垃圾)就丢掉。
+    return not (qual_label == 'cc' and qual_score > THRESHOLDS['quality'])
+
+# 固定顺序：(拒绝时记的统计名, 过滤函数)
+FILTER_STAGES = [
+    ('rejected_gopher', keep_gopher),
+    ('rejected_lang', keep_lang),
+    ('rejected_nsfw', keep_nsfw),
+    ('rejected_toxic', keep_toxic),
+    ('rejected_quality_model', keep_quality),
+]
+
+# 批量版本：输入 DocBatch 和要判断的下标，返回布尔保留掩码
+def keep_gopher_batch(batch, idx):
+    return np.fromiter((test_gopher(batch.texts[i]) for i in idx), dtype=bool, count=len(idx))
+
+def keep_lang_batch(batch, idx):
+    labels, scores = predict_fasttext_batch('lid', batch.clean(idx))
+    return (labels == 'en') & (scores >= THRESHOLDS['lang'])
+
+def keep_nsfw_batch(batch, idx):
+    labels, scores = predict_fasttext_batch('nsfw', batch.clean(idx))
+    return ~((labels == 'nsfw') & (scores > THRESHOLDS['nsfw']))
+
+def keep_toxic_batch(batch, idx):
+    labels, scores = predict_fasttext_batch('toxic', batch.clean(idx))
+    return ~((labels == 'toxic') & (scores > THRESHOLDS['toxic']))
+
+def keep_quality_batch(batch, idx):
+    labels, scores = predict_fasttext_batch('quality', batch.clean(idx))
+    return ~((labels == 'cc') & (scores > THRESHOLDS['quality']))
+
+FILTER_BATCH_STAGES = [
+    ('rejected_gopher', keep_gopher_batch),
+    ('rejected_lang', keep_lang_batch),
+    ('rejected_nsfw', keep_nsfw_batch),
+    ('rejected_toxic', keep_toxic_batch),
+    ('rejected_quality_model', keep_quality_batch),
+]
+
+# 按顺序执行，返回第一个拒绝该文档的阶段名，全部通过返回 None
+def first_rejection(stages, text):
+    for name, keep in stages:
+        if not keep(text):
+            return name
+    return None
+
+# 批量版本：每个阶段只处理还活着的文档，返回每篇文档被拒绝的阶段名（保留为 None）
+def first_rejection_batch(stages, batch):
+    reasons = np.full(len(batch), None, dtype=object)
+    alive = np.arange(len(batch))
+    for name, keep in stages:
+        if len(alive) == 0:
+            break
+        mask = keep(batch, alive)
+        reasons[alive[~mask]] = name
+        alive = alive[mask]
+    return reasons
+
+class FilterCascade:
+    """根据实测代价和拒绝率自动排序的过滤级联。
+
+    前 warmup 篇文档跑完所有阶段，记录每个阶段的平均耗时 c 和拒绝率 p，
+    之后按 c / p 从小到大执行（又便宜又能拒的先跑），使每篇文档的期望代价最小。
+    文档保留当且仅当所有阶段都通过，与执行顺序无关，所以保留结果和固定顺序完全一致；
+    只是 rejected_* 会记在新顺序中第一个拒绝它的阶段上。
+    """
+
+    def __init__(self, stages, warmup=200):
+        self.stages = list(stages)
+        self.warmup = warmup
+        self.seen = 0
+        self.kept = 0
+        self.cost = [0.0] * len(self.stages)
+        self.rejected = [0] * len(self.stages)
+        self.plan = None
+
+    def run(self, text):
+        if self.plan is not None:
+            return first_rejection(self.plan, text)
+        # 预热：所有阶段都跑一遍，按固定顺序归因
+        reason = None
+        for i, (name, keep) in enumerate(self.stages):
+            start = time.perf_counter()
+            ok = keep(text)
+            self.cost[i] += time.perf_counter() - start
+            if not ok:
+                self.rejected[i] += 1
+                if reason is None:
+                    reason = name
+        self.seen += 1
+        self.kept += reason is None
+        if self.seen >= self.warmup:
+            self.make_plan()
+        return reason
+
+    def run_batch(self, batch):
+        if self.plan is not None:
+            return first_rejection_batch(self.plan, batch)
+        reasons = np.full(len(batch), None, dtype=object)
+        idx = np.arange(len(batch))
+        alive = np.ones(len(batch), dtype=bool)
+        for i, (name, keep) in enumerate(self.stages):
+            start = time.perf_counter()
+            mask = keep(batch, idx)
+            self.cost[i] += time.perf_counter() - start
+            self.rejected[i] += int((~mask).sum())
+            reasons[alive & ~mask] = name
+            alive &= mask
+        self.seen += len(batch)
+        self.kept += int(alive.sum())
+        if self.seen >= self.warmup:
+            self.make_plan()
+        return reasons
+
+    def make_plan(self):
+        def rank(i):
+            cost = self.cost[i] / self.seen
+            reject_rate = self.rejected[i] / self.seen
+            # 从不拒绝的阶段放最后，之间按代价排
+            return (0, cost / reject_rate) if reject_rate > 0 else (1, cost)
+        order = sorted(range(len(self.stages)), key=rank)
+        self.plan = [self.stages[i] for i in order]
+        self.order = order
+        print(f"[pid {os.getpid()}] {self.describe()}")
+
+    # 期望代价：c1 + (1-p1)*c2 + (1-p1)(1-p2)*c3 + ...（假设各阶段相互独立）
+    def expected_cost(self, order):
+        total, survive = 0.0, 1.0
+        for i in order:
+            total += survive * self.cost[i] / self.seen
+            survive *= 1 - self.rejected[i] / self.seen
+        return total
+
+    def describe(self):
+        steps = " -> ".join(
+            f"{self.stages[i][0]}({self.cost[i] / self.seen * 1e3:.3f}ms, 拒绝 {self.rejected[i] / self.seen:.1%})"
+            for i in self.order
+        )
+        kept_rate = max(self.kept, 1) / self.seen
+        fixed_cost = self.expected_cost(range(len(self.stages)))
+        plan_cost = self.expected_cost(self.order)
+        return (f"过滤顺序 ({self.seen} 篇预热): {steps}\n"
+                f"  每篇期望耗时 {fixed_cost * 1e3:.3f}ms -> {plan_cost * 1e3:.3f}ms，"
+                f"每篇保留文档 {plan_cost / kept_rate * 1e3:.3f}ms")
+
+# 过滤一个 WET 流中的所有记录，结果写入 f_out，统计累加到 logging
+# 传入 scores (ScoreWriter) 时每篇文档都跑完所有阶段并记录打分
+def filter_wet_records(stream, f_out, logging, scores=None):
+    buffer = []
+    for record in ArchiveIterator(stream):
+        if record.record_type != WarcRecordType.conversion:
+            continue
+        logging['total_docs'] += 1
+        record_id = record.headers.get('WARC-Record-ID')
+        try:
+            # WET 已经是提取好的文本，但在 fastwarc 中需要 decode回text
+            text = record.reader.read().decode('utf-8', errors='replace')
+        except:
+            logging['read_error'] += 1
+            if scores is not None:
+                scores.add(record_id, STATUS_READ_ERROR)
+            continue
+        if not text.strip():
+            logging['empty'] += 1
+            if scores is not None:
+                scores.add(record_id, STATUS_EMPTY)
+            continue
+        if scores is not None:
+            reason = score_document(record_id, text, scores)
+            if reason is not None:
+                logging[reason] += 1
+            else:
+                write_kept(text, f_out, logging)
+            continue
+        if batch_size > 0:
+            buffer.append(text)
+            if len(buffer) >= batch_size:
+                filter_batch(buffer, f_out, logging)
+                buffer = []
+            continue
+        # Gopher -> Language -> NSFW -> Toxic -> Quality，开启 cascade 时按实测代价重排
+        if cascade is not None:
+            reason = cascade.run(text)
+        else:
+            reason = first_rejection(FILTER_STAGES, text)
+        if reason is not None:
+            logging[reason] += 1
+            continue
+        write_kept(text, f_out, logging)
+    if buffer:
+        filter_batch(buffer, f_out, logging)
+    return logging
+
+# 攒够 batch_size 篇文档后一起过滤，分类器用 fastText 的 list 接口一次预测整批
+def filter_batch(texts, f_out, logging):
+    batch = DocBatch(texts)
+    if cascade is not None:
+        reasons = cascade.run_batch(batch)
+    else:
+        reasons = first_rejection_batch(FILTER_BATCH_STAGES, batch)
+    for text, reason in zip(texts, reasons):
+        if reason is not None:
+            logging[reason] += 1
+        else:
+            write_kept(text, f_out, logging)
+
+def write_kept(text, f_out, logging):
+    write_document(f_out, text)
+    logging['kept'] += 1
+
+# 打分模式：不提前退出，算出 Gopher 统计和所有分类器结果写进 sidecar，
+# 再用和离线扫描同一套 stage_masks 判定，返回第一个拒绝的阶段名
+def score_document(record_id, text, scores):
+    stats = gopher_stats(text)
+    preds = {key: predict_fasttext(key, text) for key in ('lid', 'nsfw', 'toxic', 'quality')}
+    scores.add(record_id, STATUS_OK, stats, preds)
+    for name, mask in stage_masks(scores.last()).items():
+        if not mask[0]:
+            return name
+    return None
+
 # 处理单个文件
+# 先写临时文件，完整写完后再原子地改名，中途崩溃不会留下看起来完整的输出
 def process_wet_file(args):
     input_path, output_path = args
     logging = Counter()
+    tmp_path = output_path + '.tmp'
+    scores = ScoreWriter() if store_scores else None
+    written = []  # 这次运行写出、失败时要删掉的文件
     try:
         with open(input_path, 'rb') as stream, \
-        gzip.open(output_path, 'wt') as f_out:
-            for record in ArchiveIterator(stream):
-                if record.record_type != WarcRecordType.conversion:
-                    continue
-                logging['total_docs'] += 1
-                try:
-                    # WET 已经是提取好的文本，但在 fastwarc 中需要 decode回text
-                    text = record.reader.read().decode('utf-8', errors='replace')
-                except:
-                    logging['read_error'] += 1
-                    continue
-                if not text.strip():
-                    logging['empty'] += 1
-                    continue
-                # 1. Gopher
-                if not test_gopher(text):
-                    logging['rejected_gopher'] += 1
-                    continue
-                # 2. Launguage
-                lang, score = predict_fasttext('lid', text)
-                if lang != 'en' or score < 0.6:
-                    logging['rejected_lang'] += 1
-                    continue
-                # 3. Harmful
-                nsfw_label, nsfw_score = predict_fasttext('nsfw', text)
-                if nsfw_label == 'nsfw' and nsfw_score > 0.6: 
-                    logging['rejected_nsfw'] += 1
-                    continue
-                # Toxic
-                toxic_label, toxic_score = predict_fasttext('toxic', text)
-                if toxic_label == 'toxic' and toxic_score > 0.6: 
-                    logging['rejected_toxic'] += 1
-                    continue
-                # 4. Quality
-                qual_label, qual_score = predict_fasttext('quality', text)
-                # 如果确信是 'cc' (垃圾)就丢掉。
-                if qual_label == 'cc' and qual_score > 0.5: 
-                    logging['rejected_quality_model'] += 1
-                    continue
-                text, _ = mask_emails(text)
-                text, _ = mask_ips(text)
-                text, _ = mask_phone_numbers(text)
-                f_out.write(text.strip() + "\n\n")
-                logging['kept'] += 1
+        gzip.open(tmp_path, 'wt') as f_out:
+            written.append(tmp_path)
+            filter_wet_records(stream, f_out, logging, scores)
+        if scores is not None:
+            sidecar = scores_path(output_path)
+            written += [sidecar + '.tmp', sidecar]
+            scores.save(sidecar, os.path.basename(input_path))
+        os.replace(tmp_path, output_path)
     except Exception as e:
         print(f"Error processing {input_path}: {e}")
+        logging['file_error'] += 1
+        # 不留下不完整的临时文件，也不留下和输出对不上的 sidecar
+        for path in written:
+            if os.path.exists(path):
+                os.remove(path)
         return logging
     
     return logging
-        
 
+# 扫描 WET 文件的 gzip member 边界。CC 的 WET 每条记录单独压缩成一个 member，
+# 所以 member 起点就是记录的字节偏移。返回所有偏移，最后一个元素是文件大小。
+def index_wet_file(input_path, read_size=1 << 20):
+    offsets = [0]
+    member_start = 0  # 当前 member 的起点
+    fed = 0  # 当前 member 已喂给解压器的字节数
+    decomp = zlib.decompressobj(wbits=31)
+    with open(input_path, 'rb') as f:
+        pending = f.read(read_size)
+        while pending:
+            decomp.decompress(pending)
+            if decomp.eof:
+                # member 结束：unused_data 属于下一个 member
+                leftover = decomp.unused_data
+                member_start += fed + len(pending) - len(leftover)
+                offsets.append(member_start)
+                fed = 0
+                decomp = zlib.decompressobj(wbits=31)
+                pending = leftover or f.read(read_size)
+            else:
+                fed += len(pending)
+                pending = f.read(read_size)
+    if offsets[-1] != member_start + fed:
+        # 文件末尾有不完整的 member，也交给最后一个块去处理
+        offsets.append(member_start + fed)
+    return offsets
+
+# 按压缩后的字节数把 WET 文件切成若干记录区间 [start, end)
+def split_wet_file(input_path, chunk_bytes):
+    offsets = index_wet_file(input_path)
+    chunks = []
+    start = offsets[0]
+    for off in offsets[1:]:
+        if off - start >= chunk_bytes:
+            chunks.append((start, off))
+            start = off
+    if start < offsets[-1]:
+        chunks.append((start, offsets[-1]))
+    return chunks
+
+# 处理一个记录区间，输出写到单独的 part 文件
+def process_wet_chunk(args):
+    input_path, start, end, output_path = args
+    logging = Counter()
+    scores = ScoreWriter() if store_scores else None
+    try:
+        with open(input_path, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start)
+        with gzip.open(output_path, 'wt') as f_out:
+            filter_wet_records(io.BytesIO(data), f_out, logging, scores)
+        if scores is not None:
+            scores.save(scores_path(output_path), os.path.basename(input_path))
+    except Exception as e:
+        print(f"Error processing {input_path} [{start}, {end}): {e}")
+        logging['file_error'] += 1
+    return logging
+
+# 按顺序拼接 part 文件（gzip 支持多个 member 直接拼接），同样先写临时文件再改名
+def merge_parts(part_paths, output_path):
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'wb') as f_out:
+        for part in part_paths:
+            with open(part, 'rb') as f_in:
+                shutil.copyfileobj(f_in, f_out)
+    os.replace(tmp_path, output_path)
+    for part in part_paths:
+        os.remove(part)
 
-# CPU并行处理一堆文件
-def main():
-    INPUT_DIR = os.path.join(BASE_DIR, 'data', 'CC')
-    OUTPUT_DIR = os.path.join(BASE_DIR, 'data', 'filtered-0.5')
+# 文件内并行：先给每个文件建记录索引并切块，再把所有块丢进同一个进程池。
+# 块都很小且共享一个任务队列，空闲的进程会立刻领走下一个块，不会因为某个大文件而空等。
+def run_chunked(tasks, max_workers, chunk_bytes, worker_args=(), prefork=False, on_file_done=None,
+                score_store=False):
+    file_stats = {in_path: Counter() for in_path, _ in tasks}
+    file_parts = {}
+    remaining = {}
+    with make_executor(max_workers, worker_args, prefork) as executor:
+        index_futures = {executor.submit(split_wet_file, in_path, chunk_bytes): (in_path, out_path)
+                         for in_path, out_path in tasks}
+        chunk_futures = {}
+        for future in as_completed(index_futures):
+            in_path, out_path = index_futures[future]
+            try:
+                chunks = future.result()
+            except Exception as e:
+                # 索引失败（比如某个 gzip member 损坏）只跳过这个文件，不中断整个运行
+                print(f"Error indexing {in_path}: {e}")
+                file_stats[in_path]['file_error'] += 1
+                continue
+            file_parts[in_path] = [f"{out_path}.part{i:05d}" for i in range(len(chunks))]
+            remaining[in_path] = len(chunks)
+            if not chunks:
+                if score_store:
+                    merge_score_parts([], scores_path(out_path), os.path.basename(in_path))
+                merge_parts([], out_path)
+                if on_file_done is not None:
+                    on_file_done(in_path, out_path, file_stats[in_path])
+            for (start, end), part_path in zip(chunks, file_parts[in_path]):
+                future = executor.submit(process_wet_chunk, (in_path, start, end, part_path))
+                chunk_futures[future] = (in_path, out_path)
+        print(f"共切分为 {len(chunk_futures)} 个记录块")
+        for future in tqdm(as_completed(chunk_futures), total=len(chunk_futures)):
+            in_path, out_path = chunk_futures[future]
+            file_stats[in_path] += future.result()
+            remaining[in_path] -= 1
+            if remaining[in_path] == 0:
+                if file_stats[in_path]['file_error']:
+                    # 有块失败，不发布这个文件的输出，下次重跑
+                    for part in file_parts[in_path]:
+                        for path in (part, scores_path(part)):
+                            if os.path.exists(path):
+                                os.remove(path)
+                    continue
+                score_parts = [scores_path(part) for part in file_parts[in_path]]
+                if all(os.path.exists(part) for part in score_parts):
+                    merge_score_parts(score_parts, scores_path(out_path), os.path.basename(in_path))
+                merge_parts(file_parts[in_path], out_path)
+                if on_file_done is not None:
+                    on_file_done(in_path, out_path, file_stats[in_path])
+        report_worker_memory()
+    return file_stats
+
+# prefork 模式：先在父进程加载一次模型，再用 fork 启动进程池。
+# fastText 的权重矩阵在 C++ 堆上，子进程只读不写，所以这些页在所有 worker 之间写时复制共享，
+# 每个 worker 的 RSS 里虽然算上了它们，PSS 只按 1/N 分摊。
+def make_executor(max_workers, worker_args=(), prefork=False):
+    if not prefork:
+        return ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker, initargs=worker_args)
+    init_worker()
+    # 冻结已有对象，避免子进程里的 GC 扫描父进程对象时把共享页弄脏
+    gc.freeze()
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork'),
+                               initializer=init_worker, initargs=worker_args)
+
+# 从 /proc 读取进程内存 (kB)。RSS 会把共享页重复计入每个进程，PSS 按共享进程数均摊。
+def read_process_memory(pid):
+    mem = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'VmHWM'):
+                mem[key] = int(value.split()[0])
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('Pss', 'Shared_Clean', 'Shared_Dirty'):
+                    mem[key] = int(value.split()[0])
+    except OSError:
+        pass
+    return mem
+
+# 在进程池关闭前调用，打印父进程和每个 worker 的内存占用
+def report_worker_memory():
+    print("\n进程内存 (MB): RSS / 峰值 RSS / PSS / 共享")
+    pids = [('parent', os.getpid())] + [('worker', p.pid) for p in multiprocessing.active_children()]
+    for role, pid in pids:
+        try:
+            mem = read_process_memory(pid)
+        except OSError:
+            continue
+        shared = mem.get('Shared_Clean', 0) + mem.get('Shared_Dirty', 0)
+        print(f"  {role} {pid}: {mem.get('VmRSS', 0) / 1024:.0f} / {mem.get('VmHWM', 0) / 1024:.0f} / "
+              f"{mem.get('Pss', 0) / 1024:.0f} / {shared / 1024:.0f}")
+
+
+# 运行清单：记录每个已完成输入文件的大小/修改时间、输出的 sha256 和统计，用于断点续跑
+MANIFEST_NAME = 'manifest.json'
+
+def load_manifest(output_dir):
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_manifest(output_dir, manifest):
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def input_signature(input_path):
+    st = os.stat(input_path)
+    return {'input_size': st.st_size, 'input_mtime_ns': st.st_mtime_ns}
+
+# 输入没变、输出还在且校验和一致，才算已完成
+def is_completed(manifest, input_path, output_path):
+    entry = manifest.get(os.path.basename(input_path))
+    if entry is None or not os.path.exists(output_path):
+        return False
+    signature = input_signature(input_path)
+    if any(entry.get(k) != v for k, v in signature.items()):
+        return False
+    return entry.get('sha256') == file_sha256(output_path)
+
+def mark_completed(manifest, input_path, output_path, stats):
+    manifest[os.path.basename(input_path)] = {
+        **input_signature(input_path),
+        'output': os.path.basename(output_path),
+        'sha256': file_sha256(output_path),
+        'stats': dict(stats),
+    }
+
+# CPU并行处理一堆文件，返回所有文件（包括跳过的）的统计
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input-dir', default=os.path.join(BASE_DIR, 'data', 'CC'), help='WET 文件目录')
+    parser.add_argument('--output-dir', default=os.path.join(BASE_DIR, 'data', 'filtered-0.5'),
+                        help='过滤结果和运行清单的输出目录')
+    parser.add_argument('--chunked', action='store_true', help='按记录块切分 WET 文件，在文件内部并行')
+    parser.add_argument('--chunk-mb', type=float, default=8, help='每个记录块的压缩字节数 (MB)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='进程数，默认 4；块模式或 prefork 模式下为 CPU 核数')
+    parser.add_argument('--prefork', action='store_true',
+                        help='在父进程加载一次模型后再 fork，worker 之间共享模型内存')
+    parser.add_argument('--cascade-warmup', type=int, default=0,
+                        help='大于 0 时开启自动排序的过滤级联，用前 N 篇文档测代价和拒绝率')
+    parser.add_argument('--batch-size', type=int, default=0,
+                        help='大于 0 时每个进程攒够 N 篇文档再批量跑 fastText')
+    parser.add_argument('--force', action='store_true', help='忽略运行清单，重新处理所有文件')
+    parser.add_argument('--score-store', action='store_true',
+                        help='为每个输入写 .scores.npz，保存所有文档的 Gopher 统计和分类器打分（会关闭提前退出）')
+    args = parser.parse_args(argv)
+
+    INPUT_DIR = args.input_dir
+    OUTPUT_DIR = args.output_dir
     os.makedirs(OUTPUT_DIR, exist_ok=True)
 
     # 扫描得到所有 WET 文件
@@ -108,19 +596,48 @@ def main():
     tasks = []
     for f in wet_files:
         in_path = os.path.join(INPUT_DIR, f)
-        out_path = os.path.join(OUTPUT_DIR, f.replace('.wet.gz', '.filtered.txt.gz'))
+        out_path = os.path.join(OUTPUT_DIR, output_name(f))
         tasks.append((in_path, out_path))
 
     print(f"找到 {len(tasks)} 个 WET 文件，准备处理...")
-    
-    # 并行处理
+
+    # 断点续跑：跳过清单里已经完成的文件，统计直接从清单里取
     total_stats = Counter()
-    # initializer只用加载一次模型，避免Pickling错误
-    with ProcessPoolExecutor(max_workers=4, initializer=init_worker) as executor:
-        futures = {executor.submit(process_wet_file, task): task for task in tasks}
-        for future in tqdm(as_completed(futures), total=len(tasks)):
-            file_stats = future.result()
-            total_stats += file_stats
+    manifest = {} if args.force else load_manifest(OUTPUT_DIR)
+    pending = []
+    for in_path, out_path in tasks:
+        missing_scores = args.score_store and not os.path.exists(scores_path(out_path))
+        if not missing_scores and is_completed(manifest, in_path, out_path):
+            total_stats += Counter(manifest[os.path.basename(in_path)]['stats'])
+        else:
+            manifest.pop(os.path.basename(in_path), None)
+            pending.append((in_path, out_path))
+    if len(pending) < len(tasks):
+        print(f"跳过 {len(tasks) - len(pending)} 个已完成的文件，剩余 {len(pending)} 个")
+    tasks = pending
+
+    def on_file_done(in_path, out_path, stats):
+        mark_completed(manifest, in_path, out_path, stats)
+        save_manifest(OUTPUT_DIR, manifest)
+
+    # 并行处理
+    worker_args = (args.cascade_warmup, args.batch_size, args.score_store)
+    max_workers = args.workers or (os.cpu_count() if args.chunked or args.prefork else 4)
+    if args.chunked:
+        file_stats = run_chunked(tasks, max_workers, int(args.chunk_mb * (1 << 20)), worker_args, args.prefork,
+                                 on_file_done, args.score_store)
+        for stats in file_stats.values():
+            total_stats += stats
+    else:
+        # initializer只用加载一次模型，避免Pickling错误
+        with make_executor(max_workers, worker_args, args.prefork) as executor:
+            futures = {executor.submit(process_wet_file, task): task for task in tasks}
+            for future in tqdm(as_completed(futures), total=len(tasks)):
+                file_stats = future.result()
+                total_stats += file_stats
+                if not file_stats['file_error']:
+                    on_file_done(*futures[future], file_stats)
+            report_worker_memory()
 
     print("\n" + "="*30)
     print("过滤统计报告")
@@ -131,6 +648,10 @@ def main():
     if total_stats['total_docs'] > 0:
         kept_ratio = total_stats['kept'] / total_stats['total_docs'] * 100
         print(f"保留率: {kept_ratio:.2f}%")
+    if args.cascade_warmup > 0:
+        print("注：开启 cascade 时 rejected_* 记在各 worker 实测顺序中第一个拒绝的阶段上，"
+              "随文档在 worker 之间的调度而变化；kept 和输出不受影响")
+    return total_stats
 
 if __name__ == "__main__":
     main()
@@ -1,7 +1,11 @@
 import resiliparse.extract.html2text
 from resiliparse.parse.encoding import detect_encoding
-import fasttext
-import os
+import numpy as np
+try:
+    from .model_registry import get_model
+except ImportError:
+    # 以脚本方式运行时（python cs336_data/pipeline.py），cs336_data 不是包
+    from model_registry import get_model
 
 # uv run pytest -k test_extract_text_from_html_bytes 
 def extract_text_from_html_bytes(html_bytes: bytes) -> str:
@@ -16,49 +20,146 @@ def extract_text_from_html_bytes(html_bytes: bytes) -> str:
     )
     return text
 
-language_model_path = "cs336_data/data/classifiers/lid.176.bin"
-language_model = fasttext.load_model(language_model_path)
+# 批量预测：一次 multiline predict 处理整批文本。
+# normalised=True 表示 texts 已经把换行换成了空格（例如 pipeline 里多个模型共用的同一份缓冲），不再重复替换。
+# k=1 时返回一维的 labels / scores；k>1 时形状为 (n, k)，不足 k 个的位置用 '' 和 0 补齐。
+def predict_batch(model_key, texts, k=1, normalised=False):
+    if not normalised:
+        texts = [text.replace('\n', ' ') for text in texts]
+    n = len(texts)
+    if n == 0:
+        shape = (0,) if k == 1 else (0, k)
+        return np.empty(shape, dtype=str), np.empty(shape, dtype=np.float64)
+    all_labels, all_scores = get_model(model_key).predict(texts, k=k)
+    prefix = len('__label__')
+    if k == 1:
+        labels = np.array([label[0][prefix:] if label else '' for label in all_labels])
+        scores = np.fromiter((score[0] if len(score) else 0.0 for score in all_scores), dtype=np.float64, count=n)
+        return labels, scores
+    labels = np.full((n, k), '', dtype=object)
+    scores = np.zeros((n, k), dtype=np.float64)
+    for i, (label, score) in enumerate(zip(all_labels, all_scores)):
+        m = len(label)
+        labels[i, :m] = [name[prefix:] for name in label]
+        scores[i, :m] = score[:m]
+    return labels.astype(str), scores
+
 # uv run pytest -k test_identify_language
 def identify_language(text: str) -> tuple[str, float]:
     if not text or not text.strip(): return None
     clean_text = text.replace('\n', ' ')
-    label_list, score_list = language_model.predict(clean_text, k=1)
+    label_list, score_list = get_model('lid').predict(clean_text, k=1)
     label, score = label_list[0], score_list[0]
     # label: __label__en
     lang_label = label.replace("__label__", "")
     return lang_label, score
 
+# 批量版本，返回 (labels, scores) 两个 NumPy 数组
+def identify_language_batch(texts, k=1, normalised=False):
+    return predict_batch('lid', texts, k, normalised)
+
 # uv run pytest -k test_mask_emails
 import re 
+EMAIL_PATTERN = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b'
+PHONE_PATTERN = r'(?:\(?\d{3}\)?[\s.-]?)\d{3}[\s.-]?\d{4}'
+IP_PATTERN = r'\b(?:25[0-5]|2[0-4]\d|1\d{2}|[1-9]?\d)(?:\.(?:25[0-5]|2[0-4]\d|1\d{2}|[1-9]?\d)){3}\b'
+_EMAIL_RE = re.compile(EMAIL_PATTERN)
+_PHONE_RE = re.compile(PHONE_PATTERN)
+_IP_RE = re.compile(IP_PATTERN)
+
 def mask_emails(string: str) -> tuple[str, int]:
-    email_pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b'
-    new_text, num = re.subn(email_pattern, "|||EMAIL_ADDRESS|||", string)
+    new_text, num = _EMAIL_RE.subn("|||EMAIL_ADDRESS|||", string)
     return new_text, num 
 
 # uv run pytest -k test_mask_phones
 def mask_phone_numbers(text: str) -> tuple[str, int]:
-    phone_pattern = r'(?:\(?\d{3}\)?[\s.-]?)\d{3}[\s.-]?\d{4}'
-    new_text, count = re.subn(phone_pattern, "|||PHONE_NUMBER|||", text)
+    new_text, count = _PHONE_RE.subn("|||PHONE_NUMBER|||", text)
     return new_text, count
 
 
 # uv run pytest -k test_mask_ips
 def mask_ips(text: str) -> tuple[str, int]:
-    ip_pattern = r'\b(?:25[0-5]|2[0-4]\d|1\d{2}|[1-9]?\d)(?:\.(?:25[0-5]|2[0-4]\d|1\d{2}|[1-9]?\d)){3}\b'
-    new_text, count = re.subn(ip_pattern, "|||IP_ADDRESS|||", text)
+    new_text, count = _IP_RE.subn("|||IP_ADDRESS|||", text)
     return new_text, count
 
-# 加载模型
-base_dir = os.path.dirname(os.path.abspath(__file__)) # 当前文件的运行绝对路径的目录
-nsfw_model_path = os.path.join(base_dir, "data", "classifiers", "jigsaw_fasttext_bigrams_nsfw_final.bin")
-nsfw_model = fasttext.load_model(nsfw_model_path)
-hate_model_path = os.path.join(base_dir, "data", "classifiers", "jigsaw_fasttext_bigrams_hatespeech_final.bin")
-hate_model = fasttext.load_model(hate_model_path)
+# 一次调用脱敏所有类别，结果和依次调用 mask_emails、mask_ips、mask_phone_numbers 完全一致
+# （email 优先，重叠的电话不会吃掉 email 的一部分）。先用便宜的预筛判断每个类别是否可能出现，
+# 不可能的类别整个跳过，可能的类别从最早可能的匹配起点开始扫描。
+PII_MASKS = {
+    'email': "|||EMAIL_ADDRESS|||",
+    'ip': "|||IP_ADDRESS|||",
+    'phone': "|||PHONE_NUMBER|||",
+}
+# 预筛用的必要条件，都以字面字符开头，re 能直接跳过不可能的位置，比完整模式快一个数量级：
+# email 的 @ 及之后部分和完整模式一样；ip 一定含有 \d\.\d{1,3}\.\d，电话一定含有 \d{3}\)?[\s.-]?\d{3}
+_EMAIL_DOMAIN_RE = re.compile(r'@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b')
+_DIGIT_PII_RE = re.compile(r'\d(?:\.\d{1,3}\.\d|\d\d\)?[\s.-]?\d{3})')
+_EMAIL_LOCAL_CHARS = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789._%+-')
+
+# email 最早可能的起点；不可能有 email 时返回 None
+def _email_start(text):
+    if '@' not in text:
+        return None
+    m = _EMAIL_DOMAIN_RE.search(text)
+    if m is None:
+        return None
+    # email 的本地部分不含空白等字符，从第一个可能的 @ 往前找到它的起点
+    i = m.start()
+    while i > 0 and text[i - 1] in _EMAIL_LOCAL_CHARS:
+        i -= 1
+    return i
+
+# ip 和电话最早可能的起点；都不可能出现时返回 None
+def _digit_pii_start(text):
+    m = _DIGIT_PII_RE.search(text)
+    if m is None:
+        return None
+    # ip 的第一段最多 3 位、电话前面最多一个 '('，真正的匹配不会早于这里
+    return max(m.start() - 3, 0)
+
+# 等价于 regex.subn(mask, text)，只是从 start 开始找。
+# 用 finditer(text, start) 而不是切片，这样 \b 仍然能看到 start 前面的字符
+def _mask_from(regex, mask, text, start):
+    parts = []
+    last = 0
+    for m in regex.finditer(text, start):
+        parts.append(text[last:m.start()])
+        parts.append(mask)
+        last = m.end()
+    if not parts:
+        return text, 0
+    parts.append(text[last:])
+    return ''.join(parts), len(parts) // 2
+
+def mask_pii(text: str) -> tuple[str, dict]:
+    """返回脱敏后的文本和每个类别的替换次数"""
+    counts = dict.fromkeys(PII_MASKS, 0)
+    start = _email_start(text)
+    if start is not None:
+        text, counts['email'] = _mask_from(_EMAIL_RE, PII_MASKS['email'], text, start)
+    # 掩码里没有数字，email 脱敏不会拼出新的 ip 或电话，预筛在脱敏后的文本上做
+    start = _digit_pii_start(text)
+    if start is not None:
+        # ip 的匹配都在 start 之后，前面的文本不变，start 对电话仍然成立
+        text, counts['ip'] = _mask_from(_IP_RE, PII_MASKS['ip'], text, start)
+        text, counts['phone'] = _mask_from(_PHONE_RE, PII_MASKS['phone'], text, start)
+    return text, counts
+
+# 批量版本：返回脱敏后的文本列表，以及 {类别: 每篇文档的替换次数数组}
+def mask_pii_batch(texts):
+    masked = []
+    counts = {name: np.zeros(len(texts), dtype=np.int64) for name in PII_MASKS}
+    for i, text in enumerate(texts):
+        text, doc_counts = mask_pii(text)
+        masked.append(text)
+        for name, count in doc_counts.items():
+            counts[name][i] = count
+    return masked, counts
 
 # uv run pytest -k test_classify_nsfw
 def classify_nsfw_speech(text: str) -> tuple[str, float]:
     clean_text = text.replace('\n', ' ')
-    labels, scores = nsfw_model.predict(clean_text, k=1)
+    labels, scores = get_model('nsfw').predict(clean_text, k=1)
     label = labels[0].replace('__label__', '')
     score = scores[0]
     return label, score 
@@ -67,40 +168,117 @@ def classify_nsfw_speech(text: str) -> tuple[str, float]:
 # uv run pytest -k test_classify_toxic_speech
 def classify_toxic_speech(text: str) -> tuple[str, float]:
     clean_text = text.replace('\n', ' ')
-    labels, scores = hate_model.predict(clean_text, k=1)
+    labels, scores = get_model('toxic').predict(clean_text, k=1)
     label = labels[0].replace('__label__', '')
     score = scores[0]
     return label, score 
 
+def classify_nsfw_speech_batch(texts, k=1, normalised=False):
+    return predict_batch('nsfw', texts, k, normalised)
+
+def classify_toxic_speech_batch(texts, k=1, normalised=False):
+    return predict_batch('toxic', texts, k, normalised)
+
 # uv run pytest -k test_gopher
-import nltk
-def test_gopher(text: str) -> bool:
-    try:
-        words = nltk.word_tokenize(text)
-    except LookupError:
-        nltk.download('punkt')
-        nltk.download('punkt_tab')
-        words = nltk.word_tokenize(text)
+# 用一个编译好的正则近似 nltk.word_tokenize（Treebank 规则）：
+# 标点、引号、破折号单独成词，句点只在词尾拆开，'s / 'll 之类的缩写单独成词，
+# 逗号和冒号后面跟数字时留在词里（3,000 / 10:30）。
+# 在测试 fixtures 上和 NLTK 的词数、平均词长、含字母词占比对齐（见 tests/test_quality.py），
+# 差别只在 cannot 这类少数缩写和依赖 punkt 断句的句点上。
+_GOPHER_PUNCT = r";@#$%&?!()\[\]{}<>\"*«»“”‘’„\u2012-\u2015`"
+_GOPHER_TOKEN_RE = re.compile(rf"""
+    \.{{2,}}
+  | --
+  | `+
+  | [{_GOPHER_PUNCT}]
+  | [,:](?!\d)
+  | '[^\s{_GOPHER_PUNCT},:'.]*
+  | (?:[^\s{_GOPHER_PUNCT},:'.-] | [,:](?=\d) | \.(?=[^\s.]) | -(?!-))+
+  | \.
+""", re.X)
+# 每个词占一行时，匹配含字母的行
+_ALPHA_TOKEN_RE = re.compile(r"^[^\n]*?[^\W\d_]", re.M)
+_WHITESPACE_RE = re.compile(r"\s")
+# 长文档按段分词，段边界落在空白上，这样可以在词数超限时提前停下
+_GOPHER_SEGMENT = 1 << 17
+
+# 返回 (词数, 词长总和, 含字母的词数)；给了 max_words 时，超过后立刻返回
+def _scan_gopher_tokens(text, max_words=None):
+    num_words = total_len = alpha_words = 0
+    start, n = 0, len(text)
+    while start < n:
+        end = start + _GOPHER_SEGMENT
+        if end < n:
+            ws = _WHITESPACE_RE.search(text, end)
+            end = ws.start() if ws else n
+        else:
+            end = n
+        tokens = _GOPHER_TOKEN_RE.findall(text, start, end)
+        num_words += len(tokens)
+        # NLTK 会把 " 改写成 `` 或 ''，长度按 2 算
+        total_len += sum(map(len, tokens)) + tokens.count('"')
+        matches = _ALPHA_TOKEN_RE.findall('\n'.join(tokens))
+        if ''.join([m[-1] for m in matches]).isalpha():
+            alpha_words += len(matches)
+        else:
+            # [^\W\d_] 还会匹配 ½、² 这类非十进制数字字符，少见，逐词按 isalpha 重算
+            alpha_words += sum(1 for w in tokens if any(c.isalpha() for c in w))
+        if max_words is not None and num_words > max_words:
+            break
+        start = end
+    return num_words, total_len, alpha_words
+
+def _ellipsis_frac(text):
+    lines = text.splitlines()
+    if not lines:
+        return 0.0
+    return sum(1 for line in lines if line.rstrip().endswith('...')) / len(lines)
+
+# Gopher 规则用到的统计量：词数、平均词长、以 ... 结尾的行占比、含字母的词占比
+def gopher_stats(text: str) -> dict:
+    num_words, total_len, alpha_words = _scan_gopher_tokens(text)
+    stats = {'num_words': num_words, 'mean_word_len': 0.0, 'ellipsis_frac': _ellipsis_frac(text), 'alpha_frac': 0.0}
+    if num_words > 0:
+        stats['mean_word_len'] = total_len / num_words
+        stats['alpha_frac'] = alpha_words / num_words
+    return stats
+
+# 只用 & 组合，标量和 NumPy 数组（离线阈值扫描）都能用
+def gopher_passes(stats):
     # Rule 1
-    num_words = len(words)
-    if num_words < 50 or num_words > 100000:
-        return False 
+    ok = (stats['num_words'] >= 50) & (stats['num_words'] <= 100000)
     # Rule 2
-    total_characters = sum(len(w) for w in words)
-    avg_characters = total_characters / num_words
-    if not (3 <= avg_characters <= 10):
-        return False
+    ok = ok & (stats['mean_word_len'] >= 3) & (stats['mean_word_len'] <= 10)
     # Rule 3
-    lines = text.splitlines()
-    if len(lines) > 0:
-        target_lines_num = sum(1 for line in lines if line.strip().endswith('...'))
-        if target_lines_num / len(lines) > 0.3: return False
-    alphabets_num = sum(1 for w in words if any(c.isalpha() for c in w))
-    if alphabets_num / num_words < 0.8: return False
-    return True 
-
-# uv run pytest -k test_classify_quality
-    
+    ok = ok & (stats['ellipsis_frac'] <= 0.3)
+    # Rule 4
+    ok = ok & (stats['alpha_frac'] >= 0.8)
+    return ok
 
+# 和 gopher_passes(gopher_stats(text)) 结果一致，但能提前判死的规则先算，不用分完整篇文档
+def test_gopher(text: str) -> bool:
+    # Rule 3 只看行，最便宜
+    if _ellipsis_frac(text) > 0.3:
+        return False
+    # 每个词至少一个字符，字符数不到 50 不可能有 50 个词
+    if len(text) < 50:
+        return False
+    # 词数超过上限后不再继续分词
+    num_words, total_len, alpha_words = _scan_gopher_tokens(text, max_words=100000)
+    if not 50 <= num_words <= 100000:
+        return False
+    return 3 <= total_len / num_words <= 10 and alpha_words / num_words >= 0.8
 
+# uv run pytest -k test_classify_quality
+# 质量分类器的标签是 hq / cc，对外统一成 wiki / cc
+def classify_quality(text: str) -> tuple[str, float]:
+    clean_text = text.replace('\n', ' ')
+    labels, scores = get_model('quality').predict(clean_text)
+    label = labels[0].replace('__label__', '')
+    final_label = 'wiki' if label == 'hq' else 'cc'
+    score = scores[0]
+    return final_label, score
 
+def classify_quality_batch(texts, k=1, normalised=False):
+    labels, scores = predict_batch('quality', texts, k, normalised)
+    return np.where(labels == 'hq', 'wiki', np.where(labels == '', '', 'cc')), scores
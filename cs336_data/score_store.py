@@ -0,0 +1,239 @@
+"""每篇文档的打分 sidecar，以及基于它的离线阈值扫描。
+
+`pipeline.py --score-store` 会为每个输入 WET 文件额外写一个 `<name>.scores.npz`，
+按列保存所有 conversion 记录（包括被拒绝的）的 WARC-Record-ID、Gopher 统计量和四个分类器的标签/分数。
+之后调阈值不用再跑模型：
+
+    # 对一组阈值统计保留率和各阶段拒绝数
+    python cs336_data/score_store.py sweep data/filtered-0.5 --quality 0.5,0.7,0.9
+    # 按选定的阈值直接从 WET 里导出过滤结果
+    python cs336_data/score_store.py materialise data/filtered-0.5 data/CC data/filtered-0.9 --quality 0.9
+"""
+import os
+import gzip
+import argparse
+import itertools
+import numpy as np
+from fastwarc.warc import ArchiveIterator, WarcRecordType
+try:
+    from .preprocessing import gopher_passes, mask_pii
+    from .deduplication import write_jsonl_record
+except ImportError:
+    from preprocessing import gopher_passes, mask_pii
+    from deduplication import write_jsonl_record
+
+# 默认阈值，与 pipeline.py 的过滤阶段一致
+THRESHOLDS = {'lang': 0.6, 'nsfw': 0.6, 'toxic': 0.6, 'quality': 0.5}
+
+# 记录状态
+STATUS_OK = 0
+STATUS_READ_ERROR = 1
+STATUS_EMPTY = 2
+
+# 与 pipeline.FILTER_STAGES 的固定顺序一致
+STAGE_NAMES = ['rejected_gopher', 'rejected_lang', 'rejected_nsfw', 'rejected_toxic', 'rejected_quality_model']
+GOPHER_COLUMNS = ['num_words', 'mean_word_len', 'ellipsis_frac', 'alpha_frac']
+MODEL_KEYS = ['lid', 'nsfw', 'toxic', 'quality']
+
+SCORES_SUFFIX = '.scores.npz'
+# 过滤结果：每行一篇 {"text": ...}，即 deduplication 的 'jsonl' 格式
+OUTPUT_SUFFIX = '.filtered.jsonl.gz'
+
+def output_name(wet_name):
+    return wet_name.replace('.wet.gz', OUTPUT_SUFFIX)
+
+def scores_path(output_path):
+    if output_path.endswith(OUTPUT_SUFFIX):
+        output_path = output_path[:-len(OUTPUT_SUFFIX)]
+    return output_path + SCORES_SUFFIX
+
+# PII 脱敏后写入一篇保留的文档，pipeline 和 materialise 共用。
+# 网页正文的段落之间有空行，用 JSONL 而不是空行分隔，下游按文档读取时不会把段落拆成多篇
+def write_document(f_out, text):
+    text, _ = mask_pii(text)
+    write_jsonl_record(f_out, text.strip())
+
+
+class ScoreWriter:
+    """逐篇追加打分，最后按列存成一个 npz。"""
+
+    def __init__(self):
+        self.rows = {name: [] for name in ['record_id', 'status'] + GOPHER_COLUMNS}
+        for key in MODEL_KEYS:
+            self.rows[f'{key}_label'] = []
+            self.rows[f'{key}_score'] = []
+
+    def __len__(self):
+        return len(self.rows['status'])
+
+    def add(self, record_id, status, stats=None, preds=None):
+        self.rows['record_id'].append(record_id or '')
+        self.rows['status'].append(status)
+        for name in GOPHER_COLUMNS:
+            self.rows[name].append(stats[name] if stats else 0)
+        for key in MODEL_KEYS:
+            label, score = preds[key] if preds else (None, np.nan)
+            self.rows[f'{key}_label'].append(label or '')
+            self.rows[f'{key}_score'].append(score)
+
+    # 最后一篇文档的打分，每列是长度为 1 的数组
+    def last(self):
+        return {name: np.array(values[-1:]) for name, values in self.rows.items()}
+
+    def columns(self):
+        cols = {}
+        for name, values in self.rows.items():
+            if name == 'status':
+                cols[name] = np.array(values, dtype=np.int8)
+            elif name == 'num_words':
+                cols[name] = np.array(values, dtype=np.int64)
+            elif name == 'record_id' or name.endswith('_label'):
+                cols[name] = np.array(values, dtype=str)
+            else:
+                cols[name] = np.array(values, dtype=np.float64)
+        return cols
+
+    def save(self, path, source):
+        save_columns(path, self.columns(), source)
+
+
+def save_columns(path, cols, source):
+    with open(path + '.tmp', 'wb') as f:
+        np.savez_compressed(f, source=np.array(source), **cols)
+    os.replace(path + '.tmp', path)
+
+def load_scores(path):
+    with np.load(path) as data:
+        source = str(data['source'])
+        cols = {name: data[name] for name in data.files if name != 'source'}
+    return source, cols
+
+# 按顺序把若干 part 的 sidecar 拼成一个文件（块模式用）
+def merge_score_parts(part_paths, path, source):
+    parts = [load_scores(p)[1] for p in part_paths]
+    if parts:
+        cols = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+    else:
+        cols = ScoreWriter().columns()
+    save_columns(path, cols, source)
+    for p in part_paths:
+        os.remove(p)
+
+
+# 每个阶段的保留掩码，和 pipeline 的判定完全一致
+def stage_masks(cols, thresholds=THRESHOLDS):
+    thresholds = {**THRESHOLDS, **thresholds}
+    return {
+        'rejected_gopher': gopher_passes(cols),
+        'rejected_lang': (cols['lid_label'] == 'en') & (cols['lid_score'] >= thresholds['lang']),
+        'rejected_nsfw': ~((cols['nsfw_label'] == 'nsfw') & (cols['nsfw_score'] > thresholds['nsfw'])),
+        'rejected_toxic': ~((cols['toxic_label'] == 'toxic') & (cols['toxic_score'] > thresholds['toxic'])),
+        'rejected_quality_model': ~((cols['quality_label'] == 'cc') & (cols['quality_score'] > thresholds['quality'])),
+    }
+
+# 按固定顺序把每篇文档归到第一个拒绝它的阶段，返回和 pipeline 同样格式的统计以及保留掩码
+def evaluate(cols, thresholds=THRESHOLDS):
+    status = cols['status']
+    stats = {
+        'total_docs': len(status),
+        'read_error': int((status == STATUS_READ_ERROR).sum()),
+        'empty': int((status == STATUS_EMPTY).sum()),
+    }
+    alive = status == STATUS_OK
+    for name, mask in stage_masks(cols, thresholds).items():
+        stats[name] = int((alive & ~mask).sum())
+        alive &= mask
+    stats['kept'] = int(alive.sum())
+    return stats, alive
+
+
+def load_score_dir(scores_dir):
+    paths = sorted(os.path.join(scores_dir, f) for f in os.listdir(scores_dir) if f.endswith(SCORES_SUFFIX))
+    return [(path, *load_scores(path)) for path in paths]
+
+def sweep(scores_dir, grid):
+    """grid: {'quality': [0.5, 0.9], ...}，返回每组阈值的统计"""
+    loaded = load_score_dir(scores_dir)
+    names = list(grid)
+    cols = {name: np.concatenate([c[name] for _, _, c in loaded]) for name in loaded[0][2]} if loaded else None
+    results = []
+    for values in itertools.product(*(grid[name] for name in names)):
+        thresholds = dict(zip(names, values))
+        stats, _ = evaluate(cols, thresholds) if cols else ({'total_docs': 0, 'kept': 0}, None)
+        stats['retention'] = stats['kept'] / stats['total_docs'] if stats['total_docs'] else 0.0
+        results.append(({**THRESHOLDS, **thresholds}, stats))
+    return results
+
+# 不重跑任何模型，按给定阈值从原始 WET 中导出保留的文档
+def materialise(scores_dir, wet_dir, output_dir, thresholds=THRESHOLDS):
+    os.makedirs(output_dir, exist_ok=True)
+    total = {}
+    for path, source, cols in load_score_dir(scores_dir):
+        stats, keep = evaluate(cols, thresholds)
+        for k, v in stats.items():
+            total[k] = total.get(k, 0) + v
+        out_path = os.path.join(output_dir, output_name(source))
+        try:
+            with open(os.path.join(wet_dir, source), 'rb') as stream, \
+            gzip.open(out_path + '.tmp', 'wt') as f_out:
+                idx = 0
+                for record in ArchiveIterator(stream):
+                    if record.record_type != WarcRecordType.conversion:
+                        continue
+                    # WET 里的记录比 sidecar 多，说明两者不是同一次运行的
+                    if idx >= len(keep):
+                        raise ValueError(f"{path} 与 {source} 的第 {idx} 条记录不匹配")
+                    if keep[idx]:
+                        record_id = record.headers.get('WARC-Record-ID')
+                        if record_id != cols['record_id'][idx]:
+                            raise ValueError(f"{path} 与 {source} 的第 {idx} 条记录不匹配")
+                        text = record.reader.read().decode('utf-8', errors='replace')
+                        write_document(f_out, text)
+                    idx += 1
+            if idx != len(keep):
+                raise ValueError(f"{path} 与 {source} 的第 {idx} 条记录不匹配")
+            os.replace(out_path + '.tmp', out_path)
+        finally:
+            if os.path.exists(out_path + '.tmp'):
+                os.remove(out_path + '.tmp')
+    return total
+
+
+def parse_grid(args):
+    grid = {}
+    for key in THRESHOLDS:
+        value = getattr(args, key)
+        if value is not None:
+            grid[key] = [float(v) for v in value.split(',')]
+    return grid
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_sweep = sub.add_parser('sweep', help='统计一组阈值下的保留率和各阶段拒绝数')
+    p_sweep.add_argument('scores_dir')
+    p_mat = sub.add_parser('materialise', help='按选定阈值导出过滤结果')
+    p_mat.add_argument('scores_dir')
+    p_mat.add_argument('wet_dir')
+    p_mat.add_argument('output_dir')
+    for p in (p_sweep, p_mat):
+        for key in THRESHOLDS:
+            p.add_argument(f'--{key}', default=None, help=f'{key} 阈值，sweep 时可用逗号分隔多个值')
+    args = parser.parse_args()
+    grid = parse_grid(args)
+
+    if args.command == 'sweep':
+        header = list(THRESHOLDS) + ['kept', 'retention'] + STAGE_NAMES
+        print('\t'.join(header))
+        for thresholds, stats in sweep(args.scores_dir, grid):
+            row = [f"{thresholds[k]:g}" for k in THRESHOLDS]
+            row += [str(stats['kept']), f"{stats['retention']:.2%}"] + [str(stats.get(n, 0)) for n in STAGE_NAMES]
+            print('\t'.join(row))
+    else:
+        thresholds = {k: v[0] for k, v in grid.items()}
+        total = materialise(args.scores_dir, args.wet_dir, args.output_dir, thresholds)
+        for k, v in total.items():
+            print(f"{k}: {v}")
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 import gzip
 import random
 from fastwarc.warc import ArchiveIterator
-from preprocessing import extract_text_from_html_bytes, identify_language
+from preprocessing import extract_text_from_html_bytes, identify_language_batch
 
 warc_path = "cs336_data/data/CC/CC-MAIN-20250417135010-20250417165010-00065.warc.gz"
 
@@ -16,8 +16,9 @@ def analyze_warc_languages():
     print(f"Reading {warc_path}...")
     
     try:
+        texts = []
         with gzip.open(warc_path, 'rb') as stream:
-            # 流式读取
+            # 流式读取，先收集文本，再一次性批量识别语言
             for record in ArchiveIterator(stream):
                 # 考虑response内容
                 if record.record_type.name == 'response':
@@ -27,24 +28,25 @@ def analyze_warc_languages():
                     text = extract_text_from_html_bytes(content_bytes)
                     if not text.strip():
                         continue
-                    lang, score = identify_language(text)
-                    
-                    records_processed += 1
-                    if lang == 'en':
-                        english_count += 1
-                    
-                    # 3. 收集 20 个样本进行人工检查
-                    if len(samples_to_inspect) < 20:
-                         samples_to_inspect.append((text, lang, score))
-                    else:
-                        # 简单的随机替换，保证看后面的一些数据
-                        if random.random() < 0.05:
-                            idx = random.randint(0, 19)
-                            samples_to_inspect[idx] = (text, lang, score)
-
-                    if records_processed >= 1000: 
+                    texts.append(text)
+                    if len(texts) >= 1000:
                         break
 
+        langs, scores = identify_language_batch(texts)
+        for text, lang, score in zip(texts, langs, scores):
+            records_processed += 1
+            if lang == 'en':
+                english_count += 1
+
+            # 3. 收集 20 个样本进行人工检查
+            if len(samples_to_inspect) < 20:
+                 samples_to_inspect.append((text, lang, score))
+            else:
+                # 简单的随机替换，保证看后面的一些数据
+                if random.random() < 0.05:
+                    idx = random.randint(0, 19)
+                    samples_to_inspect[idx] = (text, lang, score)
+
         # 打印统计结果
         print(f"\n--- Statistics (based on first {records_processed} docs) ---")
         if records_processed > 0:
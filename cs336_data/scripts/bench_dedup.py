@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import shutil
+import string
+import argparse
+import itertools
+import multiprocessing as mp
+import numpy as np
+from deduplication import exact_line_deduplication, minhash_deduplication, peak_rss_mb
+
+# 去重的基准测试：生成带已知重复簇的合成语料，跑 exact_line_deduplication 和 minhash_deduplication，
+# 记录 docs/sec、峰值 RSS、候选对数，以及相对真值的 precision/recall，结果写成 JSON。
+#   python cs336_data/scripts/bench_dedup.py --num-docs 1000,10000 --edit-rate 0,0.02 --boilerplate 0.1 \
+#       --output bench.json
+#
+# 语料：先生成 num_docs * (1 - dup_frac) 篇原始文档，其余的文档是从原始文档复制后逐词编辑（替换/删除/插入，
+# 比例 edit_rate）得到的近重复，每个簇最多 cluster_size 篇，打乱顺序写出。每行以 boilerplate 的概率取自
+# 一个固定的模板行池（复制时不编辑），模拟导航栏、版权声明之类的重复行。
+# 真值：
+#   minhash: 每个簇应该只留一篇。簇里删掉的文档最多 k - 1 篇算对，多删的算误删，少删的算漏删；
+#   line: 模板行应该全部删掉（boilerplate_recall），其余的行删掉的比例记为 content_removed。
+# 每次运行在单独的 spawn 进程里做，峰值 RSS 只反映这一次运行。
+
+WORDS_PER_LINE = 12
+BOILERPLATE_POOL = 50
+
+def make_vocab(rng, size):
+    letters = np.array(list(string.ascii_lowercase))
+    lengths = rng.integers(3, 10, size)
+    return [''.join(rng.choice(letters, n)) for n in lengths]
+
+def edit_words(rng, words, vocab, edit_rate):
+    out = []
+    for word in words:
+        r = rng.random()
+        if r < edit_rate / 3:
+            continue
+        if r < 2 * edit_rate / 3:
+            out.append(vocab[rng.integers(len(vocab))])
+        elif r < edit_rate:
+            out.extend([word, vocab[rng.integers(len(vocab))]])
+        else:
+            out.append(word)
+    return out
+
+def make_corpus(out_dir, num_docs, dup_frac=0.3, cluster_size=4, edit_rate=0.02, boilerplate=0.1,
+                doc_lines=20, vocab_size=20000, seed=0):
+    """生成语料，返回真值 dict（同时写到 out_dir/truth.json）"""
+    rng = np.random.default_rng(seed)
+    vocab = make_vocab(rng, vocab_size)
+    # Zipf 分布的词频
+    weights = 1 / np.arange(1, vocab_size + 1)
+    weights /= weights.sum()
+
+    def random_line():
+        return ' '.join(vocab[i] for i in rng.choice(vocab_size, WORDS_PER_LINE, p=weights))
+
+    pool = [random_line() for _ in range(BOILERPLATE_POOL)]
+    num_originals = max(num_docs - int(num_docs * dup_frac), 1)
+    docs, clusters = [], []
+    for c in range(num_originals):
+        docs.append([pool[rng.integers(BOILERPLATE_POOL)] if rng.random() < boilerplate else random_line()
+                     for _ in range(doc_lines)])
+        clusters.append(c)
+    # 近重复分到随机挑选的原始文档上，每簇最多 cluster_size 篇
+    sizes = np.ones(num_originals, dtype=np.int64)
+    boiler = set(pool)
+    while len(docs) < num_docs:
+        c = int(rng.integers(num_originals))
+        if sizes[c] >= cluster_size:
+            continue
+        sizes[c] += 1
+        lines = [line if line in boiler else ' '.join(edit_words(rng, line.split(), vocab, edit_rate))
+                 for line in docs[c]]
+        docs.append(lines)
+        clusters.append(c)
+
+    os.makedirs(out_dir, exist_ok=True)
+    order = rng.permutation(len(docs))
+    names = []
+    for i, idx in enumerate(order):
+        name = f'doc{i:07d}.txt'
+        with open(os.path.join(out_dir, name), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(docs[idx]) + '\n')
+        names.append(name)
+    truth = {'names': names, 'clusters': [clusters[idx] for idx in order], 'boilerplate': pool}
+    with open(os.path.join(out_dir, 'truth.json'), 'w', encoding='utf-8') as f:
+        json.dump(truth, f)
+    return truth
+
+def minhash_scores(truth, kept_names):
+    kept = set(kept_names)
+    sizes, kept_per_cluster = {}, {}
+    for name, c in zip(truth['names'], truth['clusters']):
+        sizes[c] = sizes.get(c, 0) + 1
+        kept_per_cluster[c] = kept_per_cluster.get(c, 0) + (name in kept)
+    tp = fp = fn = 0
+    for c, k in sizes.items():
+        removed = k - kept_per_cluster[c]
+        hit = min(removed, k - 1)
+        tp += hit
+        fp += removed - hit
+        fn += k - 1 - hit
+    return {
+        'true_duplicates': tp + fn,
+        'removed': tp + fp,
+        'precision': tp / (tp + fp) if tp + fp else 1.0,
+        'recall': tp / (tp + fn) if tp + fn else 1.0,
+    }
+
+def line_scores(truth, corpus_dir, output_dir):
+    boiler = set(truth['boilerplate'])
+    counts = {'boiler_in': 0, 'boiler_out': 0, 'content_in': 0, 'content_out': 0}
+    for name in truth['names']:
+        for key, path in (('in', os.path.join(corpus_dir, name)), ('out', os.path.join(output_dir, name))):
+            if not os.path.exists(path):
+                continue
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    line = line.rstrip('\n')
+                    if line:
+                        counts[('boiler_' if line in boiler else 'content_') + key] += 1
+    return {
+        'lines': counts['boiler_in'] + counts['content_in'],
+        'boilerplate_recall': 1 - counts['boiler_out'] / counts['boiler_in'] if counts['boiler_in'] else 1.0,
+        'content_removed': 1 - counts['content_out'] / counts['content_in'] if counts['content_in'] else 0.0,
+    }
+
+# 在子进程里跑一次去重，返回 (耗时, 去重函数的返回值, 峰值 RSS)
+def run_method(method, files, output_dir, params):
+    start = time.perf_counter()
+    if method == 'line':
+        result = exact_line_deduplication(files, output_dir, **params)
+    else:
+        result = minhash_deduplication(files, output_directory=output_dir, **params)
+    return time.perf_counter() - start, result, peak_rss_mb()
+
+def bench(corpus_dir, truth, method, params):
+    files = [os.path.join(corpus_dir, name) for name in truth['names']]
+    output_dir = corpus_dir + f'-out-{method}'
+    shutil.rmtree(output_dir, ignore_errors=True)
+    with mp.get_context('spawn').Pool(1) as pool:
+        elapsed, result, rss = pool.apply(run_method, (method, files, output_dir, params))
+    record = {
+        'method': method,
+        'params': params,
+        'seconds': elapsed,
+        'docs_per_sec': len(files) / elapsed if elapsed else 0.0,
+        'peak_rss_mb': rss,
+    }
+    if method == 'line':
+        record.update(line_scores(truth, corpus_dir, output_dir))
+    else:
+        record.update(result or {})
+        record.update(minhash_scores(truth, os.listdir(output_dir)))
+    shutil.rmtree(output_dir, ignore_errors=True)
+    return record
+
+def parse_list(value, cast):
+    return [cast(v) for v in value.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-docs', default='1000', help='逗号分隔的多个值会组合成网格，下同')
+    parser.add_argument('--edit-rate', default='0.0,0.02')
+    parser.add_argument('--boilerplate', default='0.1')
+    parser.add_argument('--dup-frac', type=float, default=0.3)
+    parser.add_argument('--cluster-size', type=int, default=4)
+    parser.add_argument('--doc-lines', type=int, default=20)
+    parser.add_argument('--methods', default='line,minhash')
+    parser.add_argument('--num-hashes', type=int, default=100)
+    parser.add_argument('--num-bands', type=int, default=10)
+    parser.add_argument('--ngrams', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=0.8)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', default='bench-dedup')
+    parser.add_argument('--output', default=None, help='结果 JSON 的路径，默认只打印')
+    args = parser.parse_args()
+
+    method_params = {
+        'line': {'num_workers': args.workers},
+        'minhash': {'num_hashes': args.num_hashes, 'num_bands': args.num_bands, 'ngrams': args.ngrams,
+                    'jaccard_threshold': args.threshold, 'num_workers': args.workers},
+    }
+    grid = itertools.product(parse_list(args.num_docs, int), parse_list(args.edit_rate, float),
+                             parse_list(args.boilerplate, float))
+    results = []
+    for num_docs, edit_rate, boilerplate in grid:
+        corpus = {'num_docs': num_docs, 'edit_rate': edit_rate, 'boilerplate': boilerplate,
+                  'dup_frac': args.dup_frac, 'cluster_size': args.cluster_size, 'doc_lines': args.doc_lines,
+                  'seed': args.seed}
+        corpus_dir = os.path.join(args.work_dir, f'corpus-{num_docs}-{edit_rate:g}-{boilerplate:g}')
+        shutil.rmtree(corpus_dir, ignore_errors=True)
+        print(f"Generating {corpus_dir}...")
+        truth = make_corpus(corpus_dir, num_docs, args.dup_frac, args.cluster_size, edit_rate, boilerplate,
+                            args.doc_lines, seed=args.seed)
+        for method in parse_list(args.methods, str):
+            record = {'corpus': corpus, **bench(corpus_dir, truth, method, method_params[method])}
+            results.append(record)
+            summary = {k: v for k, v in record.items() if k not in ('corpus', 'params')}
+            print(json.dumps({**corpus, **summary}))
+        shutil.rmtree(corpus_dir, ignore_errors=True)
+    if not os.listdir(args.work_dir):
+        os.rmdir(args.work_dir)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"Wrote {len(results)} results to {args.output}")
+
+if __name__ == '__main__':
+    main()
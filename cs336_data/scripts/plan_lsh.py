@@ -0,0 +1,45 @@
+import glob
+import argparse
+from deduplication import plan_lsh, lsh_sample, measure_lsh_configs
+
+# 为 minhash_deduplication 选 num_hashes / num_bands。
+#   python cs336_data/scripts/plan_lsh.py --threshold 0.8 --recall 0.9 --num-docs 5000000
+# 加上 --dry-run 'data/dedup-in/*.txt' 会先在样本上量出文档对的相似度分布再规划，并实测前几个方案的候选对数和召回率。
+
+def print_table(rows, columns):
+    print('\t'.join(columns))
+    for row in rows:
+        print('\t'.join(f"{row[c]:.4g}" if isinstance(row[c], float) else str(row[c]) for c in columns))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threshold', type=float, default=0.8, help='目标 Jaccard 阈值')
+    parser.add_argument('--recall', type=float, default=0.9, help='阈值处要求的召回率')
+    parser.add_argument('--num-docs', type=int, default=1_000_000, help='语料的文档数（估计）')
+    parser.add_argument('--max-hashes', type=int, default=256)
+    parser.add_argument('--hash-cost', type=float, default=0.02, help='一个签名值相对验证一对候选的代价')
+    parser.add_argument('--top', type=int, default=5)
+    parser.add_argument('--dry-run', default=None, help='样本文件的 glob')
+    parser.add_argument('--record-format', default=None, help='输入是多文档分片时的格式，如 jsonl')
+    parser.add_argument('--sample-docs', type=int, default=1000)
+    parser.add_argument('--ngrams', type=int, default=5)
+    args = parser.parse_args()
+
+    sample = None
+    if args.dry_run:
+        files = sorted(glob.glob(args.dry_run))
+        print(f"Measuring pair similarities on a sample of {args.sample_docs} docs from {len(files)} files...")
+        sample = lsh_sample(files, args.threshold, args.ngrams, args.sample_docs, args.max_hashes,
+                            record_format=args.record_format)
+    hist = sample['hist'] if sample else None
+    plans = plan_lsh(args.threshold, args.recall, args.num_docs, args.max_hashes, args.hash_cost, hist, args.top)
+    print_table(plans, ['num_bands', 'rows_per_band', 'num_hashes', 'knee', 'recall_at_threshold',
+                        'expected_candidates', 'expected_false_positives', 'cost'])
+    if args.dry_run:
+        results = measure_lsh_configs(sample, [(p['num_bands'], p['rows_per_band']) for p in plans])
+        print("\nMeasured on the sample:")
+        print_table(results, ['num_bands', 'rows_per_band', 'sample_docs', 'true_pairs', 'candidate_pairs',
+                              'false_positives', 'recall'])
+
+if __name__ == '__main__':
+    main()
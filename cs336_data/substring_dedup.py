@@ -0,0 +1,256 @@
+"""token 级的精确子串去重。
+
+整行去重和整篇 MinHash 都去不掉不按行对齐的重复段落（模板、版权声明、导航栏等）。这里直接在
+train.py 用 memmap 读取的 uint16 token .bin 上做：长度为 min_length 的 token 窗口如果在前面出现过，
+就把这个窗口里的 token 删掉。这样每段重复内容只保留第一次出现的那份，后面的副本整段删掉，
+短于 min_length 的重复不受影响。
+
+做法和 deduplication.parallel_exact_line_deduplication 一样是外存的，内存只和块大小、分区大小有关：
+1. 按块（相邻块重叠 min_length - 1 个 token）计算每个窗口的 64 位多项式指纹，把 (指纹, 位置) 按指纹
+   区间写进 num_partitions 个分区文件；
+2. 每个分区按 (指纹, 位置) 排序，指纹相同的窗口排在一起，组内第一个之后的窗口是重复的。
+   这相当于只按前 min_length 个 token 排序的截断后缀数组。和第一次出现重叠的窗口不算重复，所以周期性
+   的片段会留下开头的 min_length 个 token。指纹相同时会回到 .bin 里逐 token 比较，
+   哈希碰撞不会误删；重复窗口的起点写进它覆盖到的每个块的文件（min_length 可以大于 chunk_tokens）；
+3. 每个块根据落在块内的重复窗口生成删除掩码，写出清洗后的块，最后按顺序拼成输出 .bin。
+   给了 eos_token 时文档分隔符永远不删。
+
+    python cs336_data/substring_dedup.py data/train.bin data/train.dedup.bin --min-length 50 --workers 8
+
+统计信息同时写到 <output>.stats.json。
+"""
+import os
+import json
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+try:
+    from .deduplication import hash_partition, partition_dir, peak_rss_mb
+except ImportError:
+    from deduplication import hash_partition, partition_dir, peak_rss_mb
+
+# 多项式哈希的底数（奇数），运算都是 mod 2^64，溢出是有意的
+_BASE = np.uint64(0x9E3779B97F4A7C15)
+# 每次比较 token 窗口的行数
+VERIFY_BLOCK = 1 << 14
+
+def _mix64(x):
+    # splitmix64 的收尾，多项式哈希的低位不够均匀，打散后再分区
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(31)
+    return x
+
+def window_hashes(tokens, length):
+    """每个长度为 length 的窗口的 64 位指纹，返回 len(tokens) - length + 1 个。
+    按 length 的二进制位倍增拼接，只需要 O(log length) 次整块的向量运算"""
+    n = len(tokens)
+    if n < length:
+        return np.empty(0, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        # block_hash[i] 是 [i, i + block) 的哈希，block_pow = BASE^block
+        block_hash = tokens.astype(np.uint64) + np.uint64(1)
+        block, block_pow = 1, _BASE
+        result, result_len = None, 0
+        while True:
+            if length & block:
+                if result is None:
+                    result, result_len = block_hash.copy(), block
+                else:
+                    m = n - (result_len + block) + 1
+                    result = result[:m] * block_pow + block_hash[result_len:result_len + m]
+                    result_len += block
+            if block * 2 > length:
+                break
+            m = n - 2 * block + 1
+            block_hash = block_hash[:m] * block_pow + block_hash[block:block + m]
+            block_pow = block_pow * block_pow
+            block *= 2
+        return _mix64(result[:n - length + 1])
+
+def num_chunks(num_tokens, chunk_tokens):
+    return max((num_tokens + chunk_tokens - 1) // chunk_tokens, 1)
+
+def chunk_dir(work_dir, chunk):
+    return os.path.join(work_dir, 'starts', f'chunk-{chunk:06d}')
+
+def open_tokens(path, dtype=np.uint16):
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+# 第一遍 worker：一个块里所有窗口的 (指纹, 位置) 按分区写出
+def spill_window_hashes(args):
+    path, dtype, chunk, chunk_tokens, min_length, work_dir, num_partitions = args
+    tokens = open_tokens(path, dtype)
+    start = chunk * chunk_tokens
+    # 最后 min_length - 1 个 token 属于下一个块开头的窗口
+    window = np.asarray(tokens[start:start + chunk_tokens + min_length - 1])
+    hashes = window_hashes(window, min_length)
+    if len(hashes) == 0:
+        return 0
+    pairs = np.empty((len(hashes), 2), dtype=np.uint64)
+    pairs[:, 0] = hashes
+    pairs[:, 1] = np.arange(start, start + len(hashes), dtype=np.uint64)
+    parts = hash_partition(hashes, num_partitions)
+    order = np.argsort(parts, kind='stable')
+    parts, pairs = parts[order], pairs[order]
+    bounds = np.searchsorted(parts, np.arange(num_partitions + 1, dtype=np.uint64))
+    for part in np.flatnonzero(np.diff(bounds)):
+        out = os.path.join(partition_dir(work_dir, part), f'{chunk:06d}.u64')
+        pairs[bounds[part]:bounds[part + 1]].tofile(out)
+    return len(hashes)
+
+# 两组窗口是否逐 token 相同
+def windows_equal(tokens, a, b, min_length):
+    offsets = np.arange(min_length)
+    equal = np.empty(len(a), dtype=bool)
+    for i in range(0, len(a), VERIFY_BLOCK):
+        wa = tokens[a[i:i + VERIFY_BLOCK, None] + offsets]
+        wb = tokens[b[i:i + VERIFY_BLOCK, None] + offsets]
+        equal[i:i + VERIFY_BLOCK] = (wa == wb).all(axis=1)
+    return equal
+
+# 第二遍 worker：找出一个分区里的重复窗口，起点按块写出。返回 (重复窗口数, 哈希碰撞数, 分区窗口数)
+def find_duplicate_windows(args):
+    path, dtype, part, chunk_tokens, min_length, work_dir = args
+    part_path = partition_dir(work_dir, part)
+    names = sorted(os.listdir(part_path))
+    pairs = [np.fromfile(os.path.join(part_path, name), dtype=np.uint64).reshape(-1, 2) for name in names]
+    pairs = np.concatenate(pairs) if pairs else np.empty((0, 2), dtype=np.uint64)
+    shutil.rmtree(part_path)
+    if len(pairs) < 2:
+        return 0, 0, len(pairs)
+    order = np.lexsort((pairs[:, 1], pairs[:, 0]))
+    hashes, positions = pairs[order, 0], pairs[order, 1].astype(np.int64)
+    del pairs, order
+    new_group = np.r_[True, hashes[1:] != hashes[:-1]]
+    group = np.cumsum(new_group) - 1
+    # 组内位置最小的是第一次出现
+    first = positions[new_group][group]
+    # 和第一次出现重叠的窗口不算重复，否则周期性的片段（同一个短模式重复多次）连第一份都保不住
+    later = positions >= first + min_length
+    starts, firsts = positions[later], first[later]
+    equal = windows_equal(open_tokens(path, dtype), starts, firsts, min_length)
+    collisions = int((~equal).sum())
+    starts = np.sort(starts[equal])
+    # 窗口可能跨过后面的若干个块（min_length 大于 chunk_tokens 时不止一个），覆盖到的每个块都要记下
+    first_chunk, last_chunk = starts // chunk_tokens, (starts + min_length - 1) // chunk_tokens
+    for k in range((min_length - 1) // chunk_tokens + 2):
+        covered = first_chunk + k <= last_chunk
+        chunks, chunk_starts = first_chunk[covered] + k, starts[covered]
+        bounds = np.flatnonzero(np.r_[True, chunks[1:] != chunks[:-1]]) if len(chunks) else []
+        ends = list(bounds[1:]) + [len(chunks)]
+        for lo, hi in zip(bounds, ends):
+            c = int(chunks[lo])
+            with open(os.path.join(chunk_dir(work_dir, c), f'{part:04d}.i64'), 'ab') as f:
+                chunk_starts[lo:hi].tofile(f)
+    return len(starts), collisions, len(hashes)
+
+# 第三遍 worker：删掉一个块里被重复窗口覆盖的 token，写出清洗后的块。返回 (输入 token 数, 删除数)
+def clean_chunk(args):
+    path, dtype, chunk, chunk_tokens, min_length, work_dir, eos_token = args
+    tokens = open_tokens(path, dtype)
+    start = chunk * chunk_tokens
+    block = np.asarray(tokens[start:start + chunk_tokens])
+    cover = np.zeros(len(block) + 1, dtype=np.int32)
+    dirpath = chunk_dir(work_dir, chunk)
+    for name in sorted(os.listdir(dirpath)):
+        starts = np.unique(np.fromfile(os.path.join(dirpath, name), dtype=np.int64))
+        lo = np.clip(starts - start, 0, len(block))
+        hi = np.clip(starts + min_length - start, 0, len(block))
+        np.add.at(cover, lo, 1)
+        np.add.at(cover, hi, -1)
+    remove = np.cumsum(cover[:-1]) > 0
+    if eos_token is not None:
+        remove &= block != eos_token
+    block[~remove].tofile(os.path.join(work_dir, f'clean-{chunk:06d}.bin'))
+    shutil.rmtree(dirpath)
+    return len(block), int(remove.sum())
+
+
+def _run(executor, fn, tasks):
+    return list(executor.map(fn, tasks)) if executor is not None else [fn(task) for task in tasks]
+
+def exact_substring_deduplication(input_path, output_path, min_length=50, num_workers=1, num_partitions=64,
+                                  chunk_tokens=1 << 22, eos_token=None, dtype=np.uint16, tmp_dir=None):
+    """删除 input_path 中长度 >= min_length 的重复 token 片段（保留第一次出现），写出 output_path，返回统计"""
+    num_tokens = len(open_tokens(input_path, dtype))
+    chunks = num_chunks(num_tokens, chunk_tokens)
+    work_dir = tempfile.mkdtemp(prefix='substring-dedup-', dir=tmp_dir)
+    executor = ProcessPoolExecutor(max_workers=num_workers) if num_workers > 1 else None
+    try:
+        for part in range(num_partitions):
+            os.makedirs(partition_dir(work_dir, part))
+        for chunk in range(chunks):
+            os.makedirs(chunk_dir(work_dir, chunk))
+
+        print(f"Pass 1: Hashing {num_tokens} tokens ({chunks} chunks) into {num_partitions} partitions...")
+        tasks = [(input_path, dtype, c, chunk_tokens, min_length, work_dir, num_partitions) for c in range(chunks)]
+        num_windows = sum(_run(executor, spill_window_hashes, tasks))
+
+        print("Pass 2: Sorting partitions and finding repeated windows...")
+        tasks = [(input_path, dtype, part, chunk_tokens, min_length, work_dir) for part in range(num_partitions)]
+        results = _run(executor, find_duplicate_windows, tasks)
+        dup_windows = sum(r[0] for r in results)
+        collisions = sum(r[1] for r in results)
+        max_partition = max((r[2] for r in results), default=0)
+
+        print(f"Pass 3: Removing {dup_windows} repeated windows and writing output...")
+        tasks = [(input_path, dtype, c, chunk_tokens, min_length, work_dir, eos_token) for c in range(chunks)]
+        results = _run(executor, clean_chunk, tasks)
+        tmp_out = output_path + '.tmp'
+        with open(tmp_out, 'wb') as f_out:
+            for c in range(chunks):
+                part_path = os.path.join(work_dir, f'clean-{c:06d}.bin')
+                with open(part_path, 'rb') as f_in:
+                    shutil.copyfileobj(f_in, f_out)
+                os.remove(part_path)
+        os.replace(tmp_out, output_path)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    removed = sum(r[1] for r in results)
+    stats = {
+        'input_tokens': num_tokens,
+        'output_tokens': num_tokens - removed,
+        'removed_tokens': removed,
+        'removed_frac': removed / num_tokens if num_tokens else 0.0,
+        'min_length': min_length,
+        'windows': num_windows,
+        'duplicate_windows': dup_windows,
+        'hash_collisions': collisions,
+        # 第二遍单个分区的 (指纹, 位置) 对数，每对 16 字节
+        'max_partition_windows': max_partition,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    with open(output_path + '.stats.json', 'w', encoding='utf-8') as f:
+        json.dump(stats, f, indent=2)
+    print(f"删除 {removed} / {num_tokens} 个 token ({stats['removed_frac']:.2%})，"
+          f"重复窗口 {dup_windows}，哈希碰撞 {collisions}")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', help='uint16 token .bin')
+    parser.add_argument('output')
+    parser.add_argument('--min-length', type=int, default=50, help='重复片段的最短 token 数')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--partitions', type=int, default=64)
+    parser.add_argument('--chunk-tokens', type=int, default=1 << 22)
+    parser.add_argument('--eos-token', type=int, default=None, help='文档分隔符，永远不删，gpt2 是 50256')
+    parser.add_argument('--tmp-dir', default=None)
+    args = parser.parse_args()
+    exact_substring_deduplication(args.input, args.output, args.min_length, args.workers, args.partitions,
+                                  args.chunk_tokens, args.eos_token, tmp_dir=args.tmp_dir)
+
+if __name__ == '__main__':
+    main()
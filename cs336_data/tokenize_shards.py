@@ -0,0 +1,152 @@
+"""把 pipeline.py 输出的 .filtered.jsonl.gz 分片 tokenize 成 train.py 可以直接 memmap 的 uint16 .bin。
+
+    python cs336_data/tokenize_shards.py 'data/filtered-0.5/*.filtered.jsonl.gz' data/train.bin --workers 16
+
+每个分片交给进程池里的一个 worker：流式读出其中的文档（默认 JSONL，和 pipeline 的输出格式一致，
+其他格式见 deduplication.RECORD_FORMATS），用 GPT-2 tokenizer 按块批量编码，每篇文档后面追加一个 EOS
+（<|endoftext|>，50256），写到一个临时文件。
+主进程按分片的顺序把临时文件依次追加到一个预分配、不够时倍增的 memmap 里，所以输出和 worker 数无关。
+
+除了 <output>.bin，还会写 <output>.bin.idx：int64 的文档起点偏移，共 文档数 + 1 个，
+第 i 篇文档（含 EOS）是 tokens[idx[i]:idx[i + 1]]，可以用 load_documents 读取。
+"""
+import os
+import glob
+import time
+import shutil
+import argparse
+import tempfile
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import tiktoken
+try:
+    from .deduplication import get_record_format
+except ImportError:
+    from deduplication import get_record_format
+
+TOKEN_DTYPE = np.uint16
+# 每次批量编码的文档数
+ENCODE_BATCH = 256
+INDEX_SUFFIX = '.idx'
+
+def get_encoding(encoding):
+    return tiktoken.get_encoding(encoding) if isinstance(encoding, str) else encoding
+
+
+class TokenBinWriter:
+    """往 .bin 末尾追加 token 的 memmap，容量不够时文件长度翻倍后重新映射，close 时截断到实际长度。"""
+
+    def __init__(self, path, capacity=1 << 24, dtype=TOKEN_DTYPE):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.size = 0
+        self.capacity = 0
+        with open(path, 'wb'):
+            pass
+        self._mm = None
+        self._resize(max(capacity, 1))
+
+    def _resize(self, capacity):
+        if self._mm is not None:
+            self._mm.flush()
+            self._mm = None
+        with open(self.path, 'r+b') as f:
+            f.truncate(capacity * self.dtype.itemsize)
+        self.capacity = capacity
+        self._mm = np.memmap(self.path, dtype=self.dtype, mode='r+', shape=(capacity,))
+
+    def append(self, tokens):
+        end = self.size + len(tokens)
+        if end > self.capacity:
+            self._resize(max(end, self.capacity * 2))
+        self._mm[self.size:end] = tokens
+        self.size = end
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.flush()
+            self._mm = None
+        with open(self.path, 'r+b') as f:
+            f.truncate(self.size * self.dtype.itemsize)
+
+
+# worker：tokenize 一个分片，token 写进 tmp_path，返回每篇文档的长度（含 EOS）
+def tokenize_shard(args):
+    path, tmp_path, encoding, record_format = args
+    enc = get_encoding(encoding)
+    eos = enc.eot_token
+    records = (text for text in record_format.read(path) if text.strip())
+    lengths = []
+    with open(tmp_path, 'wb') as f:
+        for batch in iter(lambda: list(itertools.islice(records, ENCODE_BATCH)), []):
+            encoded = enc.encode_ordinary_batch(batch)
+            for ids in encoded:
+                ids.append(eos)
+                lengths.append(len(ids))
+            tokens = np.fromiter(itertools.chain.from_iterable(encoded), dtype=np.int64,
+                                 count=sum(lengths[-len(encoded):]))
+            if len(tokens) and tokens.max() > np.iinfo(TOKEN_DTYPE).max:
+                raise ValueError(f"token id {tokens.max()} 超出 {TOKEN_DTYPE.__name__} 的范围")
+            tokens.astype(TOKEN_DTYPE).tofile(f)
+    return np.array(lengths, dtype=np.int64)
+
+def tokenize_shards(input_files, output_path, num_workers=1, encoding='gpt2', record_format='jsonl',
+                    tmp_dir=None):
+    """返回 (文档数, token 数)"""
+    record_format = get_record_format(record_format)
+    # 临时文件和输出放在同一个文件系统上
+    work_dir = tempfile.mkdtemp(prefix='tokenize-', dir=tmp_dir or os.path.dirname(os.path.abspath(output_path)))
+    tasks = [(path, os.path.join(work_dir, f'{i:06d}.bin'), encoding, record_format)
+             for i, path in enumerate(input_files)]
+    writer = TokenBinWriter(output_path + '.tmp')
+    offsets = [np.zeros(1, dtype=np.int64)]
+    start = time.perf_counter()
+    executor = ProcessPoolExecutor(max_workers=num_workers) if num_workers > 1 else None
+    try:
+        results = executor.map(tokenize_shard, tasks) if executor is not None else map(tokenize_shard, tasks)
+        # map 按提交顺序返回，输出顺序固定
+        for (path, tmp_path, _, _), lengths in zip(tasks, results):
+            offsets.append(writer.size + np.cumsum(lengths))
+            writer.append(np.fromfile(tmp_path, dtype=TOKEN_DTYPE))
+            os.remove(tmp_path)
+            print(f"{os.path.basename(path)}: {len(lengths)} docs, {writer.size} tokens so far")
+        writer.close()
+        offsets = np.concatenate(offsets)
+        offsets.tofile(output_path + INDEX_SUFFIX + '.tmp')
+        os.replace(output_path + '.tmp', output_path)
+        os.replace(output_path + INDEX_SUFFIX + '.tmp', output_path + INDEX_SUFFIX)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+        # 中途失败时不留下写了一半的 .tmp，输出文件和语料一样大
+        for tmp in (output_path + '.tmp', output_path + INDEX_SUFFIX + '.tmp'):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    elapsed = time.perf_counter() - start
+    num_docs, num_tokens = len(offsets) - 1, int(offsets[-1])
+    print(f"{num_docs} docs, {num_tokens} tokens in {elapsed:.1f}s ({num_tokens / max(elapsed, 1e-9):.0f} tokens/s)")
+    return num_docs, num_tokens
+
+# 读取 .bin（memmap）和文档偏移
+def load_documents(path):
+    tokens = np.memmap(path, dtype=TOKEN_DTYPE, mode='r') if os.path.getsize(path) else np.empty(0, TOKEN_DTYPE)
+    offsets = np.fromfile(path + INDEX_SUFFIX, dtype=np.int64)
+    return tokens, offsets
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inputs', help='输入分片的 glob，按文件名排序')
+    parser.add_argument('output', help='输出的 .bin')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--encoding', default='gpt2')
+    parser.add_argument('--record-format', default='jsonl')
+    parser.add_argument('--tmp-dir', default=None)
+    args = parser.parse_args()
+    files = sorted(glob.glob(args.inputs))
+    tokenize_shards(files, args.output, args.workers, args.encoding, args.record_format, args.tmp_dir)
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,6 @@ from __future__ import annotations
 
 import os
 from typing import Any
-import fasttext
-classify_quality_model = None
-DIR_PATH = os.path.dirname(os.path.abspath(__file__))
-model_path = os.path.join(DIR_PATH, '..', 'cs336_data', 'data', 'classifiers', 'quality_classifier.bin')
 
 def run_extract_text_from_html_bytes(html_bytes: bytes) -> str | None:
     from cs336_data.preprocessing import extract_text_from_html_bytes
@@ -17,6 +13,11 @@ def run_identify_language(text: str) -> tuple[Any, float]:
     return identify_language(text)
 
 
+def run_identify_language_batch(texts: list[str], k: int = 1) -> tuple[Any, Any]:
+    from cs336_data.preprocessing import identify_language_batch
+    return identify_language_batch(texts, k=k)
+
+
 def run_mask_emails(text: str) -> tuple[str, int]:
     from cs336_data.preprocessing import mask_emails
     return mask_emails(text)
@@ -31,6 +32,10 @@ def run_mask_ips(text: str) -> tuple[str, int]:
     from cs336_data.preprocessing import mask_ips
     return mask_ips(text)
 
+def run_mask_pii(text: str) -> tuple[str, dict[str, int]]:
+    from cs336_data.preprocessing import mask_pii
+    return mask_pii(text)
+
 def run_classify_nsfw(text: str) -> tuple[Any, float]:
     from cs336_data.preprocessing import classify_nsfw_speech
     return classify_nsfw_speech(text)
@@ -44,15 +49,8 @@ def run_classify_toxic_speech(text: str) -> tuple[Any, float]:
 
 
 def run_classify_quality(text: str) -> tuple[Any, float]:
-    global classify_quality_model
-    if classify_quality_model is None:
-        classify_quality_model = fasttext.load_model(model_path)
-    clean_text = text.replace('\n', ' ')
-    labels, scores = classify_quality_model.predict(clean_text)
-    label = labels[0].replace('__label__', '')
-    final_label = 'wiki' if label == 'hq' else 'cc'
-    score = scores[0]
-    return final_label, score
+    from cs336_data.preprocessing import classify_quality
+    return classify_quality(text)
 
 
 def run_gopher_quality_filter(text: str) -> bool:
@@ -61,10 +59,10 @@ def run_gopher_quality_filter(text: str) -> bool:
 
 
 def run_exact_line_deduplication(
-    input_files: list[os.PathLike], output_directory: os.PathLike
+    input_files: list[os.PathLike], output_directory: os.PathLike, **kwargs
 ):
     from cs336_data.deduplication import exact_line_deduplication
-    return exact_line_deduplication(input_files, output_directory)
+    return exact_line_deduplication(input_files, output_directory, **kwargs)
 
 
 def run_minhash_deduplication(
@@ -74,7 +72,146 @@ def run_minhash_deduplication(
     ngrams: int,
     jaccard_threshold: float,
     output_directory: os.PathLike,
+    **kwargs,
 ):
     from cs336_data.deduplication import minhash_deduplication
     return minhash_deduplication(input_files, num_hashes, 
-                                 num_bands, ngrams, jaccard_threshold, output_directory)
+                                 num_bands, ngrams, jaccard_threshold, output_directory, **kwargs)
+
+
+def run_gopher_stats(text: str) -> dict:
+    from cs336_data.preprocessing import gopher_stats
+    return gopher_stats(text)
+
+
+def run_incremental_line_deduplication(
+    input_files: list[os.PathLike], output_directory: os.PathLike, index_path: os.PathLike, **kwargs
+):
+    from cs336_data.deduplication import incremental_line_deduplication
+    return incremental_line_deduplication(input_files, output_directory, index_path, **kwargs)
+
+
+def run_incremental_minhash_deduplication(
+    input_files: list[os.PathLike], output_directory: os.PathLike, index_path: os.PathLike, **kwargs
+):
+    from cs336_data.deduplication import incremental_minhash_deduplication
+    return incremental_minhash_deduplication(input_files, output_directory, index_path, **kwargs)
+
+
+def run_exact_substring_deduplication(
+    input_path: os.PathLike, output_path: os.PathLike, min_length: int, **kwargs
+) -> dict[str, Any]:
+    from cs336_data.substring_dedup import exact_substring_deduplication
+    return exact_substring_deduplication(str(input_path), str(output_path), min_length, **kwargs)
+
+
+def run_plan_lsh(jaccard_threshold: float, recall: float, num_docs: int, **kwargs) -> list[dict[str, Any]]:
+    from cs336_data.deduplication import plan_lsh
+    return plan_lsh(jaccard_threshold, recall, num_docs, **kwargs)
+
+
+def run_dry_run_lsh(
+    input_files: list[os.PathLike], jaccard_threshold: float, ngrams: int, configs: list[tuple[int, int]], **kwargs
+):
+    from cs336_data.deduplication import dry_run_lsh
+    return dry_run_lsh(input_files, jaccard_threshold, ngrams, configs, **kwargs)
+
+
+def run_tokenize_shards(
+    input_files: list[os.PathLike], output_path: os.PathLike, **kwargs
+) -> tuple[int, int]:
+    from cs336_data.tokenize_shards import tokenize_shards
+    return tokenize_shards(input_files, str(output_path), **kwargs)
+
+
+def run_load_documents(path: os.PathLike):
+    from cs336_data.tokenize_shards import load_documents
+    return load_documents(str(path))
+
+
+def run_minhash_signatures(
+    input_files: list[os.PathLike], num_hashes: int, ngrams: int, num_workers: int = 1
+):
+    from cs336_data.deduplication import compute_signatures, make_hash_params
+    return compute_signatures(input_files, make_hash_params(num_hashes), ngrams, num_workers=num_workers)
+
+
+def run_evict_models() -> None:
+    from cs336_data.model_registry import MODEL_FILES, registry
+    for key in MODEL_FILES:
+        registry.evict(key)
+
+
+def run_index_wet_file(input_path: os.PathLike, **kwargs) -> list[int]:
+    from cs336_data.pipeline import index_wet_file
+    return index_wet_file(str(input_path), **kwargs)
+
+
+def run_split_wet_file(input_path: os.PathLike, chunk_bytes: int) -> list[tuple[int, int]]:
+    from cs336_data.pipeline import split_wet_file
+    return split_wet_file(str(input_path), chunk_bytes)
+
+
+def run_filter_wet_file(
+    input_path: os.PathLike, output_path: os.PathLike, cascade_warmup: int = 0, batch_size: int = 0,
+    score_store: bool = False,
+):
+    from cs336_data.pipeline import init_worker, process_wet_file
+    init_worker(cascade_warmup, batch_size, score_store)
+    return process_wet_file((str(input_path), str(output_path)))
+
+
+def run_filter_wet_files_chunked(
+    tasks: list[tuple[os.PathLike, os.PathLike]], chunk_bytes: int, num_workers: int = 2, cascade_warmup: int = 0,
+    batch_size: int = 0, score_store: bool = False, prefork: bool = False,
+):
+    from cs336_data.pipeline import run_chunked
+    tasks = [(str(in_path), str(out_path)) for in_path, out_path in tasks]
+    return run_chunked(tasks, num_workers, chunk_bytes, (cascade_warmup, batch_size, score_store), prefork,
+                       score_store=score_store)
+
+
+def run_filter_cascade(
+    stages: list[tuple[str, Any]], texts: list[str], warmup: int, batch_size: int = 0,
+) -> tuple[list[str | None], list[str]]:
+    from cs336_data.pipeline import DocBatch, FilterCascade
+    cascade = FilterCascade(stages, warmup=warmup)
+    if batch_size > 0:
+        reasons = []
+        for i in range(0, len(texts), batch_size):
+            reasons.extend(cascade.run_batch(DocBatch(texts[i : i + batch_size])))
+    else:
+        reasons = [cascade.run(text) for text in texts]
+    return reasons, [name for name, _ in cascade.plan or []]
+
+
+def run_first_rejection(stages: list[tuple[str, Any]], text: str) -> str | None:
+    from cs336_data.pipeline import first_rejection
+    return first_rejection(stages, text)
+
+
+def run_read_process_memory(pid: int) -> dict[str, int]:
+    from cs336_data.pipeline import read_process_memory
+    return read_process_memory(pid)
+
+
+def run_pipeline(input_dir: os.PathLike, output_dir: os.PathLike, *args: str):
+    from cs336_data.pipeline import main
+    return main(["--input-dir", str(input_dir), "--output-dir", str(output_dir), *args])
+
+
+def run_load_manifest(output_dir: os.PathLike) -> dict[str, Any]:
+    from cs336_data.pipeline import load_manifest
+    return load_manifest(str(output_dir))
+
+
+def run_sweep_scores(scores_dir: os.PathLike, grid: dict[str, list[float]]) -> list[tuple[dict, dict]]:
+    from cs336_data.score_store import sweep
+    return sweep(str(scores_dir), grid)
+
+
+def run_materialise_scores(
+    scores_dir: os.PathLike, wet_dir: os.PathLike, output_dir: os.PathLike, thresholds: dict[str, float] | None = None
+) -> dict[str, int]:
+    from cs336_data.score_store import THRESHOLDS, materialise
+    return materialise(str(scores_dir), str(wet_dir), str(output_dir), thresholds or THRESHOLDS)
@@ -1,14 +1,30 @@
+import gzip
+import json
 import logging
 
+import numpy as np
+import pytest
 from xopen import xopen
 
-from .adapters import run_exact_line_deduplication, run_minhash_deduplication
+from .adapters import (
+    run_exact_line_deduplication,
+    run_exact_substring_deduplication,
+    run_incremental_line_deduplication,
+    run_incremental_minhash_deduplication,
+    run_minhash_deduplication,
+    run_minhash_signatures,
+    run_plan_lsh,
+    run_dry_run_lsh,
+)
 from .common import FIXTURES_PATH
 
 logger = logging.getLogger(__name__)
 
 
-def test_exact_line_deduplication(tmp_path):
+@pytest.mark.parametrize(
+    "options", [{}, {"buffer_size": 3}, {"num_workers": 2, "num_partitions": 4, "buffer_size": 3}]
+)
+def test_exact_line_deduplication(tmp_path, options):
     documents_with_line_duplicates_paths = list(
         (FIXTURES_PATH / "documents_with_line_duplicates").glob("doc*.txt")
     )
@@ -22,7 +38,7 @@ def test_exact_line_deduplication(tmp_path):
             deduplicated_documents.append(f.read())
 
     run_exact_line_deduplication(
-        input_files=documents_with_line_duplicates_paths, output_directory=tmp_path
+        input_files=documents_with_line_duplicates_paths, output_directory=tmp_path, **options
     )
     output_filepaths = list(tmp_path.glob("*"))
 
@@ -40,6 +56,34 @@ def test_exact_line_deduplication(tmp_path):
     assert len(deduplicated_documents) == 0
 
 
+def test_incremental_line_deduplication(tmp_path):
+    """
+    Deduplicating doc3-5 against an index built from doc1-2 gives the same output as
+    deduplicating all five documents together.
+    """
+    paths = sorted((FIXTURES_PATH / "documents_with_line_duplicates").glob("doc*.txt"))
+    index_path = tmp_path / "index"
+    run_incremental_line_deduplication(paths[:2], tmp_path / "snapshot1", index_path)
+    index = run_incremental_line_deduplication(paths[2:], tmp_path / "snapshot2", index_path)
+    assert len(index.segments) == 2
+    assert len(index.sources) == 5
+
+    for path in paths[2:]:
+        with open(FIXTURES_PATH / "documents_line_deduplicated" / path.name) as f:
+            expected = f.read()
+        with open(tmp_path / "snapshot2" / path.name) as f:
+            assert f.read() == expected
+
+    # Compacting the segments does not change lookups
+    index.compact()
+    assert len(index.segments) == 1
+    run_incremental_line_deduplication(paths[2:], tmp_path / "again", index_path, update_index=False)
+    for path in paths[2:]:
+        with open(tmp_path / "again" / path.name) as f:
+            # This batch is already in the index, so every line has been seen at least twice
+            assert f.read() == ""
+
+
 def test_minhash_deduplication_exact_duplicates(tmp_path):
     """
     Check that minhash deduplication properly identifies and removes exact duplicates.
@@ -80,7 +124,10 @@ def test_minhash_deduplication_exact_duplicates(tmp_path):
     assert len(deduplicated_documents) == 0
 
 
-def test_minhash_deduplication_fuzzy_duplicates(tmp_path):
+@pytest.mark.parametrize(
+    "options", [{}, {"ngram_store": False}, {"num_workers": 2, "estimate_z": 3.0}]
+)
+def test_minhash_deduplication_fuzzy_duplicates(tmp_path, options):
     """
     Check that minhash deduplication properly identifies and removes fuzzy
     duplicates (two documents with the MIT license, but with slightly different
@@ -111,6 +158,7 @@ def test_minhash_deduplication_fuzzy_duplicates(tmp_path):
         num_bands=50,
         ngrams=5,
         jaccard_threshold=0.8,
+        **options,
     )
     output_filepaths = list(tmp_path.glob("*"))
     assert len(output_filepaths) == 2
@@ -130,3 +178,249 @@ def test_minhash_deduplication_fuzzy_duplicates(tmp_path):
     assert len(deduplicated_documents) == 0
     # One of the kept deduplicated documents should be kept, and the other should be removed.
     assert len(kept_duplicated_documents) == 1
+
+
+def test_minhash_deduplication_large_bucket(tmp_path):
+    """
+    Many copies of the same document land in one LSH bucket; exactly one copy (the first) survives.
+    """
+    with open(FIXTURES_PATH / "documents_with_fuzzy_duplicates" / "rails_mit_license.txt") as f:
+        text = f.read()
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    paths = []
+    for i in range(200):
+        path = input_dir / f"copy{i:03d}.txt"
+        path.write_text(text)
+        paths.append(path)
+    output_dir = tmp_path / "output"
+    stats = run_minhash_deduplication(
+        input_files=paths,
+        output_directory=output_dir,
+        num_hashes=100,
+        num_bands=10,
+        ngrams=5,
+        jaccard_threshold=0.8,
+    )
+    assert [p.name for p in output_dir.glob("*")] == ["copy000.txt"]
+    # Star edges: one per non-representative copy, instead of one per pair in the bucket
+    assert stats["candidate_edges"] == 199 and stats["removed"] == 199
+
+
+def test_minhash_signatures_deterministic():
+    """
+    Signatures are defined by seeded mmh3 and exact (a*x + b) mod (2^61 - 1), so they match a
+    pure-Python reference and are identical across worker processes.
+    """
+    import mmh3
+
+    from cs336_data.deduplication import get_ngrams, make_hash_params, normalize
+
+    paths = sorted((FIXTURES_PATH / "documents_with_fuzzy_duplicates").glob("*.txt"))
+    signatures = run_minhash_signatures(paths, num_hashes=16, ngrams=5)
+    assert signatures.shape == (len(paths), 16)
+
+    prime = (1 << 61) - 1
+    hash_params = make_hash_params(16)
+    with open(paths[0]) as f:
+        ngram_set = get_ngrams(normalize(f.read()), 5)
+    hashes = [mmh3.hash64(ngram, 42, signed=False)[0] % prime for ngram in ngram_set]
+    expected = [min((int(a) * h + int(b)) % prime for h in hashes) for a, b in hash_params]
+    assert [int(v) for v in signatures[0]] == expected
+
+    parallel = run_minhash_signatures(paths, num_hashes=16, ngrams=5, num_workers=2)
+    assert (parallel == signatures).all()
+
+
+def test_incremental_minhash_deduplication(tmp_path):
+    """
+    A fuzzy duplicate arriving in a later batch is removed against the persistent index, without
+    recomputing the signatures of the first batch.
+    """
+    paths = sorted((FIXTURES_PATH / "documents_with_fuzzy_duplicates").glob("*.txt"))
+    first = [p for p in paths if p.name != "react_mit_license.txt"]
+    second = [p for p in paths if p.name == "react_mit_license.txt"]
+    index_path = tmp_path / "index"
+    params = dict(num_hashes=500, num_bands=50, ngrams=5, jaccard_threshold=0.8)
+
+    run_incremental_minhash_deduplication(first, tmp_path / "out1", index_path, **params)
+    assert sorted(p.name for p in (tmp_path / "out1").glob("*")) == [p.name for p in first]
+
+    index = run_incremental_minhash_deduplication(second, tmp_path / "out2", index_path, **params)
+    assert list((tmp_path / "out2").glob("*")) == []
+    assert len(index) == len(first)
+
+    # Reopening the index keeps its parameters and segments; compaction does not change query results
+    index = run_incremental_minhash_deduplication(second, tmp_path / "out3", index_path, update_index=False)
+    before = index.query(index.signatures(second), 0.8)
+    index.compact()
+    after = index.query(index.signatures(second), 0.8)
+    assert len(before[0]) == 1
+    assert all((a == b).all() for a, b in zip(before, after))
+
+
+def write_jsonl_shard(path, texts):
+    with gzip.open(path, "wt") as f:
+        for text in texts:
+            f.write(json.dumps({"text": text}) + "\n")
+
+
+def read_jsonl_shard(path):
+    with gzip.open(path, "rt") as f:
+        return [json.loads(line)["text"] for line in f]
+
+
+@pytest.mark.parametrize("options", [{}, {"num_workers": 2, "num_partitions": 4}])
+def test_exact_line_deduplication_records(tmp_path, options):
+    """
+    Multi-document shards: duplicate lines are removed inside each document (blank lines inside a
+    document do not split it), documents that lose every line are dropped, and shards are written
+    back in the same compressed JSONL format.
+    """
+    shards = {"a.jsonl.gz": ["x\nshared", "only a\n\npara two"], "b.jsonl.gz": ["shared\ny", "shared"]}
+    input_files = []
+    for name, texts in shards.items():
+        write_jsonl_shard(tmp_path / name, texts)
+        input_files.append(tmp_path / name)
+    output_dir = tmp_path / "output"
+    run_exact_line_deduplication(input_files, output_dir, record_format="jsonl", **options)
+    assert read_jsonl_shard(output_dir / "a.jsonl.gz") == ["x", "only a\npara two"]
+    assert read_jsonl_shard(output_dir / "b.jsonl.gz") == ["y"]
+
+
+def test_exact_line_deduplication_blank_line_records(tmp_path):
+    """
+    The blank-line format still works for documents without internal blank lines, and is written
+    back blank-line separated.
+    """
+    shards = {"a.txt.gz": "x\nshared\n\nonly a\n\n", "b.txt.gz": "shared\ny\n\nshared\n\n"}
+    input_files = []
+    for name, text in shards.items():
+        with gzip.open(tmp_path / name, "wt") as f:
+            f.write(text)
+        input_files.append(tmp_path / name)
+    output_dir = tmp_path / "output"
+    run_exact_line_deduplication(input_files, output_dir, record_format="blank_line")
+    with gzip.open(output_dir / "a.txt.gz", "rt") as f:
+        assert f.read() == "x\n\nonly a\n\n"
+    with gzip.open(output_dir / "b.txt.gz", "rt") as f:
+        assert f.read() == "y\n\n"
+
+
+def test_minhash_deduplication_records(tmp_path):
+    """
+    Whole documents inside JSONL shards are deduplicated individually, even though they contain
+    blank lines; the fuzzy duplicate in the second shard is removed and kept documents are written
+    back in order in the same format.
+    """
+    fixtures = FIXTURES_PATH / "documents_with_fuzzy_duplicates"
+    texts = {name: (fixtures / name).read_text() for name in
+             ["rails_mit_license.txt", "pytorch_license.txt", "react_mit_license.txt"]}
+    shards = {"s0.jsonl.gz": ["rails_mit_license.txt", "pytorch_license.txt"], "s1.jsonl.gz": ["react_mit_license.txt"]}
+    for shard, names in shards.items():
+        write_jsonl_shard(tmp_path / shard, [texts[name] for name in names])
+    output_dir = tmp_path / "output"
+    run_minhash_deduplication(
+        input_files=[tmp_path / shard for shard in shards],
+        output_directory=output_dir,
+        num_hashes=500,
+        num_bands=50,
+        ngrams=5,
+        jaccard_threshold=0.8,
+        record_format="jsonl",
+    )
+    assert read_jsonl_shard(output_dir / "s0.jsonl.gz") == [
+        texts["rails_mit_license.txt"],
+        texts["pytorch_license.txt"],
+    ]
+    assert read_jsonl_shard(output_dir / "s1.jsonl.gz") == []
+
+
+@pytest.mark.parametrize("options", [{}, {"chunk_tokens": 97, "num_partitions": 3, "num_workers": 2}])
+def test_exact_substring_deduplication(tmp_path, options):
+    """
+    Later copies of a repeated token span of at least min_length are removed, even when they are
+    not aligned with anything; the first copy, shorter repeats and EOS tokens are kept, and a periodic
+    span keeps its first min_length tokens.
+    """
+    rng = np.random.default_rng(0)
+    eos = 50256
+    boilerplate = rng.integers(0, 50000, 80).astype(np.uint16)
+    short = rng.integers(0, 50000, 20).astype(np.uint16)
+    pieces = [
+        rng.integers(0, 50000, 37), boilerplate, short, [eos],
+        rng.integers(0, 50000, 101), boilerplate, [eos],
+        rng.integers(0, 50000, 13), short, boilerplate[:60], rng.integers(0, 50000, 50),
+    ]
+    tokens = np.concatenate([np.asarray(p, dtype=np.uint16) for p in pieces])
+    input_path = tmp_path / "train.bin"
+    output_path = tmp_path / "train.dedup.bin"
+    tokens.tofile(input_path)
+
+    stats = run_exact_substring_deduplication(input_path, output_path, 50, eos_token=eos, **options)
+    output = np.fromfile(output_path, dtype=np.uint16)
+    expected = np.concatenate([np.asarray(p, dtype=np.uint16) for i, p in enumerate(pieces) if i not in (5, 9)])
+    assert (output == expected).all()
+    assert stats["removed_tokens"] == 80 + 60
+    assert stats["hash_collisions"] == 0
+
+    # A short motif repeated back to back: windows overlapping the first occurrence are not duplicates,
+    # so the first min_length tokens of the periodic span survive
+    motif = rng.integers(0, 50000, 10).astype(np.uint16)
+    pieces = [rng.integers(0, 50000, 30), np.tile(motif, 20), rng.integers(0, 50000, 30)]
+    tokens = np.concatenate([np.asarray(p, dtype=np.uint16) for p in pieces])
+    tokens.tofile(input_path)
+    stats = run_exact_substring_deduplication(input_path, output_path, 50, eos_token=eos, **options)
+    output = np.fromfile(output_path, dtype=np.uint16)
+    expected = np.concatenate([pieces[0], pieces[1][:50], pieces[2]]).astype(np.uint16)
+    assert (output == expected).all()
+    assert stats["removed_tokens"] == 150
+
+
+def test_exact_substring_deduplication_long_windows(tmp_path):
+    """
+    With min_length = 2 * chunk_tokens + 1 a repeated window covers at least three chunks; the
+    middle chunks must lose their tokens too, not only the first and last.
+    """
+    rng = np.random.default_rng(1)
+    chunk_tokens = 16
+    min_length = 2 * chunk_tokens + 1
+    repeated = rng.integers(0, 50000, 90).astype(np.uint16)
+    pieces = [rng.integers(0, 50000, 25), repeated, rng.integers(0, 50000, 7), repeated, rng.integers(0, 50000, 11)]
+    tokens = np.concatenate([np.asarray(p, dtype=np.uint16) for p in pieces])
+    input_path = tmp_path / "train.bin"
+    output_path = tmp_path / "train.dedup.bin"
+    tokens.tofile(input_path)
+
+    for options in [{}, {"num_partitions": 3, "num_workers": 2}]:
+        stats = run_exact_substring_deduplication(
+            input_path, output_path, min_length, chunk_tokens=chunk_tokens, **options
+        )
+        output = np.fromfile(output_path, dtype=np.uint16)
+        expected = np.concatenate([p for i, p in enumerate(pieces) if i != 3]).astype(np.uint16)
+        assert (output == expected).all()
+        assert stats["removed_tokens"] == len(repeated)
+
+
+def test_plan_lsh():
+    """
+    Plans use every hash (num_hashes = bands * rows), meet the recall target at the threshold and
+    are sorted by cost; a measured similarity histogram and a dry run on a sample agree with them.
+    """
+    plans = run_plan_lsh(0.8, 0.9, 100_000, max_hashes=128)
+    assert plans and plans == sorted(plans, key=lambda p: p["cost"])
+    for plan in plans:
+        assert plan["num_hashes"] == plan["num_bands"] * plan["rows_per_band"] <= 128
+        expected = 1 - (1 - 0.8 ** plan["rows_per_band"]) ** plan["num_bands"]
+        assert plan["recall_at_threshold"] == pytest.approx(expected)
+        assert plan["recall_at_threshold"] >= 0.9
+
+    paths = sorted((FIXTURES_PATH / "documents_with_fuzzy_duplicates").glob("*.txt"))
+    results, hist = run_dry_run_lsh(paths, 0.8, 5, [(50, 10), (1, 100)], max_hashes=500)
+    assert hist.sum() == len(paths) * (len(paths) - 1) // 2
+    assert results[0]["true_pairs"] == 1 and results[0]["recall"] == 1.0
+    assert results[1]["candidate_pairs"] <= results[0]["candidate_pairs"]
+
+    # The measured histogram replaces the pessimistic uniform prior, so fewer hashes suffice
+    informed = run_plan_lsh(0.8, 0.9, 100_000, max_hashes=128, similarity_hist=hist)
+    assert informed[0]["num_hashes"] <= plans[0]["num_hashes"]
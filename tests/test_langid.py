@@ -1,6 +1,6 @@
 import logging
 
-from .adapters import run_identify_language
+from .adapters import run_identify_language, run_identify_language_batch
 from .common import FIXTURES_PATH
 
 logger = logging.getLogger(__name__)
@@ -25,3 +25,19 @@ def test_identify_language_chinese_simplified():
     assert predicted_language == "zh"
     assert isinstance(score, float)
     assert score > 0
+
+
+def test_identify_language_batch_matches_single():
+    with open(FIXTURES_PATH / "moby_extracted.txt") as f:
+        moby_expected_text = f.read()
+    texts = [moby_expected_text, "欢迎来到我们的网站", "Bonjour tout le monde"]
+    labels, scores = run_identify_language_batch(texts)
+    assert labels.shape == scores.shape == (3,)
+    for text, label, score in zip(texts, labels, scores):
+        expected_label, expected_score = run_identify_language(text)
+        assert label == expected_label
+        assert abs(score - expected_score) < 1e-6
+
+    labels, scores = run_identify_language_batch(texts, k=2)
+    assert labels.shape == scores.shape == (3, 2)
+    assert (scores[:, 0] >= scores[:, 1]).all()
@@ -1,6 +1,9 @@
 import logging
+import random
 
-from .adapters import run_mask_emails, run_mask_ips, run_mask_phone_numbers
+import pytest
+
+from .adapters import run_mask_emails, run_mask_ips, run_mask_phone_numbers, run_mask_pii
 
 logger = logging.getLogger(__name__)
 
@@ -57,3 +60,59 @@ def test_mask_ips():
     masked_text, num_masked = run_mask_ips(test_string)
     assert masked_text == expected_masked_text
     assert num_masked == 1
+
+
+def test_mask_pii_all_categories():
+    test_string = (
+        "Email pl@fakedomain.ai or call (283)-182-3829, the server is at 192.0.2.1. "
+        "Backup: spl@fakedomain.ai, 2831823829 and 10.0.0.1"
+    )
+    expected_masked_text = (
+        "Email |||EMAIL_ADDRESS||| or call |||PHONE_NUMBER|||, the server is at |||IP_ADDRESS|||. "
+        "Backup: |||EMAIL_ADDRESS|||, |||PHONE_NUMBER||| and |||IP_ADDRESS|||"
+    )
+    masked_text, counts = run_mask_pii(test_string)
+    assert masked_text == expected_masked_text
+    assert counts == {"email": 2, "ip": 2, "phone": 2}
+
+    assert masked_text == mask_sequentially(test_string)[0]
+
+
+def test_mask_pii_no_pii():
+    test_string = "Nothing to mask here @ all, 2024 was a year."
+    masked_text, counts = run_mask_pii(test_string)
+    assert masked_text == test_string
+    assert counts == {"email": 0, "ip": 0, "phone": 0}
+
+
+def mask_sequentially(text):
+    """The reference for mask_pii: emails, then IPs, then phone numbers."""
+    text, emails = run_mask_emails(text)
+    text, ips = run_mask_ips(text)
+    text, phones = run_mask_phone_numbers(text)
+    return text, {"email": emails, "ip": ips, "phone": phones}
+
+
+@pytest.mark.parametrize(
+    "test_string",
+    [
+        # A phone number that starts before an email and runs into it must not leak the address
+        "a255123 9912312@12x.com",
+        "(555)1234567a@b.co",
+        "call 555-123-4567@example.org now",
+        "10.0.0.1234567890 and 192.168.1.1@host.net",
+        "2831823829.1.2.3 or 1.2.3.4 5678901",
+    ],
+)
+def test_mask_pii_overlapping_matches_sequential(test_string):
+    assert run_mask_pii(test_string) == mask_sequentially(test_string)
+
+
+def test_mask_pii_random_matches_sequential():
+    # Random concatenations of digit runs, separators and email fragments produce many overlapping
+    # near-matches of all three patterns
+    rng = random.Random(0)
+    pieces = ["1", "25", "555", "1234", "0", ".", "-", " ", "(", ")", "a", "x_1", "@", "@ab.co", ".org"]
+    for _ in range(5000):
+        test_string = "".join(rng.choice(pieces) for _ in range(rng.randint(1, 16)))
+        assert run_mask_pii(test_string) == mask_sequentially(test_string), test_string
@@ -0,0 +1,505 @@
+import gc
+import gzip
+import json
+import os
+import shutil
+import string
+import struct
+import time
+import uuid
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from .adapters import (
+    run_evict_models,
+    run_filter_cascade,
+    run_filter_wet_file,
+    run_filter_wet_files_chunked,
+    run_first_rejection,
+    run_index_wet_file,
+    run_load_manifest,
+    run_materialise_scores,
+    run_pipeline,
+    run_read_process_memory,
+    run_split_wet_file,
+    run_sweep_scores,
+)
+
+# Small synthetic vocabularies stand in for languages and content types. The fastText models below
+# let every word vote for the label of the vocabularies it belongs to, so the pipeline tests need
+# neither the downloaded classifiers nor a training run.
+VOCAB_SIZES = {"en": 400, "fr": 400, "nsfw": 100, "toxic": 100, "spam": 200}
+MODEL_LABELS = {
+    "lid": {"en": ["en", "nsfw", "toxic", "spam"], "fr": ["fr"]},
+    "nsfw": {"non-nsfw": ["en", "fr", "toxic", "spam"], "nsfw": ["nsfw"]},
+    "toxic": {"non-toxic": ["en", "fr", "nsfw", "spam"], "toxic": ["toxic"]},
+    "quality": {"wiki": ["en", "fr", "nsfw", "toxic"], "cc": ["spam"]},
+}
+WORDS_PER_LINE = 12
+
+
+def make_vocab(rng, size):
+    letters = np.array(list(string.ascii_lowercase))
+    return ["".join(rng.choice(letters, n)) for n in rng.integers(3, 9, size)]
+
+
+@pytest.fixture(scope="module")
+def vocab():
+    rng = np.random.default_rng(0)
+    return {name: make_vocab(rng, size) for name, size in VOCAB_SIZES.items()}
+
+
+def write_fasttext_model(path, label_words, scale=10.0):
+    """
+    Writes a supervised fastText model (binary format version 12, softmax loss, no subwords) whose
+    word vectors are `scale` times the one-hot vector of the word's label, so a text is scored by the
+    softmax of its label mix.
+    """
+    labels = list(label_words)
+    words = {}
+    for i, label in enumerate(labels):
+        for word in label_words[label]:
+            words.setdefault(word, i)
+    dim = len(labels)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<ii", 793712314, 12))
+        # dim, ws, epoch, minCount, neg, wordNgrams, loss=softmax, model=supervised, bucket, minn, maxn,
+        # lrUpdateRate, t
+        f.write(struct.pack("<12id", dim, 5, 5, 1, 5, 1, 3, 3, 0, 0, 0, 100, 1e-4))
+        # size, nwords, nlabels, ntokens, pruneidx_size (-1: not pruned)
+        f.write(struct.pack("<iiiqq", len(words) + len(labels), len(words), len(labels), len(words), -1))
+        for word in words:
+            f.write(word.encode() + b"\0" + struct.pack("<qb", 1, 0))
+        for label in labels:
+            f.write(f"__label__{label}".encode() + b"\0" + struct.pack("<qb", 1, 1))
+        input_matrix = scale * np.eye(dim, dtype=np.float32)[list(words.values())]
+        output_matrix = np.eye(dim, dtype=np.float32)
+        for matrix in (input_matrix, output_matrix):
+            # Unquantised flag, then rows, columns and the row-major float32 data
+            f.write(b"\0" + struct.pack("<qq", *matrix.shape) + matrix.tobytes())
+
+
+@pytest.fixture(scope="module")
+def model_paths(tmp_path_factory, vocab):
+    model_dir = tmp_path_factory.mktemp("models")
+    paths = {}
+    for key, labels in MODEL_LABELS.items():
+        paths[key] = model_dir / f"{key}.bin"
+        label_words = {label: [word for name in names for word in vocab[name]] for label, names in labels.items()}
+        write_fasttext_model(paths[key], label_words)
+    return paths
+
+
+@pytest.fixture(autouse=True)
+def fasttext_models(model_paths, monkeypatch):
+    # Environment overrides reach the worker processes too; evict models cached by other tests
+    for key, path in model_paths.items():
+        monkeypatch.setenv(f"CS336_MODEL_{key.upper()}", str(path))
+    run_evict_models()
+    yield
+    run_evict_models()
+
+
+def make_document(rng, vocab):
+    """Mostly one language, sometimes mixed with NSFW, toxic or spam words; lengths straddle the Gopher
+    word-count limit and paragraphs are separated by blank lines."""
+    weights = {"en" if rng.random() < 0.7 else "fr": 1.0}
+    for name in ("nsfw", "toxic"):
+        if rng.random() < 0.1:
+            weights[name] = rng.uniform(0.2, 1.5)
+    if rng.random() < 0.4:
+        weights["spam"] = rng.uniform(0.2, 1.5)
+    names = list(weights)
+    p = np.array([weights[name] for name in names])
+    sources = rng.choice(len(names), int(rng.integers(30, 200)), p=p / p.sum())
+    words = [vocab[names[s]][rng.integers(len(vocab[names[s]]))] for s in sources]
+    lines = []
+    for i in range(0, len(words), WORDS_PER_LINE):
+        lines.append(" ".join(words[i : i + WORDS_PER_LINE]))
+        if rng.random() < 0.2:
+            lines.append("")
+    return "\n".join(lines)
+
+
+def warc_record(rng, record_type, body, uri=None):
+    body = body.encode("utf-8")
+    headers = [
+        f"WARC-Type: {record_type}",
+        f"WARC-Record-ID: <urn:uuid:{uuid.UUID(bytes=rng.bytes(16))}>",
+        "WARC-Date: 2025-01-01T00:00:00Z",
+        "Content-Type: text/plain",
+        f"Content-Length: {len(body)}",
+    ]
+    if uri is not None:
+        headers.insert(1, f"WARC-Target-URI: {uri}")
+    return ("WARC/1.0\r\n" + "\r\n".join(headers) + "\r\n\r\n").encode() + body + b"\r\n\r\n"
+
+
+def write_wet(path, rng, vocab, num_docs):
+    """A WET file in Common Crawl layout: a warcinfo record followed by conversion records, each
+    compressed as its own gzip member. Returns the compressed size of every member."""
+    members = [gzip.compress(warc_record(rng, "warcinfo", "software: synthetic"))]
+    for i in range(num_docs):
+        text = make_document(rng, vocab) if rng.random() > 0.05 else "  \n"
+        members.append(gzip.compress(warc_record(rng, "conversion", text, f"http://example.com/{i}")))
+    with open(path, "wb") as f:
+        for member in members:
+            f.write(member)
+    return [len(member) for member in members]
+
+
+@pytest.fixture
+def wet_files(tmp_path, vocab):
+    rng = np.random.default_rng(2)
+    input_dir = tmp_path / "CC"
+    input_dir.mkdir()
+    paths = []
+    for name, num_docs in (("a.warc.wet.gz", 80), ("b.warc.wet.gz", 40)):
+        write_wet(input_dir / name, rng, vocab, num_docs)
+        paths.append(input_dir / name)
+    return paths
+
+
+def read_jsonl_shard(path):
+    with gzip.open(path, "rt") as f:
+        return [json.loads(line)["text"] for line in f]
+
+
+@pytest.mark.parametrize("read_size", [64, 1 << 20])
+def test_index_wet_file(tmp_path, vocab, read_size):
+    """
+    Member offsets are found whether a member boundary falls inside a read or across reads, and a
+    truncated trailing member is still covered up to the end of the file.
+    """
+    path = tmp_path / "a.warc.wet.gz"
+    sizes = write_wet(path, np.random.default_rng(3), vocab, 20)
+    expected = np.concatenate([[0], np.cumsum(sizes)]).tolist()
+    assert run_index_wet_file(path, read_size=read_size) == expected
+
+    with open(path, "ab") as f:
+        f.write(gzip.compress(b"WARC/1.0\r\n" * 50)[:30])
+    assert run_index_wet_file(path, read_size=read_size) == expected + [expected[-1] + 30]
+
+
+def test_split_wet_file(tmp_path, vocab):
+    """
+    Chunks are contiguous, start and end on member boundaries, cover the whole file and reach the
+    requested size except for the last one.
+    """
+    path = tmp_path / "a.warc.wet.gz"
+    sizes = write_wet(path, np.random.default_rng(4), vocab, 50)
+    offsets = set(np.concatenate([[0], np.cumsum(sizes)]).tolist())
+    chunks = run_split_wet_file(path, 3000)
+    assert len(chunks) > 1
+    assert chunks[0][0] == 0 and chunks[-1][1] == sum(sizes)
+    for (start, end), (next_start, _) in zip(chunks, chunks[1:]):
+        assert end == next_start
+        assert end - start >= 3000
+    assert all(start in offsets and end in offsets for start, end in chunks)
+
+
+@pytest.mark.parametrize("options", [{}, {"batch_size": 7}, {"score_store": True}])
+def test_chunked_matches_whole_file(tmp_path, wet_files, options):
+    """
+    Splitting WET files into record chunks filtered by a process pool gives the same output shards,
+    in the same order, and the same statistics as filtering each file in one piece.
+    """
+    whole_dir, chunked_dir = tmp_path / "whole", tmp_path / "chunked"
+    whole_dir.mkdir()
+    chunked_dir.mkdir()
+    tasks = [(path, chunked_dir / path.name.replace(".wet.gz", ".filtered.jsonl.gz")) for path in wet_files]
+    file_stats = run_filter_wet_files_chunked(tasks, 2000, **options)
+    for in_path, out_path in tasks:
+        whole_path = whole_dir / out_path.name
+        stats = run_filter_wet_file(in_path, whole_path, **options)
+        assert file_stats[str(in_path)] == stats
+        assert read_jsonl_shard(out_path) == read_jsonl_shard(whole_path)
+        assert not list(chunked_dir.glob("*.part*"))
+    # Each JSONL line holds a whole document, blank lines between paragraphs included
+    assert any("\n\n" in text for _, out_path in tasks for text in read_jsonl_shard(out_path))
+    # The synthetic corpus exercises the early-exit paths
+    total = sum(file_stats.values(), Counter())
+    assert total["kept"] > 0
+    assert all(total[name] > 0 for name in ("empty", "rejected_gopher", "rejected_lang", "rejected_nsfw",
+                                            "rejected_toxic", "rejected_quality_model"))
+
+
+def test_chunked_skips_corrupt_file(tmp_path, wet_files):
+    """
+    A file whose gzip members cannot be indexed is counted as a file error and skipped; the other
+    files are still filtered.
+    """
+    corrupt = wet_files[0].parent / "corrupt.warc.wet.gz"
+    data = bytearray(wet_files[0].read_bytes())
+    data[200:260] = bytes(b ^ 0xFF for b in data[200:260])
+    corrupt.write_bytes(bytes(data))
+    output_dir = tmp_path / "chunked"
+    output_dir.mkdir()
+    tasks = [(path, output_dir / path.name.replace(".wet.gz", ".filtered.jsonl.gz")) for path in [corrupt, *wet_files]]
+    file_stats = run_filter_wet_files_chunked(tasks, 2000)
+    assert file_stats[str(corrupt)] == Counter(file_error=1)
+    assert sorted(path.name for path in output_dir.iterdir()) == sorted(out_path.name for _, out_path in tasks[1:])
+    assert all(file_stats[str(path)]["kept"] > 0 for path in wet_files)
+
+
+def make_stage(reject_every, delay):
+    def keep(text):
+        time.sleep(delay)
+        return int(text) % reject_every != 0
+    return keep
+
+
+def make_batch_stage(keep):
+    return lambda batch, idx: np.array([keep(batch.texts[i]) for i in idx], dtype=bool)
+
+
+# In the fixed order the slow, rarely rejecting stage runs first and the cheap one that rejects half of
+# the documents runs last
+CASCADE_STAGES = [
+    ("slow", make_stage(10, 1e-3)),
+    ("never", make_stage(1 << 30, 0)),
+    ("cheap", make_stage(2, 0)),
+]
+
+
+@pytest.mark.parametrize("batch_size", [0, 8])
+def test_filter_cascade(batch_size):
+    """
+    After warm-up the cascade runs cheap, often-rejecting stages first and never-rejecting ones last; a
+    document is kept exactly when the fixed order keeps it, and rejections are attributed to the first
+    rejecting stage of whichever order was used.
+    """
+    stages = CASCADE_STAGES
+    if batch_size > 0:
+        stages = [(name, make_batch_stage(keep)) for name, keep in CASCADE_STAGES]
+    texts = [str(i) for i in range(1, 101)]
+    reasons, order = run_filter_cascade(stages, texts, warmup=16, batch_size=batch_size)
+    assert order == ["cheap", "slow", "never"]
+    for i, (text, reason) in enumerate(zip(texts, reasons)):
+        expected = run_first_rejection(CASCADE_STAGES, text)
+        assert (reason is None) == (expected is None)
+        if i < 16:
+            assert reason == expected
+        elif reason is not None:
+            assert reason == "cheap"
+
+
+def test_cascade_matches_fixed_order(tmp_path, wet_files):
+    """
+    Filtering with a measured stage order keeps the same documents as the fixed order, and a later run
+    without a cascade goes back to the fixed order's attribution.
+    """
+    for in_path in wet_files:
+        fixed = run_filter_wet_file(in_path, tmp_path / "fixed.jsonl.gz")
+        reordered = run_filter_wet_file(in_path, tmp_path / "cascade.jsonl.gz", cascade_warmup=10)
+        assert read_jsonl_shard(tmp_path / "cascade.jsonl.gz") == read_jsonl_shard(tmp_path / "fixed.jsonl.gz")
+        assert reordered["kept"] == fixed["kept"]
+        assert reordered.total() == fixed.total()
+        assert run_filter_wet_file(in_path, tmp_path / "fixed.jsonl.gz") == fixed
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 1000])
+def test_batch_matches_per_document(tmp_path, wet_files, batch_size):
+    """
+    Classifying documents in batches, including a partial final batch and a batch larger than the
+    file, writes the same documents and counts the same rejections as one document at a time; with a
+    cascade the kept documents still match.
+    """
+    for in_path in wet_files:
+        single = run_filter_wet_file(in_path, tmp_path / "single.jsonl.gz")
+        batched = run_filter_wet_file(in_path, tmp_path / "batched.jsonl.gz", batch_size=batch_size)
+        assert batched == single
+        assert read_jsonl_shard(tmp_path / "batched.jsonl.gz") == read_jsonl_shard(tmp_path / "single.jsonl.gz")
+
+        reordered = run_filter_wet_file(in_path, tmp_path / "cascade.jsonl.gz", cascade_warmup=10,
+                                        batch_size=batch_size)
+        assert reordered["kept"] == single["kept"]
+        assert reordered.total() == single.total()
+        assert read_jsonl_shard(tmp_path / "cascade.jsonl.gz") == read_jsonl_shard(tmp_path / "single.jsonl.gz")
+
+
+@pytest.mark.parametrize("options", [{}, {"batch_size": 7}, {"cascade_warmup": 10, "batch_size": 7}])
+def test_prefork_matches_default(tmp_path, wet_files, options):
+    """
+    Loading the models once in the parent and forking the workers from it gives the same output
+    shards and statistics as workers that load their own models. Each worker measures its own cascade
+    order, so with a cascade only the kept and total counts are compared.
+    """
+    outputs = {}
+    for prefork in (False, True):
+        output_dir = tmp_path / f"prefork-{prefork}"
+        output_dir.mkdir()
+        tasks = [(path, output_dir / path.name.replace(".wet.gz", ".filtered.jsonl.gz")) for path in wet_files]
+        try:
+            file_stats = run_filter_wet_files_chunked(tasks, 2000, prefork=prefork, **options)
+        finally:
+            gc.unfreeze()
+        if options.get("cascade_warmup"):
+            file_stats = {path: (stats["kept"], stats.total()) for path, stats in file_stats.items()}
+        outputs[prefork] = file_stats, [read_jsonl_shard(out_path) for _, out_path in tasks]
+    assert outputs[True] == outputs[False]
+
+
+def test_read_process_memory():
+    mem = run_read_process_memory(os.getpid())
+    assert mem["VmRSS"] > 0
+    assert mem["VmHWM"] >= mem["VmRSS"]
+    if os.path.exists(f"/proc/{os.getpid()}/smaps_rollup"):
+        assert 0 < mem["Pss"] <= mem["VmRSS"]
+
+
+def output_files(output_dir):
+    """Inode and modification time of every published output, to tell skipped files from rewritten ones."""
+    return {path.name: (path.stat().st_ino, path.stat().st_mtime_ns) for path in output_dir.glob("*.jsonl.gz")}
+
+
+@pytest.mark.parametrize("args", [[], ["--chunked", "--chunk-mb", "0.002"]])
+def test_pipeline_resumes_from_manifest(tmp_path, wet_files, vocab, args):
+    """
+    A second run skips the files the manifest records as complete and reports their stored statistics;
+    --force reprocesses everything and a modified input is reprocessed on its own.
+    """
+    input_dir, output_dir = wet_files[0].parent, tmp_path / "filtered"
+    args = ["--workers", "2", *args]
+    first = run_pipeline(input_dir, output_dir, *args)
+    manifest = run_load_manifest(output_dir)
+    assert set(manifest) == {path.name for path in wet_files}
+    assert sum((Counter(entry["stats"]) for entry in manifest.values()), Counter()) == first
+    outputs = output_files(output_dir)
+    assert len(outputs) == len(wet_files)
+
+    assert run_pipeline(input_dir, output_dir, *args) == first
+    assert output_files(output_dir) == outputs
+    assert run_load_manifest(output_dir) == manifest
+
+    assert run_pipeline(input_dir, output_dir, *args, "--force") == first
+    forced = output_files(output_dir)
+    assert all(forced[name][0] != outputs[name][0] for name in outputs)
+
+    changed = wet_files[1]
+    write_wet(changed, np.random.default_rng(5), vocab, 10)
+    rerun = run_pipeline(input_dir, output_dir, *args)
+    assert rerun["total_docs"] == first["total_docs"] - manifest[changed.name]["stats"]["total_docs"] + 10
+    after = output_files(output_dir)
+    changed_output = manifest[changed.name]["output"]
+    assert after[changed_output] != forced[changed_output]
+    assert all(after[name] == forced[name] for name in forced if name != changed_output)
+
+
+def fail_after_writing(stream, f_out, logging, scores=None):
+    f_out.write("partial\n")
+    raise RuntimeError("simulated failure")
+
+
+@pytest.mark.parametrize("score_store", [False, True])
+def test_failed_file_leaves_no_output(tmp_path, wet_files, monkeypatch, score_store):
+    """
+    A file that fails part-way leaves neither its temporary output nor a scores sidecar behind, is
+    not recorded in the manifest and is processed by the next run.
+    """
+    input_dir, output_dir = wet_files[0].parent, tmp_path / "filtered"
+    out_path = tmp_path / "single" / "a.warc.filtered.jsonl.gz"
+    out_path.parent.mkdir()
+    args = ["--workers", "2"] + (["--score-store"] if score_store else [])
+    with monkeypatch.context() as patch:
+        patch.setattr("cs336_data.pipeline.filter_wet_records", fail_after_writing)
+        stats = run_filter_wet_file(wet_files[0], out_path, score_store=score_store)
+        assert stats["file_error"] == 1
+        assert list(out_path.parent.iterdir()) == []
+
+        assert run_pipeline(input_dir, output_dir, *args)["file_error"] == len(wet_files)
+        assert [path.name for path in output_dir.iterdir()] == []
+
+    stats = run_pipeline(input_dir, output_dir, *args)
+    assert stats["file_error"] == 0 and stats["total_docs"] > 0
+    assert set(run_load_manifest(output_dir)) == {path.name for path in wet_files}
+
+
+def read_output_dir(output_dir):
+    return {path.name: read_jsonl_shard(path) for path in sorted(output_dir.glob("*.filtered.jsonl.gz"))}
+
+
+def test_score_store_sweep_and_materialise(tmp_path, wet_files, monkeypatch):
+    """
+    Re-evaluating the stored scores at the pipeline's thresholds reproduces its statistics and kept
+    documents; at another quality threshold they match a pipeline run with that threshold, and raising
+    the threshold never keeps fewer documents.
+    """
+    input_dir, output_dir = wet_files[0].parent, tmp_path / "filtered"
+    pipeline_stats = run_pipeline(input_dir, output_dir, "--workers", "2", "--score-store")
+
+    quality = [0.5, 0.7, 0.9, 0.99]
+    results = run_sweep_scores(output_dir, {"quality": quality})
+    assert [thresholds["quality"] for thresholds, _ in results] == quality
+    kept = [stats["kept"] for _, stats in results]
+    assert kept == sorted(kept) and kept[0] < kept[-1]
+    default_stats = {k: v for k, v in results[0][1].items() if k != "retention"}
+    assert +Counter(default_stats) == pipeline_stats
+
+    materialised_dir = tmp_path / "materialised"
+    assert run_materialise_scores(output_dir, input_dir, materialised_dir) == default_stats
+    assert read_output_dir(materialised_dir) == read_output_dir(output_dir)
+
+    strict_dir, rerun_dir = tmp_path / "quality-0.9", tmp_path / "rerun-0.9"
+    strict_stats = run_materialise_scores(output_dir, input_dir, strict_dir, {"quality": 0.9})
+    assert strict_stats["kept"] == kept[2]
+    from cs336_data.score_store import THRESHOLDS
+    monkeypatch.setitem(THRESHOLDS, "quality", 0.9)
+    rerun_dir.mkdir()
+    rerun_stats = Counter()
+    for path in wet_files:
+        rerun_stats += run_filter_wet_file(path, rerun_dir / path.name.replace(".wet.gz", ".filtered.jsonl.gz"))
+    assert +Counter(strict_stats) == rerun_stats
+    assert read_output_dir(strict_dir) == read_output_dir(rerun_dir)
+
+
+def test_materialise_rejects_mismatched_record_count(tmp_path, wet_files, vocab):
+    """
+    Materialising against a WET file with more or fewer conversion records than its scores sidecar
+    raises instead of indexing past the sidecar or silently stopping early, and publishes nothing.
+    """
+    short_dir, long_dir = tmp_path / "short", tmp_path / "long"
+    short_dir.mkdir()
+    long_dir.mkdir()
+    shutil.copy(wet_files[0], short_dir / wet_files[0].name)
+    extra = tmp_path / "extra.wet.gz"
+    write_wet(extra, np.random.default_rng(7), vocab, 5)
+    (long_dir / wet_files[0].name).write_bytes(wet_files[0].read_bytes() + extra.read_bytes())
+    for wet_dir in (short_dir, long_dir):
+        run_pipeline(wet_dir, wet_dir / "filtered", "--workers", "1", "--score-store")
+
+    for scores_dir, wet_dir in ((short_dir / "filtered", long_dir), (long_dir / "filtered", short_dir)):
+        output_dir = tmp_path / f"materialised-{wet_dir.name}"
+        with pytest.raises(ValueError):
+            run_materialise_scores(scores_dir, wet_dir, output_dir)
+        assert list(output_dir.iterdir()) == []
+
+
+def test_missing_model_checked_once(tmp_path, wet_files, model_paths, monkeypatch):
+    """
+    A missing model disables its stage without looking for the file again for every document; a
+    model that appears later is picked up once it is evicted.
+    """
+    expected = run_filter_wet_file(wet_files[0], tmp_path / "out.jsonl.gz")
+    missing = tmp_path / "missing.bin"
+    monkeypatch.setenv("CS336_MODEL_NSFW", str(missing))
+    run_evict_models()
+    checks = Counter()
+    exists = os.path.exists
+
+    def counting_exists(path):
+        checks[str(path)] += 1
+        return exists(path)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(os.path, "exists", counting_exists)
+        stats = run_filter_wet_file(wet_files[0], tmp_path / "out.jsonl.gz")
+    assert stats["total_docs"] > 1 and stats["rejected_nsfw"] == 0
+    assert checks[str(missing)] == 1
+
+    shutil.copy(model_paths["nsfw"], missing)
+    assert run_filter_wet_file(wet_files[0], tmp_path / "out.jsonl.gz")["rejected_nsfw"] == 0
+    run_evict_models()
+    assert run_filter_wet_file(wet_files[0], tmp_path / "out.jsonl.gz") == expected
@@ -1,6 +1,8 @@
 import logging
 
-from .adapters import run_classify_quality, run_gopher_quality_filter
+import pytest
+
+from .adapters import run_classify_quality, run_gopher_quality_filter, run_gopher_stats
 from .common import FIXTURES_PATH
 
 logger = logging.getLogger(__name__)
@@ -92,3 +94,75 @@ def test_gopher_less_than_80_percent_words_with_alphabetic_character():
     words += ["word" for _ in range(2)]
     text = "the and " + " ".join(words)
     assert not run_gopher_quality_filter(text)
+
+
+# (fixture, NLTK word count, scanner word count, Gopher decision). The scanner approximates
+# nltk.word_tokenize; on these fixtures it differs only through the divergences listed below.
+GOPHER_FIXTURES = [
+    ("low_quality_cc.txt", 119, 119, True),
+    ("high_quality_wiki_reference.txt", 12365, 12362, True),
+    ("moby_extracted.txt", 125, 125, True),
+    ("documents_with_fuzzy_duplicates/pytorch_license.txt", 585, 585, False),
+    ("documents_with_fuzzy_duplicates/rails_mit_license.txt", 201, 201, True),
+]
+
+
+@pytest.mark.parametrize("fixture, nltk_words, num_words, passes", GOPHER_FIXTURES)
+def test_gopher_stats_match_nltk(fixture, nltk_words, num_words, passes):
+    """
+    Word counts and filter decisions on the fixtures are pinned exactly. The scanner's count differs
+    from NLTK's only on high_quality_wiki_reference.txt, where it sees three fewer words: it keeps
+    "cannot" whole (3 occurrences, -3), keeps the period of "savage.”" on the word (-1) and splits the
+    initial in "see L. Davis" (+1). These cases are tested on their own below. The pinned decisions
+    are those of the NLTK-based filter.
+    """
+    with open(FIXTURES_PATH / fixture) as f:
+        text = f.read()
+    stats = run_gopher_stats(text)
+    assert stats["num_words"] == num_words
+    assert run_gopher_quality_filter(text) == passes
+
+    nltk = pytest.importorskip("nltk")
+    try:
+        words = nltk.word_tokenize(text)
+    except LookupError:
+        pytest.skip("nltk punkt data not available")
+    assert len(words) == nltk_words
+    assert stats["mean_word_len"] == pytest.approx(sum(len(w) for w in words) / len(words), rel=0.01)
+    alpha_frac = sum(1 for w in words if any(c.isalpha() for c in w)) / len(words)
+    assert stats["alpha_frac"] == pytest.approx(alpha_frac, abs=0.005)
+
+
+# Known divergences from nltk.word_tokenize: (text, NLTK word count, scanner word count)
+GOPHER_DIVERGENCES = [
+    # Treebank splits "cannot" into "can" and "not"
+    ("You cannot go", 4, 3),
+    # punkt ends the sentence before the closing quote; the scanner keeps the period on the word
+    ("the “noble savage.” One must", 8, 7),
+    # punkt keeps a single-letter initial with its period; the scanner splits it off
+    ("see L. Davis", 3, 4),
+]
+
+
+@pytest.mark.parametrize("text, nltk_words, num_words", GOPHER_DIVERGENCES)
+def test_gopher_known_divergences(text, nltk_words, num_words):
+    assert run_gopher_stats(text)["num_words"] == num_words
+    nltk = pytest.importorskip("nltk")
+    try:
+        assert len(nltk.word_tokenize(text)) == nltk_words
+    except LookupError:
+        pytest.skip("nltk punkt data not available")
+
+
+def test_gopher_early_exit_matches_full_stats():
+    texts = [
+        "The string you are reading is too long of a text. " * 50000,
+        "word " * 100001,
+        "short",
+        "“Quoted” text -- with dashes — and 3,000 numbers at 10:30, don't stop... " * 20,
+        "½ ² ³ " * 40 + "plain words here " * 20,
+    ]
+    from cs336_data.preprocessing import gopher_passes
+
+    for text in texts:
+        assert run_gopher_quality_filter(text) == bool(gopher_passes(run_gopher_stats(text)))
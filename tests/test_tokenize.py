@@ -0,0 +1,71 @@
+import gzip
+import json
+
+import numpy as np
+import pytest
+import tiktoken
+
+from .adapters import run_load_documents, run_tokenize_shards
+
+
+def byte_encoding():
+    # Byte-level BPE without merges, so the test does not need to download the GPT-2 vocabulary
+    return tiktoken.Encoding(
+        name="bytes",
+        pat_str=r"\S+|\s+",
+        mergeable_ranks={bytes([i]): i for i in range(256)},
+        special_tokens={"<|endoftext|>": 50256},
+    )
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_tokenize_shards(tmp_path, num_workers):
+    """
+    Documents from every JSONL shard are tokenized in shard order with one EOS each, including
+    multi-paragraph documents; the offset index recovers every document and the output does not
+    depend on the number of workers.
+    """
+    shards = [
+        ["first document", "second one\nspans two lines"],
+        [],
+        ["Title\n\nPara one.\n\nPara two.", "Doc two\n\nmore"],
+        ["<|endoftext|> in the text is not special", "x" * 1000],
+    ]
+    paths = []
+    for i, docs in enumerate(shards):
+        path = tmp_path / f"shard{i}.filtered.jsonl.gz"
+        with gzip.open(path, "wt") as f:
+            for doc in docs:
+                f.write(json.dumps({"text": doc}) + "\n")
+        paths.append(path)
+    output = tmp_path / "train.bin"
+    enc = byte_encoding()
+
+    num_docs, num_tokens = run_tokenize_shards(paths, output, num_workers=num_workers, encoding=enc)
+    docs = [doc for shard in shards for doc in shard]
+    expected = np.concatenate([enc.encode_ordinary(doc) + [50256] for doc in docs]).astype(np.uint16)
+    assert (num_docs, num_tokens) == (len(docs), len(expected))
+    assert (np.memmap(output, dtype=np.uint16, mode="r") == expected).all()
+
+    tokens, offsets = run_load_documents(output)
+    assert len(offsets) == len(docs) + 1
+    for i, doc in enumerate(docs):
+        assert enc.decode(list(tokens[offsets[i] : offsets[i + 1] - 1])) == doc
+        assert tokens[offsets[i + 1] - 1] == 50256
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_tokenize_shards_failure_cleanup(tmp_path, num_workers):
+    """
+    A shard that fails to tokenize raises, and leaves neither the partial output .tmp files nor
+    the worker directory behind.
+    """
+    path = tmp_path / "shard0.filtered.jsonl.gz"
+    with gzip.open(path, "wt") as f:
+        f.write(json.dumps({"text": "first document"}) + "\n")
+    output = tmp_path / "train.bin"
+    with pytest.raises(FileNotFoundError):
+        run_tokenize_shards(
+            [path, tmp_path / "missing.filtered.jsonl.gz"], output, num_workers=num_workers, encoding=byte_encoding()
+        )
+    assert sorted(p.name for p in tmp_path.iterdir()) == [path.name]